@@ -1,13 +1,14 @@
 # noinspection PyUnresolvedReferences
+import itertools
 from dataclasses import dataclass
 from datetime import date
-from threading import Lock
-from time import time
 from typing import Dict, List, Optional, Tuple
 
 import ldap
 from ldap.filter import escape_filter_chars
 
+from ttl_cache import TtlCache
+
 
 class LdapConnection:
     def __init__(self, server: str, bind_dn: str, password: str):
@@ -54,8 +55,9 @@ class AccountNotCompletedError(BaseException):
 
 
 class Users:
-    def __init__(self, admin_groups: List[str], tree: str, invite_tree: str, groups_tree: str):
-        self.__users: Dict[int, User] = {}
+    def __init__(self, admin_groups: List[str], tree: str, invite_tree: str, groups_tree: str, cache_size: int = 1000):
+        # tgid -> User, checked again on LDAP after an hour
+        self.cache = TtlCache("users", self.__load, 3600, cache_size)
         self.admin_groups = admin_groups
         self.tree = tree
         self.invite_tree = invite_tree
@@ -65,29 +67,20 @@ class Users:
         if not isinstance(tgid, int):
             raise IndexError(f"{tgid} is not an int")
 
-        user = None
-        # Try to get cached user
-        if tgid in self.__users:
-            user = self.__users[tgid]
-            if not user.need_update():
-                return user
+        return self.cache.get(tgid, nickname, conn)
 
+    def __load(self, tgid: int, user: Optional["User"], nickname: Optional[str], conn: LdapConnection):
         with conn as c:
             # Got it but it's stale?
             if user is not None:
                 try:
-                    if user.need_update():
-                        user.update(c, self.admin_groups, self.excluded_groups, True, nickname)
+                    user.update(c, self.admin_groups, self.excluded_groups, True, nickname)
+                    return user
                 except (AccountNotFoundError, AccountLockedError, DuplicateEntryError):
-                    del self.__users[tgid]
-                    user = None
+                    pass
 
             # Deleted stale user or didn't get it?
-            if user is None:
-                user = User.search(tgid, nickname, self.admin_groups, self.excluded_groups, c, self.tree)
-                self.__users[tgid] = user
-
-        return user
+            return User.search(tgid, nickname, self.admin_groups, self.excluded_groups, c, self.tree)
 
     def update_invite(self, invite_code: str, tgid: int, nickname: Optional[str], conn: LdapConnection):
         invite_code_escaped = escape_filter_chars(invite_code)
@@ -110,9 +103,7 @@ class Users:
             c.modify_s(dn, modlist)
 
     def delete_cache(self) -> int:
-        busted = len(self.__users)
-        self.__users = {}
-        return busted
+        return self.cache.delete_cache()
 
 
 @dataclass
@@ -131,38 +122,43 @@ class Person:
 
 class People:
     def __init__(self, admin_groups: List[str], tree: str):
-        self.__people = {}
-        self.last_update = 0
+        # Everyone, loaded again from LDAP every hour in the background while the old ones are still used
+        self.cache = TtlCache("people", self.__load, 3600, stale_while_revalidate=True, on_store=self.__stored)
         self.tree = tree
         self.admin_groups = admin_groups
-        self.lock = Lock()
+        # Changes every time people are loaded again from LDAP
+        self.__versions = itertools.count(1)
+        self.version = next(self.__versions)
 
     def get(self, uid: str, conn: LdapConnection) -> Optional[Person]:
-        self.refresh_if_necessary(conn)
-        uid = uid.lower()
-        if uid in self.__people:
-            return self.__people[uid]
-        else:
-            return None
+        return self.refresh_if_necessary(conn).get(uid.lower())
 
     def get_all(self, conn: LdapConnection):
-        self.refresh_if_necessary(conn)
-        return self.__people.values()
+        return self.refresh_if_necessary(conn).values()
 
-    def refresh_if_necessary(self, conn):
-        with self.lock:
-            if time() - self.last_update > 3600:
-                with conn as c:
-                    # print("Sync people from LDAP")
-                    self.__sync(c)
+    def refresh_if_necessary(self, conn) -> Dict[str, Person]:
+        """
+        :return: Lowercase uid -> Person
+        """
+        return self.cache.get(None, conn)
 
     def delete_cache(self) -> int:
-        busted = len(self.__people)
-        self.__people = {}
-        self.last_update = 0
-        return busted
+        people = self.cache.peek()
+        self.cache.delete_cache()
+        self.version = next(self.__versions)
+        return 0 if people is None else len(people)
+
+    def __stored(self, _key, _people):
+        # Only now get() returns the new people: bumping the version earlier, something could be rendered again
+        # with the old ones and kept under the new version
+        self.version = next(self.__versions)
 
-    def __sync(self, conn):
+    def __load(self, _key, _old, conn) -> Dict[str, Person]:
+        with conn as c:
+            # print("Sync people from LDAP")
+            return self.__sync(c)
+
+    def __sync(self, conn) -> Dict[str, Person]:
         result = conn.search_s(
             self.tree,
             ldap.SCOPE_SUBTREE,
@@ -181,6 +177,7 @@ class People:
             ),
         )
 
+        people = {}
         for dn, attributes in result:
             dob = self.schac_to_date(attributes["schacdateofbirth"][0].decode()) if "schacdateofbirth" in attributes else None
             dost = self.schac_to_date(attributes["safetytestdate"][0].decode()) if "safetytestdate" in attributes else None
@@ -196,16 +193,15 @@ class People:
                 "signedsir" in attributes and attributes["signedsir"][0].decode() == "true",
                 "nsaccountlock" in attributes,
             )
-            self.__people[person.uid.lower()] = person
+            people[person.uid.lower()] = person
 
-        self.last_update = time()
+        return people
 
     @staticmethod
     def schac_to_date(schac_date):
         return date(year=int(schac_date[:4]), month=int(schac_date[4:6]), day=int(schac_date[6:8]))
 
 
-# noinspection PyAttributeOutsideInit
 @dataclass
 class User:
     dn: str
@@ -219,15 +215,6 @@ class User:
     isadmin: bool
     nickname: Optional[str]
 
-    def __post_init__(self):
-        self.__set_update_time()
-
-    def __set_update_time(self):
-        self.last_update = time()
-
-    def need_update(self):
-        return time() - self.last_update > 3600
-
     def update(self, conn, admin_groups: List[str], excluded_groups: List[str], also_nickname: bool, nickname: Optional[str] = None):
         """
         Update user (if cached result is old)
@@ -267,7 +254,6 @@ class User:
         if also_nickname:
             if User.__get_stored_nickname(attributes) != nickname:
                 User.__update_nickname(dn, nickname, conn)
-        self.__set_update_time()
 
     @staticmethod
     def search(tgid: int, tgnick: Optional[str], admin_groups: List[str], excluded_groups: List[str], conn, tree: str):
@@ -304,7 +290,6 @@ class User:
 
         if nickname != tgnick:
             User.__update_nickname(dn, tgnick, conn)
-        # self.__set_update_time() done in __post_init___
         return User(
             dn,
             tgid,
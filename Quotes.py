@@ -1,11 +1,12 @@
 # noinspection PyUnresolvedReferences
 import json
 import random
-from datetime import datetime
 from typing import Optional
 
 import owncloud
 
+from ttl_cache import TtlCache
+
 
 class Quotes:
     def __init__(self, oc: owncloud, quotes_path: str, demotivational_path: str, games_path: str):
@@ -21,51 +22,55 @@ class Quotes:
         self.authors_weights_for_game = {}
         self.demotivational = []
 
-        self.quotes_last_download = None
-        self.demotivational_last_download = None
+        # Both are downloaded again every 48 hours, in the background
+        self.quotes_cache = TtlCache("quotes", self.__load_quotes, 60 * 60 * 48, stale_while_revalidate=True)
+        self.demotivational_cache = TtlCache("demotivational", self.__load_demotivational, 60 * 60 * 48, stale_while_revalidate=True)
 
     def _download(self):
-        if self.quotes_last_download is not None and self._timestamp_now() - self.quotes_last_download < 60 * 60 * 48:
-            return self
+        self.quotes_cache.get()
+        return self
 
-        self.quotes = json.loads(self.oc.get_file_contents(self.quotes_path).decode("utf-8"))
-        self.quotes_last_download = self._timestamp_now()
+    def __load_quotes(self, _key, _old):
+        quotes = json.loads(self.oc.get_file_contents(self.quotes_path).decode("utf-8"))
 
-        authors_count_for_game = {}
-        for quote in self.quotes:
+        # Built aside, other threads keep using the old ones in the meantime
+        authors = {}
+        authors_for_game = {}
+        authors_weights_for_game = {}
+        for quote in quotes:
             if "author" in quote:
                 parts = quote["author"].split("/")
                 for author in parts:
                     author: str
                     author_not_normalized = author.strip()
                     author = self._normalize_author(author)
-                    if author not in self.authors:
-                        self.authors[author] = []
+                    if author not in authors:
+                        authors[author] = []
                         # dicts also keep insertion order from Python 3.7, which is important later
-                        self.authors_for_game[author] = author_not_normalized
-                        self.authors_weights_for_game[author] = 0
-                    self.authors[author].append(quote)
+                        authors_for_game[author] = author_not_normalized
+                        authors_weights_for_game[author] = 0
+                    authors[author].append(quote)
                     if len(parts) == 1 and ("game" not in quote or quote["game"] != False):
-                        self.authors_weights_for_game[author] += 1
+                        authors_weights_for_game[author] += 1
 
-        loop_on_this = list(self.authors_weights_for_game.keys())
+        loop_on_this = list(authors_weights_for_game.keys())
         for author in loop_on_this:
-            if self.authors_weights_for_game[author] <= 5:
-                del self.authors_for_game[author]
-                del self.authors_weights_for_game[author]
+            if authors_weights_for_game[author] <= 5:
+                del authors_for_game[author]
+                del authors_weights_for_game[author]
 
-        print(f"There are {len(self.authors_for_game)} authors for THE GAME: {', '.join(self.authors_for_game.values())}")
+        print(f"There are {len(authors_for_game)} authors for THE GAME: {', '.join(authors_for_game.values())}")
 
-        return self
+        self.quotes, self.authors, self.authors_for_game, self.authors_weights_for_game = quotes, authors, authors_for_game, authors_weights_for_game
+        return quotes
 
     def _download_demotivational(self):
-        if self.demotivational_last_download is not None and self._timestamp_now() - self.demotivational_last_download < 60 * 60 * 48:
-            return self
+        self.demotivational_cache.get()
+        return self
 
+    def __load_demotivational(self, _key, _old):
         self.demotivational = self.oc.get_file_contents(self.demotivational_path).decode("utf-8").split("\n")
-        self.demotivational_last_download = self._timestamp_now()
-
-        return self
+        return self.demotivational
 
     def _download_game(self):
         if len(self.game) <= 0:
@@ -79,10 +84,6 @@ class Quotes:
 
         return self
 
-    @staticmethod
-    def _timestamp_now() -> float:
-        return datetime.now().timestamp()
-
     def get_random_quote(self, author: Optional[str] = None):
         self._download()
 
@@ -209,9 +210,10 @@ class Quotes:
         self.authors = {}
         self.game = {}
         self.authors_for_game = {}
+        self.authors_weights_for_game = {}
         self.demotivational = []
-        self.quotes_last_download = None
-        self.demotivational_last_download = None
+        self.quotes_cache.delete_cache()
+        self.demotivational_cache.delete_cache()
 
         return lines
 
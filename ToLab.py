@@ -1,6 +1,8 @@
 import calendar
+import itertools
 import json
 from datetime import datetime
+from threading import Lock
 
 import pytz
 from _datetime import datetime, timedelta
@@ -15,6 +17,11 @@ class ToLab:
         self.oc = oc
         self.local_tz = pytz.timezone("Europe/Rome")
         self.tolab_path = tolab_path
+        # Commands from different chats may change the list at the same time
+        self.lock = Lock()
+        # Changes every time someone is added or removed
+        self.__versions = itertools.count(1)
+        self.version = next(self.__versions)
         self.tolab_file = json.loads(oc.get_file_contents(self.tolab_path).decode("utf-8"))
         for entry in self.tolab_file:
             entry["tolab"] = self.string_to_datetime(entry["tolab"])
@@ -98,23 +105,27 @@ class ToLab:
         return entry, days
 
     def delete_entry(self, telegram_id: int):
-        self.__delete_user(telegram_id)
-        self.save(self.tolab_file)
+        with self.lock:
+            self.__delete_user(telegram_id)
+            self.save(self.tolab_file)
+            self.version = next(self.__versions)
 
     def set_entry(self, username: str, telegram_id: int, time: str, day: int) -> int:
-        self.__delete_user(telegram_id)
-        new_entry, days = self.__create_entry(username, telegram_id, time, day)
-        keep = []
-        appended = False
-        for existing_entry in self.tolab_file:
-            if not appended and new_entry["tolab"] < existing_entry["tolab"]:
+        with self.lock:
+            self.__delete_user(telegram_id)
+            new_entry, days = self.__create_entry(username, telegram_id, time, day)
+            keep = []
+            appended = False
+            for existing_entry in self.tolab_file:
+                if not appended and new_entry["tolab"] < existing_entry["tolab"]:
+                    keep.append(new_entry)
+                    appended = True
+                keep.append(existing_entry)
+            if not appended:
                 keep.append(new_entry)
-                appended = True
-            keep.append(existing_entry)
-        if not appended:
-            keep.append(new_entry)
-        self.tolab_file = keep
-        self.save(self.tolab_file)
+            self.tolab_file = keep
+            self.save(self.tolab_file)
+            self.version = next(self.__versions)
         return days
 
     def check_tolab(self, people_inlab: set):
@@ -128,25 +139,27 @@ class ToLab:
         now = datetime.now(self.local_tz)
         expires = now - timedelta(minutes=30)
 
-        changed = False
-        keep = []
-        for entry in self.tolab_file:
-            if entry["tolab"] < expires:
-                # Entry time is past by more than 30 minutes
-                changed = True
-            elif entry["tolab"] <= now and entry["username"] in people_inlab:
-                # Was in /tolab list for some time ago and is in lab right now, remove
-                # e.g. /tolab 10:00, student actually goes to lab at 10:00, this method is called at 10:03:
-                # entry <= now and student is in lab, so we can remove the entry.
-                # e.g. /tolab 16.00, student is in lab, this method is called at 10:00: entry is not removed, they may
-                # leave and come back later.
-                changed = True
-            else:
-                keep.append(entry)
+        with self.lock:
+            changed = False
+            keep = []
+            for entry in self.tolab_file:
+                if entry["tolab"] < expires:
+                    # Entry time is past by more than 30 minutes
+                    changed = True
+                elif entry["tolab"] <= now and entry["username"] in people_inlab:
+                    # Was in /tolab list for some time ago and is in lab right now, remove
+                    # e.g. /tolab 10:00, student actually goes to lab at 10:00, this method is called at 10:03:
+                    # entry <= now and student is in lab, so we can remove the entry.
+                    # e.g. /tolab 16.00, student is in lab, this method is called at 10:00: entry is not removed, they may
+                    # leave and come back later.
+                    changed = True
+                else:
+                    keep.append(entry)
 
-        if changed:
-            self.tolab_file = keep
-            self.save(keep)
+            if changed:
+                self.tolab_file = keep
+                self.save(keep)
+                self.version = next(self.__versions)
 
     def filter_tolab(self, people_inlab: set):
         """
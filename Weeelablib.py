@@ -1,89 +1,388 @@
+import bisect
 import datetime
 import glob
+import itertools
 import re
-from time import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Dict, List, Optional, Tuple
 
 # noinspection PyUnresolvedReferences
 import owncloud
 import pytz
-
-from variables import USE_GRILLO_DB, GRILLO_DB_USER, GRILLO_DB_PASSWORD, GRILLO_DB_HOST, GRILLO_DB_PORT, GRILLO_DB_NAME
+import requests
+
+from grillo_stats import GrilloListener, GrilloStats
+from log_cache import CachedMonth, LogCache
+from log_store import ColumnarLog
+from owncloud_client import OwnCloudClient
+from pg_pool import PgPool, PoolTimeoutError
+from ttl_cache import TtlCache
+from variables import USE_GRILLO_DB, GRILLO_DB_USER, GRILLO_DB_PASS, GRILLO_DB_HOST, GRILLO_DB_PORT, GRILLO_DB_NAME
+from variables import GRILLO_DB_POOL_MIN, GRILLO_DB_POOL_MAX, GRILLO_DB_STATEMENT_TIMEOUT_MS, GRILLO_DB_NOTIFY_CHANNEL
 import psycopg2
 
 
 class WeeelabLogs:
-    def __init__(self, oc: owncloud.Client, log_path: str, log_base: str, user_bot_path: str):
+    # Bytes before the changing part of log.txt that are downloaded again to check that they haven't changed
+    LOG_CHECK_BYTES = 256
+    # Attempts for each old log file, if ownCloud is unreachable or answers with a 5xx or 429
+    OLD_LOG_ATTEMPTS = 3
+    # Seconds after which this month is selected again from Grillo instead of only the changes, in case some session
+    # was added in the past or deleted
+    GRILLO_RESYNC = 600
+    # Seconds after which log.txt (or this month from Grillo) is downloaded again when needed
+    LOG_MAX_AGE = 30
+    # What can go wrong while downloading the log, if there's an older one it's used in the meantime
+    BACKEND_ERRORS = (owncloud.owncloud.HTTPResponseError, requests.exceptions.RequestException, psycopg2.Error, PoolTimeoutError)
+
+    def __init__(
+        self,
+        oc: OwnCloudClient,
+        log_path: str,
+        log_base: str,
+        user_bot_path: str,
+        cache_dir: Optional[str] = None,
+        download_workers: int = 8,
+        columnar: bool = False,
+    ):
         self.log = []
-        self.log_last_download = None
+        # self.log and where each day is, together so that nobody gets the index of a different log
+        self.log_by_day: Tuple[list, DayIndex] = ([], DayIndex())
+        # Username -> login time of sessions still open, in the same order as self.log
+        self.inlab_since: Dict[str, datetime.datetime] = {}
+        # Downloaded again when it expires, the value is self.version
+        self.log_cache = TtlCache("log", self.__load_log, self.__log_max_age)
         self.log_last_update = None
+        # Why the last download of the log failed, None if it didn't: the log is stale until the next one works
         self.error = None
-        self.oc: owncloud.Client = oc
+        self.log_failures = 0
+        # Downloads the log in the background every refresh_interval seconds, if started
+        self.refresher = None
+        self.refresh_interval = None
+        self.oc: OwnCloudClient = oc
 
         self.log_path = log_path
         self.log_base = log_base
         self.user_bot_path = user_bot_path
 
-        # Logs from past months (no lines from current month)
-        self.old_log = []
+        # Logs from past months (no lines from current month), as a list of WeeelabLine or as a ColumnarLog
+        self.columnar = columnar
+        self.old_log = ColumnarLog() if columnar else []
+        self.old_days = DayIndex()
+        # Changes every time the logs do, for anything built from them
+        self.__versions = itertools.count(1)
+        self.version = next(self.__versions)
+        # With Grillo the database does the math, and old logs aren't downloaded at all
+        self.pg_pool = PgPool(self.connect_pg, GRILLO_DB_POOL_MIN, GRILLO_DB_POOL_MAX, GRILLO_DB_STATEMENT_TIMEOUT_MS) if USE_GRILLO_DB else None
+        self.grillo = GrilloStats(self.pg_pool) if USE_GRILLO_DB else None
+        # Minutes spent in lab by each user, in the months of old_log and in log.txt
+        self.index = MinutesIndex()
+        # (year, month) of the last line in log.txt, None if there are no lines
+        self.log_month = None
+        # Old logs are also saved here, if set, and only revalidated after a restart
+        self.cache = None if cache_dir is None else LogCache(cache_dir)
+        # Old log files downloaded at the same time
+        self.download_workers = download_workers
+        self.old_logs_downloaded = 0
+        # Malformed lines found in the logs
+        self.rejected_lines = 0
+        self.old_logs_from_disk = 0
         # Logs start from april 2017, these variables represent which log file has been fetched last, so it will start
         # from the first one that actually exists (april 2017)
         self.old_logs_month = 3
         self.old_logs_year = 2017
         self.local_tz = pytz.timezone("Europe/Rome")
+        # Commands run in parallel, only one of them should download each log
+        self.log_lock = Lock()
+        self.old_log_lock = Lock()
+        # ETag of log.txt when it was last downloaded, if it hasn't changed there's no need to download it again
+        self.log_etag = None
+        self.log_refreshes = 0
+        self.log_not_modified = 0
+        # The log is append-only, except for INLAB lines that are rewritten on logout: everything before the first
+        # INLAB line never changes, so only the bytes after it are downloaded again. This is where it starts, and
+        # which line of self.log corresponds to it.
+        self.log_tail_offset = None
+        self.log_tail_index = 0
+        # Checksum of the bytes just before log_tail_offset, to detect if the file has changed in some other way
+        self.log_tail_check = None
+        # (year, month) -> username -> minutes of the lines before log_tail_index
+        self.log_head_minutes = {}
+        self.log_incremental = 0
+        # With Grillo, only the sessions that started or ended from grillo_mark on are selected again. These are the
+        # rows of self.log, by (username, start time), and the start of the month they belong to.
+        self.grillo_rows: Dict[Tuple[str, int], Tuple[int, tuple]] = {}
+        self.grillo_since = None
+        self.grillo_mark = None
+        self.grillo_last_start = None
+        self.grillo_resynced = None
+        # Tells when someone logs in or out, so there's no need to check every 30 seconds
+        self.grillo_listener = None
+        if USE_GRILLO_DB and GRILLO_DB_NOTIFY_CHANNEL:
+            self.grillo_listener = GrilloListener(self.connect_pg, GRILLO_DB_NOTIFY_CHANNEL, self.__grillo_changed)
 
     def connect_pg(self):
-        return psycopg2.connect(user=GRILLO_DB_USER, password=GRILLO_DB_PASSWORD, host=GRILLO_DB_HOST, port=GRILLO_DB_PORT, database=GRILLO_DB_NAME)
+        return psycopg2.connect(user=GRILLO_DB_USER, password=GRILLO_DB_PASS, host=GRILLO_DB_HOST, port=GRILLO_DB_PORT, database=GRILLO_DB_NAME)
 
     def get_log(self):
-        if self.log_last_download is not None and time() - self.log_last_download < 30:
-            return self
-        self.log = []
+        """
+        Download the log, if it's older than LOG_MAX_AGE. If the refresher is running, return immediately with the
+        last one instead: it's only downloaded here the first time.
+        """
+        self.log_cache.get()
+        return self
 
-        if not USE_GRILLO_DB:
-            log_file = self.oc.get_file_contents(self.log_path).decode("utf-8")
-            log_lines = log_file.splitlines()
+    def start_refresher(self, interval: float):
+        """
+        Download the log in the background every interval seconds, so that commands never wait for it
+        """
+        self.refresh_interval = interval
+        # If the refresher is late, don't wait for it
+        self.log_cache.stale_while_revalidate = True
+        self.refresher = Thread(target=self.__refresh_periodically, args=(interval,), name="log-refresher", daemon=True)
+        self.refresher.start()
+
+    def __refresh_periodically(self, interval: float):
+        while True:
+            if not self.log_cache.is_fresh():
+                try:
+                    self.log_cache.refresh()
+                except self.BACKEND_ERRORS as e:
+                    print(f"Failed downloading the log, will try again in {interval} seconds: {e}")
+                except Exception as e:
+                    # A bug must not stop the refresher for good, commands would wait for downloads again
+                    print(f"Error refreshing the log, will try again in {interval} seconds: {type(e).__name__}: {e}")
+            sleep(interval)
+
+    def __log_max_age(self) -> float:
+        if self.grillo_listener is not None and self.grillo_listener.listening:
+            # Changes arrive as soon as they happen
+            return self.GRILLO_RESYNC
+        return self.LOG_MAX_AGE if self.refresh_interval is None else self.refresh_interval
+
+    def __load_log(self, _key, _old) -> int:
+        with self.log_lock:
+            self.__refresh()
+            return self.version
+
+    def __grillo_changed(self):
+        with self.log_lock:
+            self.__refresh()
+            self.log_cache.put(None, self.version)
+
+    def __refresh(self):
+        """
+        Download the log, or keep the previous one if that fails. Call with log_lock held.
 
-            for line in log_lines:
-                if len(line.strip()) > 0:
-                    self.log.append(WeeelabLine(line))
+        :raises: one of BACKEND_ERRORS if it fails and there's no previous log
+        """
+        try:
+            self.__download_log()
+            self.error = None
+        except self.BACKEND_ERRORS as e:
+            self.log_failures += 1
+            if self.log_last_update is None:
+                raise
+            print(f"Failed downloading the log, keeping the one from {self.log_last_update}: {e}")
+            self.error = str(e)
+
+    @property
+    def stale(self) -> bool:
+        return self.error is not None
+
+    def __download_log(self):
+        # Build the new log aside, other threads keep reading the old one in the meantime
+        log = []
 
-            # store the date of the last update of the log file,
+        if not USE_GRILLO_DB:
+            self.log_refreshes += 1
+            start = 0 if self.log_tail_offset is None else max(0, self.log_tail_offset - self.LOG_CHECK_BYTES)
+            downloaded = self.oc.get_file_range(self.log_path, start, self.log_etag)
+            if downloaded is None:
+                # Same as last time, keep it
+                self.log_not_modified += 1
+                return
+            log_file, etag, last_update_utc, offset = downloaded
+
+            if offset > 0 and zlib.crc32(log_file[: self.log_tail_offset - offset]) == self.log_tail_check:
+                # Only parse the lines after the ones that cannot have changed
+                self.log_incremental += 1
+                log = self.log[: self.log_tail_index]
+                head_minutes = {month: dict(minutes) for month, minutes in self.log_head_minutes.items()}
+                parse_from = self.log_tail_offset
+            else:
+                if offset > 0:
+                    # Something has changed before the tail, e.g. a new month has started: download everything
+                    log_file, etag, last_update_utc, offset = self.oc.get_file_range(self.log_path, 0, None)
+                head_minutes = {}
+                parse_from = 0
+
+            # Only lines from the tail on can be INLAB
+            inlab = {}
+            log_minutes = self.__parse_log_tail(log, inlab, log_file, offset, parse_from, head_minutes)
+            self.log_etag = etag
+            # last_update_utc is the date of the last update of the log file,
             # the data is in UTC so we convert it to local timezone
-            last_update_utc = self.oc.file_info(self.log_path).get_last_modified()
 
         else:
-            with self.connect_pg() as conn:
-                with conn.cursor() as cur:
-                    # Calculate min timestamp in seconds for the current month
-                    now = datetime.datetime.now()
-                    start_month = datetime.datetime(now.year, now.month, 1)
-                    start_month = int(start_month.timestamp())
-
-                    cur.execute("SELECT * FROM audit WHERE startTime >= ?", (start_month,))
-                    rows = cur.fetchall()
-                    for row in rows:
-                        line = WeeelabLine(row)
-                        self.log.append(line)
-
-                    # select the max timestamp in seconds for the current month of both startTime and endTime
-                    cur.execute("SELECT MAX(endTime), MAX(startTime) FROM audit WHERE startTime >= ?", (start_month,))
-                    row = cur.fetchone()
-                    last_update_utc = datetime.datetime.fromtimestamp(max(row[0], row[1]))
-
+            self.log_refreshes += 1
+            changed = self.__grillo_log()
+            if changed is None:
+                self.log_not_modified += 1
+                return
+            log, inlab, last_update = changed
+            log_minutes = self.minutes_by_month(log)
+            last_update_utc = datetime.datetime.utcfromtimestamp(last_update) if last_update is not None else datetime.datetime.utcnow()
+
+        # If a month has ended and the old logs already have it, this replaces the same minutes: nothing is counted twice
+        for month, minutes in log_minutes.items():
+            self.index.set_month(month, minutes)
+        self.log_by_day = (log, DayIndex(log))
+        self.log = log
+        self.inlab_since = inlab
+        self.version = next(self.__versions)
+        self.log_month = log[-1].month() if len(log) > 0 else None
         self.log_last_update = pytz.utc.localize(last_update_utc, is_dst=None).astimezone(self.local_tz)
-        self.log_last_download = time()
-        return self
 
-    def delete_cache(self) -> int:
-        lines = len(self.log) + len(self.old_log)
+    def __grillo_log(self) -> Optional[Tuple[list, Dict[str, datetime.datetime], Optional[int]]]:
+        """
+        Sessions of this month from Grillo, for /log. Only the ones that changed since last time are selected, if
+        possible, and patched into a copy of self.log. People in lab are always selected again, since those who logged
+        in before the start of the month aren't in these sessions.
 
-        self.log = []
-        self.log_last_download = None
-        self.log_last_update = None
-        self.error = None
-        self.old_log = []
-        self.old_logs_month = 3
-        self.old_logs_year = 2017
+        :return: Lines, same as inlab_since and timestamp of the last login or logout, None if nothing has changed
+        """
+        since = self.month_start()
+        if self.grillo_mark is not None and since == self.grillo_since and time() - self.grillo_resynced < self.GRILLO_RESYNC:
+            rows, last_update = self.grillo.sessions(since, self.grillo_mark)
+            grillo_rows = None
+            log = None
+            last_start = self.grillo_last_start
+            for row in rows:
+                key = (row[0], row[1])
+                known = self.grillo_rows.get(key)
+                if known is not None and known[1] == row:
+                    # The last ones are selected again every time
+                    continue
+                if known is None and row[1] < last_start:
+                    # Can't go in the right place without knowing when all the other sessions started, start over
+                    break
+                if log is None:
+                    grillo_rows = dict(self.grillo_rows)
+                    log = list(self.log)
+                if known is None:
+                    grillo_rows[key] = (len(log), row)
+                    log.append(WeeelabLine(row))
+                    last_start = row[1]
+                else:
+                    grillo_rows[key] = (known[0], row)
+                    log[known[0]] = WeeelabLine(row)
+            else:
+                inlab = self.__grillo_inlab()
+                if log is None:
+                    if list(inlab.items()) == list(self.inlab_since.items()):
+                        return None
+                    # Someone who came last month has left, or a notification was missed
+                    return self.log, inlab, self.grillo_mark
+                self.log_incremental += 1
+                self.grillo_rows = grillo_rows
+                self.grillo_mark = max(self.grillo_mark, last_update)
+                self.grillo_last_start = last_start
+                return log, inlab, self.grillo_mark
+
+        rows, last_update = self.grillo.sessions(since)
+        self.grillo_rows = {(row[0], row[1]): (i, row) for i, row in enumerate(rows)}
+        self.grillo_since = since
+        self.grillo_mark = last_update if last_update is not None else since
+        self.grillo_last_start = rows[-1][1] if len(rows) > 0 else since
+        self.grillo_resynced = time()
+        return [WeeelabLine(row) for row in rows], self.__grillo_inlab(), last_update
+
+    def __grillo_inlab(self) -> Dict[str, datetime.datetime]:
+        return {username: datetime.datetime.fromtimestamp(start) for username, start in self.grillo.inlab()}
+
+    def __parse_log_tail(self, log: list, inlab: dict, log_file: bytes, offset: int, parse_from: int, head_minutes: dict) -> dict:
+        """
+        Parse lines of log.txt and remember where the part that may change starts
+
+        :param log: Lines are appended here
+        :param inlab: Users in lab are added here, same format as inlab_since
+        :param log_file: Contents of log.txt, starting from byte offset
+        :param offset: Where log_file starts in log.txt
+        :param parse_from: Byte (in log.txt) where to start parsing, must be the start of a line
+        :param head_minutes: Minutes of the lines already in log, new lines before the tail are added here
+        :return: Minutes of all the lines in log, same format as minutes_by_month
+        """
+        position = parse_from
+        tail_offset = None
+        tail_index = None
+        for raw_line in log_file[parse_from - offset :].splitlines(keepends=True):
+            line = raw_line.decode("utf-8").rstrip("\r\n")
+            line_offset = position
+            position += len(raw_line)
+            if len(line.strip()) == 0:
+                continue
+            if not raw_line.endswith(b"\n") and tail_offset is None:
+                # Still being written, maybe
+                tail_offset, tail_index = line_offset, len(log)
+            try:
+                parsed = WeeelabLine(line)
+            except ValueError:
+                self.__reject(self.log_path, None, line)
+                continue
+            if parsed.inlab:
+                if tail_offset is None:
+                    tail_offset, tail_index = line_offset, len(log)
+                inlab.pop(parsed.username, None)
+                inlab[parsed.username] = parsed.login_time()
+            if tail_offset is None:
+                self.minutes_by_month([parsed], head_minutes)
+            log.append(parsed)
+
+        if tail_offset is None:
+            tail_offset, tail_index = position, len(log)
+        self.log_tail_offset = tail_offset
+        self.log_tail_index = tail_index
+        check_from = max(offset, tail_offset - self.LOG_CHECK_BYTES)
+        self.log_tail_check = zlib.crc32(log_file[check_from - offset : tail_offset - offset])
+        self.log_head_minutes = head_minutes
+
+        log_minutes = {month: dict(minutes) for month, minutes in head_minutes.items()}
+        return self.minutes_by_month(log[tail_index:], log_minutes)
+
+    def delete_cache(self, keep_disk: bool = False) -> int:
+        """
+        Forget all the logs, they will be downloaded again when needed
+
+        :param keep_disk: Delete only the logs in memory: the old ones saved to disk will be loaded from there, if
+                          they haven't changed
+        :return: Lines deleted from memory
+        """
+        # Not in the middle of a download, which reads and writes all of this
+        with self.log_lock, self.old_log_lock:
+            lines = len(self.log) + len(self.old_log)
+            if self.cache is not None and not keep_disk:
+                self.cache.clear()
+
+            self.log = []
+            self.log_by_day = ([], DayIndex())
+            self.inlab_since = {}
+            self.log_cache.delete_cache()
+            self.log_last_update = None
+            self.log_etag = None
+            self.log_tail_offset = None
+            self.log_month = None
+            self.grillo_mark = None
+            self.error = None
+            self.old_log = ColumnarLog() if self.columnar else []
+            self.old_days = DayIndex()
+            self.index = MinutesIndex()
+            self.old_logs_month = 3
+            self.old_logs_year = 2017
+            self.version = next(self.__versions)
 
         return lines
 
@@ -96,8 +395,9 @@ class WeeelabLogs:
         else:
             prev_year = today.year
 
-        if self.old_logs_year < prev_year or self.old_logs_month < prev_month:
-            self.update_old_logs(prev_month, prev_year)
+        with self.old_log_lock:
+            if (self.old_logs_year, self.old_logs_month) < (prev_year, prev_month):
+                self.update_old_logs(prev_month, prev_year)
 
     def update_old_logs(self, max_month, max_year):
         """
@@ -111,59 +411,146 @@ class WeeelabLogs:
         month = self.old_logs_month
 
         if not USE_GRILLO_DB:
-            while year < max_year or (year == max_year and month <= max_month):
+            months = []
+            # Up to max_month included, the current month is in log.txt and its file doesn't exist yet
+            while (year, month) < (max_year, max_month):
                 month += 1
                 if month >= 13:
                     month = 1
                     year += 1
+                months.append((year, month))
+
+            # Download them in parallel, but add them in order
+            with ThreadPoolExecutor(max_workers=self.download_workers, thread_name_prefix="old-logs") as executor:
+                for (year, month), result in zip(months, executor.map(self.__download_old_month, months)):
+                    if result is None:
+                        # Start again from this month next time. The following ones are dropped even if they were
+                        # downloaded, months are only added in order and never twice.
+                        break
+                    lines, minutes, downloaded = result
+                    self.old_log.extend(lines)
+                    self.old_days.add(lines)
+                    self.version = next(self.__versions)
+                    if (year, month) != self.log_month:
+                        # log.txt is more up to date, the file may even be empty if it's still being written
+                        self.index.set_month((year, month), minutes)
+                    if downloaded:
+                        self.old_logs_downloaded += 1
+                    else:
+                        self.old_logs_from_disk += 1
+                    # If something goes horribly wrong in the next month, don't add this one again next time
+                    self.old_logs_month = month
+                    self.old_logs_year = year
+        else:
+            # Nothing to download, GrilloStats asks the database when needed
+            self.old_logs_month = max_month
+            self.old_logs_year = max_year
 
-                filename = self.log_base + "log" + str(year) + str(month).zfill(2) + ".txt"
-                print(f"Downloading {filename}")
-                try:
-                    log_file = self.oc.get_file_contents(filename).decode("utf-8")
-                    log_lines = log_file.splitlines()
+    def __download_old_month(self, year_month: tuple):
+        """
+        Get an old log file, trying again if ownCloud has some temporary problem
 
-                    for line in log_lines:
-                        if len(line.strip()) > 0:
-                            self.old_log.append(WeeelabLine(line))
-                except owncloud.owncloud.HTTPResponseError as e:
+        :param year_month: (year, month)
+        :return: Same as __get_old_month, None if it failed
+        """
+        year, month = year_month
+        filename = self.log_base + "log" + str(year) + str(month).zfill(2) + ".txt"
+        for attempt in range(1, self.OLD_LOG_ATTEMPTS + 1):
+            try:
+                return self.__get_old_month(filename)
+            except owncloud.owncloud.HTTPResponseError as e:
+                if e.status_code == 404:
                     print(f"Failed downloading {filename}, will try again next time")
-                    # Roll back to the previous month, since that's the last we have
-                    if e.status_code == 404:
+                    try:
                         self.oc.put_file_contents(filename, "".encode("utf-8"))
-        else:
-            with self.connect_pg() as conn:
-                with conn.cursor() as curr:
-                    # Get all the logs from the month next to the last one we have to max_month max_year
-                    starting_timestamp = int(datetime.datetime(year, month, 1).timestamp())
-                    ending_timestamp = int(datetime.datetime(max_year, max_month, 1).timestamp())
+                    except (owncloud.owncloud.HTTPResponseError, requests.exceptions.RequestException) as e:
+                        print(f"Failed creating {filename}: {e}")
+                    return None
+                if e.status_code < 500 and e.status_code != 429:
+                    break
+                error = e
+            except requests.exceptions.RequestException as e:
+                error = e
+            if attempt < self.OLD_LOG_ATTEMPTS:
+                print(f"Failed downloading {filename} ({error}), trying again")
+                sleep(0.5 * 2 ** (attempt - 1))
+        print(f"Failed downloading {filename}, will try again next time")
+        return None
+
+    def __get_old_month(self, filename: str):
+        """
+        Get an old log file from the disk cache if it hasn't changed, or from ownCloud
 
-                    curr.execute("SELECT * FROM audit WHERE startTime >= ? AND startTime < ?", (starting_timestamp, ending_timestamp))
-                    rows = curr.fetchall()
-                    for row in rows:
-                        line = WeeelabLine(row)
-                        self.old_log.append(line)
+        :param filename: Path on ownCloud
+        :return: Parsed lines, minutes spent in lab by each user and whether it was downloaded (not from disk)
+        """
+        cached = None if self.cache is None else self.cache.load(filename)
+        downloaded = self.oc.get_file_range(filename, 0, None if cached is None else cached.etag)
+        if downloaded is None:
+            return self.parse_lines(filename, cached.content), cached.minutes, False
+
+        print(f"Downloaded {filename}")
+        content, etag = downloaded[0], downloaded[1]
+        lines = self.parse_lines(filename, content)
+        minutes = self.minutes_by_user(lines)
+        if self.cache is not None:
+            self.cache.store(filename, CachedMonth(content, etag, minutes))
+        return lines, minutes, True
+
+    def parse_lines(self, filename: str, log_file: bytes) -> list:
+        """
+        Parse a log file, skipping malformed lines
 
-                    year = max_year
-                    month = max_month
+        :param filename: Only for error messages
+        :param log_file: Contents of the file
+        :return: List of WeeelabLine
+        """
+        lines, rejected = WeeelabLine.parse_many(log_file.decode("utf-8"))
+        for number, line in rejected:
+            self.__reject(filename, number, line)
+        return lines
 
-        self.old_logs_month = month
-        self.old_logs_year = year
+    def __reject(self, filename: str, number: Optional[int], line: str):
+        self.rejected_lines += 1
+        where = filename if number is None else f"{filename}:{number}"
+        print(f"Skipped malformed line in {where}: {line}")
 
-    def user_exists_in_logs(self, username):
-        # noinspection PyUnusedLocal
+    @staticmethod
+    def minutes_by_user(lines: list) -> Dict[str, int]:
+        minutes = {}
         line: WeeelabLine
-        for line in self.log:
-            if line.username == username:
-                return True
+        for line in lines:
+            minutes[line.username] = minutes.get(line.username, 0) + line.duration_minutes()
+        return minutes
+
+    @staticmethod
+    def minutes_by_month(lines: list, minutes: Optional[dict] = None) -> Dict[tuple, Dict[str, int]]:
+        """
+        Add up minutes spent in lab, for each user in each month
 
-        # noinspection PyUnusedLocal
+        :param lines: WeeelabLine, the month is the one of time_in
+        :param minutes: Add to this instead of starting from scratch
+        :return: (year, month) -> username -> minutes
+        """
+        minutes = {} if minutes is None else minutes
         line: WeeelabLine
-        for line in self.old_log:
-            if line.username == username:
-                return True
+        for line in lines:
+            month = minutes.setdefault(line.month(), {})
+            month[line.username] = month.get(line.username, 0) + line.duration_minutes()
+        return minutes
 
-        return False
+    @staticmethod
+    def month_start() -> int:
+        """
+        :return: Timestamp of the first second of this month, local time
+        """
+        now = datetime.datetime.now()
+        return int(datetime.datetime(now.year, now.month, 1).timestamp())
+
+    def user_exists_in_logs(self, username):
+        if self.grillo is not None:
+            return self.grillo.user_exists(username)
+        return self.index.has_user(username)
 
     def count_time_user(self, username):
         """
@@ -172,21 +559,9 @@ class WeeelabLogs:
         :param username:
         :return: Minutes this month and in total
         """
-        minutes_thismonth = 0
-
-        line: WeeelabLine
-        for line in self.log:
-            if line.username == username:
-                minutes_thismonth += line.duration_minutes()
-
-        minutes_total = minutes_thismonth
-
-        line: WeeelabLine
-        for line in self.old_log:
-            if line.username == username:
-                minutes_total += line.duration_minutes()
-
-        return minutes_thismonth, minutes_total
+        if self.grillo is not None:
+            return self.grillo.user_minutes(username, self.month_start())
+        return self.index.user_month(username, self.log_month), self.index.user_total(username)
 
     def count_time_month(self):
         """
@@ -194,16 +569,9 @@ class WeeelabLogs:
 
         :return: Dict with username as key, minutes as value
         """
-        minutes = {}
-
-        # noinspection PyUnusedLocal
-        line: WeeelabLine
-        for line in self.log:
-            if line.username not in minutes:
-                minutes[line.username] = 0
-            minutes[line.username] += line.duration_minutes()
-
-        return minutes
+        if self.grillo is not None:
+            return self.grillo.minutes_by_user(self.month_start())
+        return self.index.month(self.log_month)
 
     def count_time_all(self):
         """
@@ -211,29 +579,92 @@ class WeeelabLogs:
 
         :return: Dict with username as key, minutes as value
         """
-        # Start from that
-        minutes = self.count_time_month()
+        if self.grillo is not None:
+            return self.grillo.minutes_by_user()
+        return self.index.totals()
 
-        # noinspection PyUnusedLocal
-        line: WeeelabLine
-        for line in self.old_log:
-            if line.username not in minutes:
-                minutes[line.username] = 0
-            minutes[line.username] += line.duration_minutes()
+    def get_days(self, days: int = 1, day: Optional[datetime.date] = None) -> List[Tuple[datetime.date, list]]:
+        """
+        Lines of the last days someone was in lab, for /log. Call get_log first: this month comes from there, the
+        previous ones from the old logs (or from Grillo).
 
-        return minutes
+        :param days: How many days, counting only those with some lines
+        :param day: Only this day, if set
+        :return: (day, WeeelabLine of that day), most recent day first
+        """
+        log, log_days = self.log_by_day
+        if day is not None:
+            ranges = log_days.get(day)
+            if len(ranges) > 0:
+                return [(day, self.__slice(log, ranges))]
+            return self.__old_days(1, day, None)
+
+        result = [(this_day, self.__slice(log, ranges)) for this_day, ranges in log_days.last(days)]
+        if len(result) < days:
+            # log.txt may still have the end of last month, which is also in the old logs
+            result += self.__old_days(days - len(result), None, log_days.first())
+        return result
+
+    def __old_days(self, days: int, day: Optional[datetime.date], before: Optional[datetime.date]) -> List[Tuple[datetime.date, list]]:
+        if self.grillo is not None:
+            return self.__grillo_days(days, day)
+
+        self.get_old_logs()
+        # Lines are added to old_log before old_days, so this is never ahead of old_log
+        old_days = self.old_days
+        old_log = self.old_log
+        if day is not None:
+            ranges = old_days.get(day)
+            return [(day, self.__slice(old_log, ranges))] if len(ranges) > 0 else []
+        return [(this_day, self.__slice(old_log, ranges)) for this_day, ranges in old_days.last(days, before)]
+
+    def __grillo_days(self, days: int, day: Optional[datetime.date]) -> List[Tuple[datetime.date, list]]:
+        """
+        Days before this month, which isn't in self.log
+        """
+        if day is not None:
+            start = datetime.datetime.combine(day, datetime.time())
+            rows, _ = self.grillo.sessions(int(start.timestamp()), until=int((start + datetime.timedelta(days=1)).timestamp()))
+            return [(day, [WeeelabLine(row) for row in rows])] if len(rows) > 0 else []
+
+        result = []
+        month_end = datetime.datetime.fromtimestamp(self.month_start())
+        # Logs start from april 2017
+        while len(result) < days and month_end > datetime.datetime(2017, 4, 1):
+            month_start = (month_end - datetime.timedelta(days=1)).replace(day=1)
+            rows, _ = self.grillo.sessions(int(month_start.timestamp()), until=int(month_end.timestamp()))
+            lines = [WeeelabLine(row) for row in rows]
+            result += [(this_day, self.__slice(lines, ranges)) for this_day, ranges in DayIndex(lines).last(days - len(result))]
+            month_end = month_start
+        return result
+
+    @staticmethod
+    def __slice(lines, ranges: List[Tuple[int, int]]) -> list:
+        """
+        :param lines: A list of WeeelabLine or a ColumnarLog
+        :return: Lines in those ranges, as WeeelabLine
+        """
+        if isinstance(lines, ColumnarLog):
+            return [WeeelabLine(lines.line(i)) for start, end in ranges for i in range(start, end)]
+        return [line for start, end in ranges for line in lines[start:end]]
 
     def get_entries_inlab(self):
-        # PyCharm, you suggested that, why are you making me remove it?
-        # noinspection PyUnusedLocal
-        line: WeeelabLine
-        inlab = []
+        """
+        :return: Usernames of people in lab right now, from who came first
+        """
+        return list(self.inlab_since)
 
-        for line in self.log:
-            if line.inlab:
-                inlab.append(line.username)
+    def is_inlab(self, username: str) -> bool:
+        return username in self.inlab_since
 
-        return inlab
+    def inlab_minutes(self, username: str) -> Optional[int]:
+        """
+        :return: Minutes since username logged in, None if not in lab
+        """
+        since = self.inlab_since.get(username)
+        if since is None:
+            return None
+        return WeeelabLine.minutes_between(since, datetime.datetime.now())
 
     def store_new_user(self, tid, name: str, surname: str, username: str):
         new_users_file = self.oc.get_file_contents(self.user_bot_path)
@@ -284,33 +715,241 @@ class WeeelabLogs:
         return hh, mm
 
 
+class MinutesIndex:
+    """
+    Minutes spent in lab by each user in each month, and in total.
+    Months are added or replaced whole, so the totals are always up to date.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        # (year, month) -> username -> minutes
+        self.__months: Dict[tuple, Dict[str, int]] = {}
+        # username -> (year, month) -> minutes
+        self.__users: Dict[str, Dict[tuple, int]] = {}
+        # username -> minutes, in all months
+        self.__totals: Dict[str, int] = {}
+
+    def set_month(self, month: tuple, minutes: Dict[str, int]):
+        """
+        Add a month, replacing it if it's already there
+
+        :param month: (year, month)
+        :param minutes: Username -> minutes
+        """
+        minutes = dict(minutes)
+        with self.__lock:
+            for username, old in self.__months.get(month, {}).items():
+                self.__totals[username] -= old
+                del self.__users[username][month]
+                if len(self.__users[username]) == 0:
+                    del self.__users[username]
+                    del self.__totals[username]
+            for username, new in minutes.items():
+                self.__totals[username] = self.__totals.get(username, 0) + new
+                self.__users.setdefault(username, {})[month] = new
+            self.__months[month] = minutes
+
+    def has_user(self, username: str) -> bool:
+        with self.__lock:
+            return username in self.__users
+
+    def user_month(self, username: str, month: Optional[tuple]) -> int:
+        with self.__lock:
+            return self.__users.get(username, {}).get(month, 0)
+
+    def user_total(self, username: str) -> int:
+        with self.__lock:
+            return self.__totals.get(username, 0)
+
+    def month(self, month: Optional[tuple]) -> Dict[str, int]:
+        with self.__lock:
+            return dict(self.__months.get(month, {}))
+
+    def totals(self) -> Dict[str, int]:
+        with self.__lock:
+            return dict(self.__totals)
+
+
+class DayIndex:
+    """
+    Where the lines of each day are, in a list of lines sorted by login time (or almost sorted: a day may appear more
+    than once). Lines can only be added at the end.
+    """
+
+    def __init__(self, lines: Optional[list] = None):
+        self.__lock = Lock()
+        # Sorted, each day only once
+        self.__days: List[datetime.date] = []
+        # Day -> (first line, last line + 1), more than one if the day isn't contiguous
+        self.__ranges: Dict[datetime.date, List[Tuple[int, int]]] = {}
+        self.__size = 0
+        if lines is not None:
+            self.add(lines)
+
+    def add(self, lines: list):
+        """
+        Add lines at the end
+
+        :param lines: WeeelabLine
+        """
+        with self.__lock:
+            start = self.__size
+            run_day = None
+            line: WeeelabLine
+            for i, line in enumerate(lines, self.__size):
+                # Comparing strings is enough to find where a day ends, dates are built only once for each day
+                if run_day != line.time_in[:10]:
+                    if run_day is not None:
+                        self.__add_range(run_day, start, i)
+                    run_day, start = line.time_in[:10], i
+            if run_day is not None:
+                self.__add_range(run_day, start, self.__size + len(lines))
+            self.__size += len(lines)
+
+    def __add_range(self, day: str, start: int, end: int):
+        date = datetime.date(int(day[6:10]), int(day[3:5]), int(day[0:2]))
+        ranges = self.__ranges.get(date)
+        if ranges is None:
+            self.__ranges[date] = [(start, end)]
+            if len(self.__days) == 0 or self.__days[-1] < date:
+                self.__days.append(date)
+            else:
+                bisect.insort(self.__days, date)
+        elif ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    def get(self, day: datetime.date) -> List[Tuple[int, int]]:
+        """
+        :return: (first line, last line + 1) of that day, empty if there are none
+        """
+        with self.__lock:
+            return list(self.__ranges.get(day, []))
+
+    def last(self, n: int, before: Optional[datetime.date] = None) -> List[Tuple[datetime.date, List[Tuple[int, int]]]]:
+        """
+        Last n days that have some lines
+
+        :param n: How many days
+        :param before: Only days before this one, None for no limit
+        :return: (day, same as get), most recent first
+        """
+        with self.__lock:
+            end = len(self.__days) if before is None else bisect.bisect_left(self.__days, before)
+            return [(day, list(self.__ranges[day])) for day in reversed(self.__days[max(0, end - n) : end])]
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__days)
+
+    def first(self) -> Optional[datetime.date]:
+        with self.__lock:
+            return self.__days[0] if len(self.__days) > 0 else None
+
+
 class WeeelabLine:
     regex = re.compile(r"\[([^\]]+)\]\s*\[([^\]]+)\]\s*\[([^\]]+)\]\s*<([^>]+)>\s*[:{2}]*\s*(.*)")
+    # Lots of lines have the same username and duration, they are parsed and stored only once
+    usernames: Dict[str, str] = {}
+    durations: Dict[str, int] = {"INLAB": 0}
+    __slots__ = ("time_in", "time_out", "duration", "username", "text", "inlab", "minutes")
 
     def __init__(self, line: str | tuple):
+        """
+        :param line: A line from the log, or a row from the Grillo audit table
+        :raises ValueError: if the line is malformed
+        """
         if isinstance(line, tuple):
-            # TODO line =
-            raise NotImplementedError("Not implemented yet")
+            self.__set(*self.__from_row(*line))
+            return
         res = self.regex.match(line)
-        self.time_in = res.group(1)
-        self.time_out = res.group(2)
-        self.duration = res.group(3)
-        self.username = res.group(4)
-        self.text = res.group(5)
+        if res is None:
+            raise ValueError(f"Malformed log line: {line}")
+        self.__set(*res.groups())
+
+    @classmethod
+    def parse_many(cls, log_file: str) -> Tuple[List["WeeelabLine"], List[Tuple[int, str]]]:
+        """
+        Parse a whole log file. Same as calling the constructor on each line that isn't empty, but faster and without
+        stopping at the first malformed line.
 
-        if self.duration == "INLAB":
+        :param log_file: Contents of the file
+        :return: Parsed lines, and malformed lines with their line number (starting from 1)
+        """
+        lines = []
+        rejected = []
+        new = cls.__new__
+        split = log_file.splitlines()
+        for number, (line, res) in enumerate(zip(split, map(cls.regex.match, split)), 1):
+            if res is None:
+                if len(line.strip()) > 0:
+                    rejected.append((number, line))
+                continue
+            parsed = new(cls)
+            try:
+                parsed.__set(*res.groups())
+            except (ValueError, IndexError):
+                rejected.append((number, line))
+                continue
+            lines.append(parsed)
+        return lines, rejected
+
+    @staticmethod
+    def __from_row(username: str, start: int, end: Optional[int], summary: Optional[str]) -> tuple:
+        """
+        Turn a row of the Grillo audit table (see grillo_stats.AUDIT_COLUMNS) into the fields of a log line
+        """
+        time_in = datetime.datetime.fromtimestamp(start).strftime("%d/%m/%Y %H:%M")
+        if end is None:
+            return time_in, "INLAB", "INLAB", username, summary or ""
+        minutes = (end - start) // 60
+        time_out = datetime.datetime.fromtimestamp(end).strftime("%d/%m/%Y %H:%M")
+        return time_in, time_out, f"{minutes // 60:02d}:{minutes % 60:02d}", username, summary or ""
+
+    def __set(self, time_in: str, time_out: str, duration: str, username: str, text: str):
+        self.time_in = time_in
+        self.duration = duration
+        self.username = self.usernames.setdefault(username, username)
+        self.text = text
+
+        minutes = self.durations.get(duration)
+        if minutes is None:
+            parts = duration.split(":")
+            minutes = self.durations[duration] = int(parts[0]) * 60 + int(parts[1])
+        self.minutes = minutes
+
+        if duration == "INLAB":
             self.time_out = None
             self.inlab = True
         else:
+            self.time_out = time_out
             self.inlab = False
 
     def day(self):
         return self.time_in.split(" ")[0]
 
-    def duration_minutes(self):
-        # TODO: calculate partials (time right now - time in)
-        if self.inlab:
-            return 0
+    def month(self) -> tuple:
+        """
+        :return: (year, month) of time_in
+        """
+        day, month, year = self.day().split("/")
+        return int(year), int(month)
 
-        parts = self.duration.split(":")
-        return int(parts[0]) * 60 + int(parts[1])
+    def login_time(self) -> datetime.datetime:
+        return datetime.datetime.strptime(self.time_in, "%d/%m/%Y %H:%M")
+
+    def duration_minutes(self, now: Optional[datetime.datetime] = None) -> int:
+        """
+        :param now: If the session is still open, count minutes from login to this time. Otherwise it's 0, as in the
+                    statistics.
+        """
+        if self.inlab and now is not None:
+            return self.minutes_between(self.login_time(), now)
+        return self.minutes
+
+    @staticmethod
+    def minutes_between(time_in: datetime.datetime, time_out: datetime.datetime) -> int:
+        # Logs have no seconds, so neither does this
+        return max(0, int((time_out.replace(second=0, microsecond=0) - time_in).total_seconds()) // 60)
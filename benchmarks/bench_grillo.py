@@ -0,0 +1,145 @@
+"""
+Load synthetic sessions into an audit table on a Postgres server, then compare GrilloStats (the database adds up the
+minutes) with downloading every row and adding them up in Python, as WeeelabLogs used to do.
+
+    python benchmarks/bench_grillo.py --host 127.0.0.1 --port 5432 --user postgres --dbname postgres --years 10
+
+Everything happens in the bench_grillo schema, which is dropped at the end.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+from datetime import date, datetime
+from time import perf_counter
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for variable in ("MAX_WORK_DONE", "WEEE_CHAT_ID", "WEEE_FOLD_ID", "WEEE_CHAT2_ID", "GRILLO_DB_PORT"):
+    os.environ.setdefault(variable, "0")
+
+from synthetic_logs import DATE_FORMAT, months, month_lines, usernames
+
+from grillo_stats import AUDIT_COLUMNS, GrilloStats
+from pg_pool import PgPool
+from Weeelablib import WeeelabLine, WeeelabLogs
+
+SCHEMA = "bench_grillo"
+
+
+def rows(first_year: int, users: int, lines_per_month: int) -> list:
+    """
+    (userId, startTime, endTime, summary) for every month from first_year to today, people in lab only this month
+    """
+    today = date.today()
+    result = []
+    for year, month in months(first_year, 1, today.year, today.month):
+        inlab = 5 if (year, month) == (today.year, today.month) else 0
+        for line in WeeelabLine.parse_many("\n".join(month_lines(year, month, usernames(users), lines_per_month, inlab)))[0]:
+            start = int(datetime.strptime(line.time_in, DATE_FORMAT).timestamp())
+            end = None if line.inlab else int(datetime.strptime(line.time_out, DATE_FORMAT).timestamp())
+            result.append((line.username, start, end, line.text))
+    return result
+
+
+def timed(fn, repeat: int) -> float:
+    """
+    :return: Median time in milliseconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        times.append((perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+class FetchEverything:
+    """
+    Every row to Python, then the same loops as WeeelabLogs without Grillo
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+
+    def __lines(self) -> list:
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT {AUDIT_COLUMNS} FROM audit ORDER BY startTime")
+                return [WeeelabLine(row) for row in cur.fetchall()]
+        finally:
+            conn.close()
+
+    def minutes_by_user(self, since=None) -> dict:
+        lines = self.__lines()
+        month = datetime.fromtimestamp(since).strftime("/%m/%Y") if since is not None else None
+        return WeeelabLogs.minutes_by_user([line for line in lines if month is None or line.day().endswith(month)])
+
+    def user_minutes(self, username: str, since: int) -> tuple:
+        everything = self.minutes_by_user()
+        return self.minutes_by_user(since).get(username, 0), everything.get(username, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.environ.get("GRILLO_DB_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("GRILLO_DB_PORT") or 5432))
+    parser.add_argument("--user", default=os.environ.get("GRILLO_DB_USER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("GRILLO_DB_PASS"))
+    parser.add_argument("--dbname", default=os.environ.get("GRILLO_DB_NAME", "postgres"))
+    parser.add_argument("--users", type=int, default=120, help="Different usernames")
+    parser.add_argument("--years", type=int, default=10, help="Years of sessions")
+    parser.add_argument("--lines-per-month", type=int, default=600, help="Sessions in each month")
+    parser.add_argument("--repeat", type=int, default=5, help="Times each query is run")
+    args = parser.parse_args()
+
+    def connect():
+        conn = psycopg2.connect(host=args.host, port=args.port, user=args.user, password=args.password, dbname=args.dbname)
+        with conn.cursor() as cur:
+            cur.execute(f"SET search_path TO {SCHEMA}")
+        return conn
+
+    data = rows(date.today().year - args.years + 1, args.users, args.lines_per_month)
+    conn = psycopg2.connect(host=args.host, port=args.port, user=args.user, password=args.password, dbname=args.dbname)
+    with conn, conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SCHEMA}")
+        cur.execute(f"CREATE TABLE {SCHEMA}.audit (id SERIAL PRIMARY KEY, userId VARCHAR NOT NULL, startTime INTEGER NOT NULL, endTime INTEGER, summary TEXT)")
+        cur.execute(f"CREATE INDEX ON {SCHEMA}.audit (startTime)")
+        cur.execute(f"CREATE INDEX ON {SCHEMA}.audit (userId)")
+        execute_values(cur, f"INSERT INTO {SCHEMA}.audit ({AUDIT_COLUMNS}) VALUES %s", data)
+        cur.execute(f"ANALYZE {SCHEMA}.audit")
+
+    pool = PgPool(connect)
+    try:
+        grillo = GrilloStats(pool)
+        everything = FetchEverything(connect)
+        since = WeeelabLogs.month_start()
+        somebody = usernames(args.users)[7]
+
+        assert grillo.minutes_by_user() == everything.minutes_by_user()
+        assert grillo.minutes_by_user(since) == everything.minutes_by_user(since)
+        assert grillo.user_minutes(somebody, since) == everything.user_minutes(somebody, since)
+
+        print(f"{len(data)} sessions, {args.years} years, {args.users} users")
+        print(f"{'':>18} {'fetch all':>10} {'grillo':>10}")
+        for name, query in {
+            "/top all (ms)": lambda engine: engine.minutes_by_user(),
+            "/top (ms)": lambda engine: engine.minutes_by_user(since),
+            "/stat user (ms)": lambda engine: engine.user_minutes(somebody, since),
+        }.items():
+            print(f"{name:>18} {timed(lambda: query(everything), args.repeat):>10.1f} {timed(lambda: query(grillo), args.repeat):>10.1f}")
+        print(f"{pool.get_stats().connections_opened} connections opened by the pool")
+    finally:
+        pool.close()
+        with conn, conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Benchmark WeeelabLogs on a synthetic archive: parsing throughput, memory and the latency of each query.
+
+    python benchmarks/bench_logs.py --users 80 --years 6 --lines-per-month 400
+    python benchmarks/bench_logs.py --save baselines/weeelablogs.json
+    python benchmarks/bench_logs.py --compare baselines/weeelablogs.json
+
+--compare fails (exit status 1) if any timing is more than --tolerance slower than the baseline.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tracemalloc
+from datetime import date
+from time import perf_counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for variable in ("MAX_WORK_DONE", "WEEE_CHAT_ID", "WEEE_FOLD_ID", "WEEE_CHAT2_ID", "GRILLO_DB_PORT"):
+    os.environ.setdefault(variable, "0")
+
+from fake_backends import FakeOwnCloud
+from synthetic_logs import archive, month_lines, usernames
+
+from Weeelablib import WeeelabLine, WeeelabLogs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def build_files(args) -> dict:
+    today = date.today()
+    last_year, last_month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+    first_year = last_year - args.years
+    files = {
+        f"/weeelab/{name}": content.encode()
+        for name, content in archive(first_year, last_month, last_year, last_month, args.users, args.lines_per_month).items()
+    }
+    log = month_lines(today.year, today.month, usernames(args.users), args.lines_per_month, inlab=min(5, args.users))
+    files["/weeelab/log.txt"] = ("\n".join(log) + "\n").encode()
+    return files, first_year, last_month
+
+
+def timed(fn, repeat: int) -> dict:
+    """
+    Call fn repeat times
+
+    :return: median and minimum time in milliseconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        times.append((perf_counter() - start) * 1000)
+    return {"median_ms": statistics.median(times), "min_ms": min(times)}
+
+
+def run(args) -> dict:
+    files, first_year, first_month = build_files(args)
+    lines = [line for content in files.values() for line in content.decode().splitlines() if len(line.strip()) > 0]
+    everything = "\n".join(lines)
+
+    # Parsing alone
+    start = perf_counter()
+    parsed, _ = WeeelabLine.parse_many(everything)
+    parse_seconds = perf_counter() - start
+
+    # Memory for each parsed line, strings included
+    del parsed
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    parsed, _ = WeeelabLine.parse_many(everything)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del parsed
+
+    # The real thing: download and parse everything through WeeelabLogs
+    oc = FakeOwnCloud(files)
+    logs = WeeelabLogs(oc, "/weeelab/log.txt", "/weeelab/", "/weeelab/users_bot.txt")
+    logs.old_logs_year = first_year
+    logs.old_logs_month = first_month - 1
+    start = perf_counter()
+    logs.get_log()
+    logs.get_old_logs()
+    load_seconds = perf_counter() - start
+
+    # Someone logs in: only the end of log.txt should be downloaded and parsed again
+    log = files["/weeelab/log.txt"]
+    oc.files["/weeelab/log.txt"] = log + log.splitlines(keepends=True)[-1]
+    logs.log_cache.delete_cache()
+    sent = oc.bytes_sent
+    start = perf_counter()
+    logs.get_log()
+    refresh_seconds = perf_counter() - start
+    refresh_bytes = oc.bytes_sent - sent
+
+    names = usernames(args.users)
+    somebody = names[len(names) // 2]
+    queries = {
+        "count_time_user": lambda: logs.count_time_user(somebody),
+        "count_time_month": logs.count_time_month,
+        "count_time_all": logs.count_time_all,
+        "get_entries_inlab": logs.get_entries_inlab,
+        "user_exists_in_logs": lambda: logs.user_exists_in_logs(somebody),
+        "user_exists_in_logs_missing": lambda: logs.user_exists_in_logs("nobody.atall"),
+    }
+
+    return {
+        "config": {"users": args.users, "years": args.years, "lines_per_month": args.lines_per_month},
+        "python": platform.python_version(),
+        "lines": len(lines),
+        "lines_in_memory": len(logs.log) + len(logs.old_log),
+        "parse_lines_per_second": len(lines) / parse_seconds,
+        "bytes_per_line": (after - before) / len(lines),
+        "load_ms": load_seconds * 1000,
+        "refresh_ms": refresh_seconds * 1000,
+        "refresh_bytes": refresh_bytes,
+        "queries": {name: timed(fn, args.repeat) for name, fn in queries.items()},
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float, min_ms: float) -> list:
+    """
+    :return: Descriptions of regressions, empty if there are none
+    """
+    regressions = []
+    if result["config"] != baseline["config"]:
+        print(f"Warning: baseline was made with {baseline['config']}, this run with {result['config']}")
+    if result["parse_lines_per_second"] < baseline["parse_lines_per_second"] / (1 + tolerance):
+        regressions.append(f"parsing: {result['parse_lines_per_second']:.0f} lines/s, was {baseline['parse_lines_per_second']:.0f}")
+    if result["bytes_per_line"] > baseline["bytes_per_line"] * (1 + tolerance):
+        regressions.append(f"memory: {result['bytes_per_line']:.0f} bytes/line, was {baseline['bytes_per_line']:.0f}")
+    for name, timing in result["queries"].items():
+        if name not in baseline["queries"]:
+            continue
+        old = baseline["queries"][name]["median_ms"]
+        # Differences of a few microseconds are just noise
+        if timing["median_ms"] > old * (1 + tolerance) and timing["median_ms"] - old > min_ms:
+            regressions.append(f"{name}: {timing['median_ms']:.3f} ms, was {old:.3f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=80, help="Different usernames in the logs")
+    parser.add_argument("--years", type=int, default=6, help="Years of old logs")
+    parser.add_argument("--lines-per-month", type=int, default=400, help="Lines in each month")
+    parser.add_argument("--repeat", type=int, default=20, help="Times each query is run")
+    parser.add_argument("--save", help="Write results to this JSON file, relative to the benchmarks directory")
+    parser.add_argument("--compare", help="Compare with this JSON baseline, relative to the benchmarks directory")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Slowdown that counts as a regression, 0.25 = 25%%")
+    parser.add_argument("--min-ms", type=float, default=0.05, help="Ignore query slowdowns smaller than this")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(
+        f"{result['lines']} lines: {result['parse_lines_per_second']:.0f} lines/s parsing, {result['bytes_per_line']:.0f} bytes/line, "
+        f"{result['load_ms']:.0f} ms to load everything, {result['refresh_ms']:.1f} ms and {result['refresh_bytes']} bytes to refresh log.txt"
+    )
+    for name, timing in result["queries"].items():
+        print(f"{name:>28}: {timing['median_ms']:.3f} ms (min {timing['min_ms']:.3f} ms)")
+
+    if args.save:
+        with open(os.path.join(HERE, args.save), "w") as file:
+            json.dump(result, file, indent=1)
+            file.write("\n")
+    if args.compare:
+        with open(os.path.join(HERE, args.compare)) as file:
+            regressions = compare(result, json.load(file), args.tolerance, args.min_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Cold start of the old logs (no disk cache) from a WebDAV server with some latency, downloading one file at a time and
+then in parallel.
+
+    python benchmarks/bench_old_logs.py --latency-ms 50 --workers 1,4,8,16
+    python benchmarks/bench_old_logs.py --error-rate 0.05
+
+Every run must end up with the same lines, in the same order, as the first one.
+"""
+
+import argparse
+import os
+import sys
+from datetime import date
+from time import perf_counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for variable in ("MAX_WORK_DONE", "WEEE_CHAT_ID", "WEEE_FOLD_ID", "WEEE_CHAT2_ID", "GRILLO_DB_PORT"):
+    os.environ.setdefault(variable, "0")
+
+from fake_webdav import FakeWebDav
+from synthetic_logs import archive
+
+from Weeelablib import WeeelabLogs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=80, help="Different usernames in the logs")
+    parser.add_argument("--lines-per-month", type=int, default=400, help="Lines in each month")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Delay of each WebDAV request")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered with 503")
+    parser.add_argument("--workers", default="1,4,8,16", help="Comma separated, 1 is one file at a time")
+    args = parser.parse_args()
+
+    today = date.today()
+    last_year, last_month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+    files = {f"/weeelab/{name}": content.encode() for name, content in archive(2017, 4, last_year, last_month, args.users, args.lines_per_month).items()}
+    files["/weeelab/log.txt"] = b""
+
+    expected = None
+    sequential = None
+    for workers in (int(w) for w in args.workers.split(",")):
+        server = FakeWebDav(files, args.latency_ms, args.error_rate).start()
+        logs = WeeelabLogs(server.client(), "/weeelab/log.txt", "/weeelab/", "/weeelab/users_bot.txt", download_workers=workers)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            start = perf_counter()
+            logs.get_old_logs()
+            seconds = perf_counter() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        server.stop()
+
+        lines = [(line.time_in, line.username) for line in logs.old_log]
+        if expected is None:
+            expected = lines
+        sequential = sequential or seconds
+        same = "same lines" if lines == expected else "DIFFERENT LINES"
+        print(
+            f"{workers:>3} workers: {seconds * 1000:6.0f} ms, {sequential / seconds:4.1f}x, {logs.old_logs_downloaded} files, "
+            f"{server.requests} requests, {server.errors} errors, {same}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Compare command latency of the threaded and asyncio runtimes, against a local fake Bot API server.
+Commands are simulated: each one waits for a "backend" (as LDAP or ownCloud would) and replies once.
+
+    python benchmarks/bench_runtime.py --users 100 --commands 2000 --backend-ms 50 --workers 8
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+from threading import Thread
+from time import monotonic, sleep
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# variables.py wants these, their value does not matter here
+for variable in ("MAX_WORK_DONE", "WEEE_CHAT_ID", "WEEE_FOLD_ID", "WEEE_CHAT2_ID", "GRILLO_DB_PORT"):
+    os.environ.setdefault(variable, "0")
+
+from dispatcher import AsyncDispatcher, Dispatcher
+from fake_bot_api import FakeBotApi
+from weeelab_bot import AsyncBotHandler, BlockingBotHandler, BotHandler, update_chat_id
+
+
+def simulated_command(bot, backend_ms: float, update: dict):
+    sleep(backend_ms / 1000)
+    bot.send_message(update["message"]["chat"]["id"], str(update["update_id"]))
+
+
+def run_threads(api: FakeBotApi, workers: int, backend_ms: float):
+    bot = BotHandler("bench", api.url)
+    dispatcher = Dispatcher(workers)
+    for update in bot.get_new_updates():
+        dispatcher.submit(update_chat_id(update), simulated_command, bot, backend_ms, update)
+
+
+async def run_asyncio(api: FakeBotApi, workers: int, backend_ms: float):
+    async with AsyncBotHandler("bench", api.url) as bot:
+        loop = asyncio.get_running_loop()
+        dispatcher = AsyncDispatcher(workers, loop)
+        blocking_bot = BlockingBotHandler(bot, loop)
+        async for update in bot.get_new_updates():
+            dispatcher.submit(update_chat_id(update), simulated_command, blocking_bot, backend_ms, update)
+
+
+def measure(runtime: str, args) -> dict:
+    # Servers are never stopped, the bot keeps polling them until the benchmark exits
+    api = FakeBotApi().start()
+    if runtime == "threads":
+        Thread(target=run_threads, args=(api, args.workers, args.backend_ms), daemon=True).start()
+    else:
+        Thread(target=lambda: asyncio.run(run_asyncio(api, args.workers, args.backend_ms)), daemon=True).start()
+
+    start = monotonic()
+    for i in range(args.commands):
+        api.push_message(i % args.users + 1, "/inlab")
+        if args.rate > 0:
+            sleep(1 / args.rate)
+    completed = api.wait_sent(args.commands, args.timeout)
+    elapsed = monotonic() - start
+
+    latencies = [(when - api.pushed_at[int(params["text"])]) * 1000 for when, method, params in api.sent if method == "sendMessage"]
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [float("nan")] * 99
+    return {
+        "runtime": runtime,
+        "replies": len(latencies),
+        "completed": completed,
+        "commands/s": len(latencies) / elapsed,
+        "p50 ms": percentiles[49],
+        "p99 ms": percentiles[98],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="Different chats sending commands")
+    parser.add_argument("--commands", type=int, default=1000, help="Commands sent in total")
+    parser.add_argument("--rate", type=float, default=0, help="Commands per second, 0 to send them all at once")
+    parser.add_argument("--backend-ms", type=float, default=20, help="How long each command waits for its backend")
+    parser.add_argument("--workers", type=int, default=8, help="BOT_WORKERS")
+    parser.add_argument("--timeout", type=float, default=300, help="Give up waiting for replies after this many seconds")
+    args = parser.parse_args()
+
+    for runtime in ("threads", "asyncio"):
+        result = measure(runtime, args)
+        print(
+            f"{result['runtime']:>8}: {result['replies']} replies{'' if result['completed'] else ' (TIMED OUT)'}, "
+            f"{result['commands/s']:.1f} commands/s, p50 {result['p50 ms']:.1f} ms, p99 {result['p99 ms']:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
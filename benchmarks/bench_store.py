@@ -0,0 +1,114 @@
+"""
+Compare the two ways of keeping old logs in memory: a list of WeeelabLine (LOG_STORE=objects) and a ColumnarLog
+(LOG_STORE=columnar). Memory for each line, and time to compute the statistics on all of them.
+
+    python benchmarks/bench_store.py --users 120 --years 10 --lines-per-month 600
+"""
+
+import argparse
+import gc
+import os
+import statistics
+import sys
+import tracemalloc
+from datetime import date, datetime
+from time import perf_counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for variable in ("MAX_WORK_DONE", "WEEE_CHAT_ID", "WEEE_FOLD_ID", "WEEE_CHAT2_ID", "GRILLO_DB_PORT"):
+    os.environ.setdefault(variable, "0")
+
+from synthetic_logs import archive
+
+from log_store import ColumnarLog
+from Weeelablib import WeeelabLine
+
+
+def timed(fn, repeat: int) -> float:
+    """
+    :return: Median time in milliseconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        times.append((perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def measure(build) -> tuple:
+    """
+    :return: What build returned, bytes allocated while building it
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    built = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return built, after - before
+
+
+# What the list of objects has to do for each statistic
+
+
+def objects_minutes(lines: list, start=None, end=None) -> dict:
+    minutes = {}
+    for line in lines:
+        if start is not None or end is not None:
+            time_in = datetime.strptime(line.time_in, "%d/%m/%Y %H:%M")
+            if (start is not None and time_in < start) or (end is not None and time_in >= end):
+                continue
+        minutes[line.username] = minutes.get(line.username, 0) + line.duration_minutes()
+    return minutes
+
+
+def objects_top(lines: list, n: int) -> list:
+    return sorted(objects_minutes(lines).items(), key=lambda item: item[1], reverse=True)[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=120, help="Different usernames in the logs")
+    parser.add_argument("--years", type=int, default=10, help="Years of old logs")
+    parser.add_argument("--lines-per-month", type=int, default=600, help="Lines in each month")
+    parser.add_argument("--repeat", type=int, default=10, help="Times each statistic is computed")
+    args = parser.parse_args()
+
+    last_year = date.today().year - 1
+    files = archive(last_year - args.years + 1, 1, last_year, 12, args.users, args.lines_per_month)
+    text = [line for content in files.values() for line in content.splitlines() if len(line.strip()) > 0]
+
+    objects, objects_bytes = measure(lambda: [WeeelabLine(line) for line in text])
+
+    def build_columnar():
+        store = ColumnarLog()
+        # One month at a time, as WeeelabLogs does
+        for content in files.values():
+            store.extend(WeeelabLine(line) for line in content.splitlines() if len(line.strip()) > 0)
+        store.minutes_by_user()
+        return store
+
+    columnar, columnar_bytes = measure(build_columnar)
+
+    start, end = datetime(last_year - 2, 3, 1), datetime(last_year - 1, 9, 1)
+    assert objects_minutes(objects) == columnar.minutes_by_user()
+    assert objects_minutes(objects, start, end) == columnar.minutes_by_user(start, end)
+    assert [minutes for _, minutes in objects_top(objects, 10)] == [minutes for _, minutes in columnar.top(10)]
+    assert all(columnar.line(i) == text[i] for i in range(0, len(text), max(1, len(text) // 1000)))
+
+    print(f"{len(text)} lines, {args.years} years, {args.users} users")
+    print(f"{'':>24} {'objects':>10} {'columnar':>10}")
+    print(f"{'bytes per line':>24} {objects_bytes / len(text):>10.0f} {columnar_bytes / len(text):>10.0f}")
+    benchmarks = {
+        "minutes by user (ms)": (lambda: objects_minutes(objects), lambda: columnar.minutes_by_user()),
+        "minutes of one user (ms)": (lambda: objects_minutes(objects).get("user7.surname7"), lambda: columnar.user_minutes("user7.surname7")),
+        "top 10 (ms)": (lambda: objects_top(objects, 10), lambda: columnar.top(10)),
+        "date range (ms)": (lambda: objects_minutes(objects, start, end), lambda: columnar.minutes_by_user(start, end)),
+    }
+    for name, (with_objects, with_columnar) in benchmarks.items():
+        print(f"{name:>24} {timed(with_objects, args.repeat):>10.2f} {timed(with_columnar, args.repeat):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
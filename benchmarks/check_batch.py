@@ -0,0 +1,101 @@
+"""
+Check that every update in a single getUpdates response is handled: N commands are queued before the bot starts,
+so the first long poll returns all of them, and each one must get its reply.
+
+    python benchmarks/check_batch.py --updates 100
+"""
+
+import argparse
+import os
+import sys
+from threading import Thread
+from time import monotonic
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ADMIN_GROUP = "cn=Admins,ou=Groups,dc=example,dc=test"
+PEOPLE_TREE = "ou=People,dc=example,dc=test"
+for variable, value in {
+    "MAX_WORK_DONE": "2000",
+    "WEEE_CHAT_ID": "-1",
+    "WEEE_FOLD_ID": "-2",
+    "WEEE_CHAT2_ID": "-3",
+    "GRILLO_DB_PORT": "0",
+}.items():
+    os.environ.setdefault(variable, value)
+
+from fake_backends import FakeLdapConnection, FakeOwnCloud, FakeTarallo
+from fake_bot_api import FakeBotApi
+
+from dispatcher import Dispatcher
+from LdapWrapper import People, Users
+from outbox import Outbox
+from ToLab import ToLab
+from weeelab_bot import BotHandler, CommandHandler, serve_updates
+from Weeelablib import WeeelabLogs
+
+# Every command goes to its own chat, with IDs starting from here
+FIRST_CHAT = 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=100, help="Updates in the batch, Telegram sends at most 100")
+    parser.add_argument("--users", type=int, default=20, help="People in LDAP, they send the commands in turn")
+    parser.add_argument("--workers", type=int, default=8, help="BOT_WORKERS")
+    parser.add_argument("--timeout", type=float, default=30, help="Stop waiting for replies after this many seconds")
+    args = parser.parse_args()
+
+    api = FakeBotApi()
+    oc = FakeOwnCloud({"/weeelab/log.txt": b"", "/weeelab/tolab.json": b"[]"})
+    conn = FakeLdapConnection(args.users, 1, ADMIN_GROUP, PEOPLE_TREE)
+    # Queued before the bot asks for anything, so they all come in the first response
+    pushed = {}
+    for i in range(args.updates):
+        chat_id = FIRST_CHAT + i
+        api.push_message(chat_id, "/id", user_id=i % args.users + 1)
+        pushed[chat_id] = f"user{i % args.users}.surname{i % args.users}"
+    api.start()
+
+    bot = BotHandler("checkbatch", api.url, pool_size=args.workers + 1)
+    outbox = Outbox(bot, global_rate=1e9, chat_rate=1e9, group_rate=1e9, burst=1e9)
+    dispatcher = Dispatcher(args.workers)
+    handler = CommandHandler(
+        outbox,
+        FakeTarallo(),
+        WeeelabLogs(oc, "/weeelab/log.txt", "/weeelab/", "/weeelab/users_bot.txt"),
+        ToLab(oc, "/weeelab/tolab.json"),
+        Users([ADMIN_GROUP], PEOPLE_TREE, "ou=Invites,dc=example,dc=test", "ou=Groups,dc=example,dc=test"),
+        People([ADMIN_GROUP], PEOPLE_TREE),
+        conn,
+        {},
+        None,
+        dispatcher,
+        None,
+    )
+    start = monotonic()
+    Thread(target=serve_updates, args=(bot, outbox, dispatcher, handler), daemon=True).start()
+    api.wait_sent(args.updates, args.timeout)
+    elapsed = monotonic() - start
+
+    if len(api.batches) == 0 or api.batches[0] != args.updates:
+        print(f"The first getUpdates returned {api.batches[:1]} updates instead of {args.updates}")
+        sys.exit(1)
+    replies = {}
+    for when, method, params in list(api.sent):
+        replies.setdefault(int(params.get("chat_id")), []).append(params.get("text"))
+    missing = [chat_id for chat_id in pushed if chat_id not in replies]
+    if len(missing) > 0:
+        print(f"{len(missing)}/{args.updates} commands in the batch got no reply, e.g. chat {missing[0]}")
+        sys.exit(1)
+    for chat_id, uid in pushed.items():
+        if replies[chat_id] != [f"Your Telegram ID is: {uid}"]:
+            print(f"Chat {chat_id} got {replies[chat_id]}, expected a single reply for {uid}")
+            sys.exit(1)
+    if len(replies) != len(pushed):
+        print(f"Replies sent to {len(replies) - len(pushed)} chats that didn't send anything")
+        sys.exit(1)
+    print(f"{args.updates} updates in one getUpdates response, {args.updates} commands handled in {elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Check that commands running in parallel reply to the chat that sent them: many simulated users send /id from their
+own private chat at the same time, every reply must be in the right chat and name the user who asked.
+
+    python benchmarks/check_contexts.py --users 50 --commands 5
+"""
+
+import argparse
+import os
+import random
+import sys
+from threading import Thread
+from time import monotonic
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ADMIN_GROUP = "cn=Admins,ou=Groups,dc=example,dc=test"
+PEOPLE_TREE = "ou=People,dc=example,dc=test"
+for variable, value in {
+    "MAX_WORK_DONE": "2000",
+    "WEEE_CHAT_ID": "-1",
+    "WEEE_FOLD_ID": "-2",
+    "WEEE_CHAT2_ID": "-3",
+    "GRILLO_DB_PORT": "0",
+}.items():
+    os.environ.setdefault(variable, value)
+
+from fake_backends import FakeLdapConnection, FakeOwnCloud, FakeTarallo
+from fake_bot_api import FakeBotApi
+
+from dispatcher import Dispatcher
+from LdapWrapper import People, Users
+from outbox import Outbox
+from ToLab import ToLab
+from weeelab_bot import BotHandler, CommandHandler, serve_updates
+from Weeelablib import WeeelabLogs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="Simulated users, each one in its own private chat")
+    parser.add_argument("--commands", type=int, default=5, help="Commands sent by each user")
+    parser.add_argument("--workers", type=int, default=8, help="BOT_WORKERS")
+    parser.add_argument("--ldap-ms", type=float, default=5, help="Delay of each LDAP request, so that commands overlap")
+    parser.add_argument("--timeout", type=float, default=60, help="Stop waiting for replies after this many seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    api = FakeBotApi().start()
+    oc = FakeOwnCloud({"/weeelab/log.txt": b"", "/weeelab/tolab.json": b"[]"})
+    # Telegram IDs of the fake people start from 1, and in private chats the chat ID is the user ID
+    conn = FakeLdapConnection(args.users, 1, ADMIN_GROUP, PEOPLE_TREE, args.ldap_ms)
+    bot = BotHandler("checkcontexts", api.url, pool_size=args.workers + 1)
+    outbox = Outbox(bot, global_rate=1e9, chat_rate=1e9, group_rate=1e9, burst=1e9)
+    dispatcher = Dispatcher(args.workers)
+    handler = CommandHandler(
+        outbox,
+        FakeTarallo(),
+        WeeelabLogs(oc, "/weeelab/log.txt", "/weeelab/", "/weeelab/users_bot.txt"),
+        ToLab(oc, "/weeelab/tolab.json"),
+        Users([ADMIN_GROUP], PEOPLE_TREE, "ou=Invites,dc=example,dc=test", "ou=Groups,dc=example,dc=test"),
+        People([ADMIN_GROUP], PEOPLE_TREE),
+        conn,
+        {},
+        None,
+        dispatcher,
+        None,
+    )
+    Thread(target=serve_updates, args=(bot, outbox, dispatcher, handler), daemon=True).start()
+
+    # Everyone sends their commands at once, mixed up
+    senders = [user_id for user_id in range(1, args.users + 1) for _ in range(args.commands)]
+    random.Random(args.seed).shuffle(senders)
+    start = monotonic()
+    for user_id in senders:
+        api.push_message(user_id, "/id")
+    api.wait_sent(len(senders), args.timeout)
+    elapsed = monotonic() - start
+
+    replies = {}
+    for when, method, params in list(api.sent):
+        replies.setdefault(int(params.get("chat_id")), []).append(params.get("text"))
+    wrong = 0
+    for user_id in range(1, args.users + 1):
+        expected = [f"Your Telegram ID is: user{user_id - 1}.surname{user_id - 1}"] * args.commands
+        if replies.pop(user_id, []) != expected:
+            wrong += 1
+    if len(replies) > 0:
+        print(f"Replies sent to {len(replies)} chats that didn't send anything")
+        sys.exit(1)
+    if wrong > 0:
+        print(f"{wrong}/{args.users} chats got replies meant for someone else, or not all of theirs")
+        sys.exit(1)
+    print(f"{len(senders)} commands from {args.users} users on {args.workers} workers in {elapsed:.2f} s: every reply went to the right chat")
+
+
+if __name__ == "__main__":
+    main()
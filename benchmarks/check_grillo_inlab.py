@@ -0,0 +1,111 @@
+"""
+Check that who is in lab comes from every open session in Grillo, including the ones started last month: /log only
+selects the sessions of this month, but someone who came in on the 31st and is still there is in lab too.
+
+    python benchmarks/check_grillo_inlab.py --host 127.0.0.1 --port 5432 --user postgres --dbname postgres
+
+Everything happens in the check_grillo_inlab schema, which is dropped at the end.
+"""
+
+import argparse
+import os
+import sys
+from time import time
+
+import psycopg2
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for variable in ("MAX_WORK_DONE", "WEEE_CHAT_ID", "WEEE_FOLD_ID", "WEEE_CHAT2_ID", "GRILLO_DB_PORT"):
+    os.environ.setdefault(variable, "0")
+os.environ.setdefault("USE_GRILLO_DB", "1")
+
+from grillo_stats import AUDIT_COLUMNS, GrilloStats
+from pg_pool import PgPool
+from Weeelablib import WeeelabLogs
+
+SCHEMA = "check_grillo_inlab"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.environ.get("GRILLO_DB_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("GRILLO_DB_PORT") or 5432))
+    parser.add_argument("--user", default=os.environ.get("GRILLO_DB_USER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("GRILLO_DB_PASS"))
+    parser.add_argument("--dbname", default=os.environ.get("GRILLO_DB_NAME", "postgres"))
+    args = parser.parse_args()
+
+    def connect():
+        conn = psycopg2.connect(host=args.host, port=args.port, user=args.user, password=args.password, dbname=args.dbname)
+        with conn.cursor() as cur:
+            cur.execute(f"SET search_path TO {SCHEMA}")
+        return conn
+
+    since = WeeelabLogs.month_start()
+    now = int(time())
+    # Came in 3 days before the start of this month and never left
+    last_month = since - 3 * 24 * 3600
+    this_month = since + (now - since) // 3
+
+    conn = psycopg2.connect(host=args.host, port=args.port, user=args.user, password=args.password, dbname=args.dbname)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SCHEMA}")
+        cur.execute(f"CREATE TABLE {SCHEMA}.audit (id SERIAL PRIMARY KEY, userId VARCHAR NOT NULL, startTime INTEGER NOT NULL, endTime INTEGER, summary TEXT)")
+        cur.executemany(
+            f"INSERT INTO {SCHEMA}.audit ({AUDIT_COLUMNS}) VALUES (%s, %s, %s, %s)",
+            [
+                ("old.session", last_month - 3600, last_month, "Last month"),
+                ("still.here", last_month, None, None),
+                ("came.today", this_month, None, None),
+                ("went.home", this_month, this_month + 60, "Done"),
+            ],
+        )
+
+    logs = WeeelabLogs(None, "", "", "")
+    logs.pg_pool.close()
+    logs.pg_pool = PgPool(connect)
+    logs.grillo = GrilloStats(logs.pg_pool)
+    failed = 0
+
+    def check(name: str, expected: dict):
+        nonlocal failed
+        logs.log_cache.refresh()
+        inlab = {username: int(login.timestamp()) for username, login in logs.inlab_since.items()}
+        if inlab == expected and list(inlab) == list(expected):
+            print(f"{name}: ok")
+        else:
+            print(f"{name}: in lab {inlab}, expected {expected}")
+            failed += 1
+
+    try:
+        check("First load", {"still.here": last_month, "came.today": this_month})
+        if [line.username for line in logs.log] != ["came.today", "went.home"]:
+            print(f"Sessions of last month in /log: {[line.username for line in logs.log]}")
+            failed += 1
+
+        with conn.cursor() as cur:
+            cur.execute(f"UPDATE {SCHEMA}.audit SET endTime = %s WHERE userId = 'still.here'", (now,))
+        check("Left after coming last month", {"came.today": this_month})
+
+        with conn.cursor() as cur:
+            cur.execute(f"INSERT INTO {SCHEMA}.audit ({AUDIT_COLUMNS}) VALUES ('still.here', %s, NULL, NULL)", (now,))
+        check("Came back", {"came.today": this_month, "still.here": now})
+
+        with conn.cursor() as cur:
+            cur.execute(f"UPDATE {SCHEMA}.audit SET endTime = %s WHERE userId = 'came.today'", (now,))
+        check("Left after coming this month", {"still.here": now})
+    finally:
+        logs.pg_pool.close()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        conn.close()
+
+    if failed > 0:
+        sys.exit(1)
+    print(f"{logs.log_incremental} incremental refreshes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Check that WeeelabLine.parse_many reads every line exactly as WeeelabLine.regex does, one line at a time, on synthetic
+logs and on lines made of random pieces of log lines. Then compare their speed.
+
+    python benchmarks/check_parser.py --random-lines 200000
+"""
+
+import argparse
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for variable in ("MAX_WORK_DONE", "WEEE_CHAT_ID", "WEEE_FOLD_ID", "WEEE_CHAT2_ID", "GRILLO_DB_PORT"):
+    os.environ.setdefault(variable, "0")
+
+from synthetic_logs import archive
+
+from Weeelablib import WeeelabLine
+
+PIECES = [
+    "[",
+    "]",
+    "<",
+    ">",
+    ":",
+    "::",
+    "{",
+    "}",
+    "2",
+    " ",
+    "  ",
+    "\t",
+    " ",
+    "　",
+    "\r",
+    "\x0c",
+    " ",
+    "INLAB",
+    "[INLAB]",
+    "[01/02/2023 10:00]",
+    "[03:45]",
+    "[3:5:7]",
+    "[:30]",
+    "[-1:00]",
+    "[ 1:00]",
+    "<name.surname>",
+    "<>",
+    ":: ",
+    "Riparato PC",
+    "è",
+    "🍕",
+    "x",
+]
+
+
+def reference(log_file: str) -> tuple:
+    """
+    What the old code did, except that it crashed on the first malformed line
+    """
+    lines, rejected = [], []
+    for number, line in enumerate(log_file.splitlines(), 1):
+        if len(line.strip()) == 0:
+            continue
+        res = WeeelabLine.regex.match(line)
+        try:
+            if res is None:
+                raise ValueError
+            time_in, time_out, duration, username, text = res.groups()
+            if duration == "INLAB":
+                minutes, time_out, inlab = 0, None, True
+            else:
+                parts = duration.split(":")
+                minutes, inlab = int(parts[0]) * 60 + int(parts[1]), False
+        except (ValueError, IndexError):
+            rejected.append((number, line))
+            continue
+        lines.append((time_in, time_out, duration, username, text, inlab, minutes))
+    return lines, rejected
+
+
+def fields(line: WeeelabLine) -> tuple:
+    return line.time_in, line.time_out, line.duration, line.username, line.text, line.inlab, line.duration_minutes()
+
+
+def random_line(rng: random.Random) -> str:
+    line = "".join(rng.choice(PIECES) for _ in range(rng.randrange(1, 12)))
+    if rng.random() < 0.5:
+        # Almost valid
+        line = f"[01/02/2023 10:00]{rng.choice(PIECES)}[01/02/2023 12:{rng.randrange(60):02d}] [{rng.choice(['02:00', 'INLAB', '2:0', ''])}] <a.b>{line}"
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--random-lines", type=int, default=100000, help="Lines made of random pieces")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    synthetic = "".join(archive(2017, 4, 2022, 12, 80, 400).values())
+    fuzzed = "\n".join(random_line(rng) for _ in range(args.random_lines))
+
+    for name, log_file in (("synthetic", synthetic), ("random", fuzzed)):
+        expected_lines, expected_rejected = reference(log_file)
+        lines, rejected = WeeelabLine.parse_many(log_file)
+        if [fields(line) for line in lines] != expected_lines or rejected != expected_rejected:
+            print(f"{name}: MISMATCH")
+            sys.exit(1)
+        print(f"{name}: same {len(lines)} lines and {len(rejected)} malformed ones")
+
+    total = len(synthetic.splitlines())
+    times = {}
+    for name, parse in (
+        ("one at a time", lambda: [WeeelabLine(line) for line in synthetic.splitlines() if len(line.strip()) > 0]),
+        ("parse_many", lambda: WeeelabLine.parse_many(synthetic)),
+    ):
+        best = None
+        for _ in range(10):
+            start = perf_counter()
+            parse()
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times[name] = best
+        print(f"{name:>14}: {total / best:,.0f} lines/s")
+    print(f"{times['one at a time'] / times['parse_many']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
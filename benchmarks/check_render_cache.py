@@ -0,0 +1,148 @@
+"""
+Check that /inlab, /top and /log reuse their messages only while nothing they depend on has changed: same logs, same
+/tolab entries, same people, same kind of user asking. Then compare the time to answer with and without the cache.
+
+    python benchmarks/check_render_cache.py --users 50
+"""
+
+import argparse
+import os
+import sys
+from datetime import date
+from time import perf_counter
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ADMIN_GROUP = "cn=Admins,ou=Groups,dc=example,dc=test"
+PEOPLE_TREE = "ou=People,dc=example,dc=test"
+for variable, value in {
+    "MAX_WORK_DONE": "2000",
+    "WEEE_CHAT_ID": "-1",
+    "WEEE_FOLD_ID": "-2",
+    "WEEE_CHAT2_ID": "-3",
+    "GRILLO_DB_PORT": "0",
+}.items():
+    os.environ.setdefault(variable, value)
+
+from fake_backends import FakeLdapConnection, FakeOwnCloud, FakeTarallo
+from synthetic_logs import archive, month_lines, usernames
+
+from LdapWrapper import People, Users
+from render_cache import RenderCache
+from ToLab import ToLab
+from weeelab_bot import CommandHandler, UpdateContext
+from Weeelablib import WeeelabLogs
+
+
+class Replies:
+    """
+    Stands in for the Outbox, keeps the last message
+    """
+
+    def __init__(self):
+        self.last = None
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        self.last = text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="Different usernames in the logs and in LDAP")
+    parser.add_argument("--lines-per-month", type=int, default=300, help="Lines in each month")
+    parser.add_argument("--repeat", type=int, default=200, help="Times each command is timed")
+    args = parser.parse_args()
+
+    today = date.today()
+    last_year, last_month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+    files = {
+        f"/weeelab/{name}": content.encode() for name, content in archive(last_year - 1, 1, last_year, last_month, args.users, args.lines_per_month).items()
+    }
+    log = month_lines(today.year, today.month, usernames(args.users), args.lines_per_month, inlab=5)
+    files["/weeelab/log.txt"] = ("\n".join(log) + "\n").encode()
+    files["/weeelab/tolab.json"] = b"[]"
+    oc = FakeOwnCloud(files)
+    conn = FakeLdapConnection(args.users, 2, ADMIN_GROUP, PEOPLE_TREE)
+
+    logs = WeeelabLogs(oc, "/weeelab/log.txt", "/weeelab/", "/weeelab/users_bot.txt")
+    # Don't download every month since 2017
+    logs.old_logs_year, logs.old_logs_month = last_year - 1, 0
+    tolab = ToLab(oc, "/weeelab/tolab.json")
+    people = People([ADMIN_GROUP], PEOPLE_TREE)
+    users = Users([ADMIN_GROUP], PEOPLE_TREE, "ou=Invites,dc=example,dc=test", "ou=Groups,dc=example,dc=test")
+    replies = Replies()
+    handler = CommandHandler(replies, FakeTarallo(), logs, tolab, users, people, conn, {}, None, None, None)
+
+    def ask(command, username: str, admin: bool = False, *command_args) -> str:
+        ctx = UpdateContext(replies, 1, {"id": 1})
+        ctx.user = SimpleNamespace(uid=username, isadmin=admin)
+        command(ctx, *command_args)
+        return replies.last
+
+    def misses(name: str) -> int:
+        stats = handler.render_cache.get_stats().get(name)
+        return 0 if stats is None else stats.misses
+
+    def check(description: str, name: str, rebuilt: bool, answer):
+        before = misses(name)
+        message = answer()
+        if (misses(name) > before) != rebuilt:
+            print(f"{description}: message {'reused' if rebuilt else 'built again'}, it shouldn't have been")
+            sys.exit(1)
+        # What it would be without the cache
+        cache, handler.render_cache = handler.render_cache, RenderCache()
+        fresh = answer()
+        handler.render_cache = cache
+        if message != fresh:
+            print(f"{description}: STALE MESSAGE")
+            sys.exit(1)
+        print(f"{description}: {'built' if rebuilt else 'reused'}, same as without cache")
+
+    def refresh_log(line: str):
+        log.append(line)
+        oc.put_file_contents("/weeelab/log.txt", ("\n".join(log) + "\n").encode())
+        logs.log_cache.delete_cache()
+
+    someone, somebody_else, admin = usernames(args.users)[10], usernames(args.users)[11], usernames(args.users)[0]
+    newcomer = usernames(args.users)[12]
+    now = today.strftime("%d/%m/%Y") + " 00:00"
+
+    check("/inlab first time", "/inlab", True, lambda: ask(handler.inlab, someone))
+    check("/inlab again", "/inlab", False, lambda: ask(handler.inlab, someone))
+    check("/inlab from someone else", "/inlab", False, lambda: ask(handler.inlab, somebody_else))
+    check("/inlab from an admin", "/inlab", True, lambda: ask(handler.inlab, admin, True))
+    refresh_log(f"[{now}] [INLAB] [INLAB] <{newcomer}> ::")
+    check("/inlab after a login", "/inlab", True, lambda: ask(handler.inlab, someone))
+    tolab.set_entry(somebody_else, 11, "23:59", 1)
+    check("/inlab after /tolab", "/inlab", True, lambda: ask(handler.inlab, someone))
+    people.delete_cache()
+    check("/inlab after people changed", "/inlab", True, lambda: ask(handler.inlab, someone))
+
+    check("/top first time", "/top", True, lambda: ask(handler.top, admin, True))
+    check("/top again", "/top", False, lambda: ask(handler.top, admin, True))
+    check("/top all", "/top", True, lambda: ask(handler.top, admin, True, "all"))
+    refresh_log(f"[{now}] [{now}] [03:00] <{somebody_else}> :: Something")
+    check("/top after a logout", "/top", True, lambda: ask(handler.top, admin, True))
+
+    check("/log 3 first time", "/log", True, lambda: ask(handler.log, someone, False, "3"))
+    check("/log 3 again", "/log", False, lambda: ask(handler.log, someone, False, "3"))
+    people.delete_cache()
+    check("/log 3 after people changed", "/log", True, lambda: ask(handler.log, someone, False, "3"))
+    refresh_log(f"[{now}] [{now}] [01:00] <{newcomer}> :: Something else")
+    check("/log 3 after a logout", "/log", True, lambda: ask(handler.log, someone, False, "3"))
+
+    for name, command, command_args in (("/inlab", handler.inlab, ()), ("/top", handler.top, ()), ("/log 7", handler.log, ("7",))):
+        times = {}
+        for cached in (False, True):
+            handler.render_cache = RenderCache()
+            start = perf_counter()
+            for _ in range(args.repeat):
+                if not cached:
+                    handler.render_cache = RenderCache()
+                ask(command, admin, True, *command_args)
+            times[cached] = (perf_counter() - start) / args.repeat * 1000
+        print(f"{name:>7}: {times[False]:.3f} ms without cache, {times[True]:.3f} ms with")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+In-memory stand-ins for ownCloud, LDAP and T.A.R.A.L.L.O., with a configurable delay on each request to simulate
+the network. They implement just what the bot uses.
+"""
+
+import hashlib
+import re
+from datetime import date, datetime, timedelta
+from threading import Lock
+from time import sleep
+from typing import Dict, List, Optional
+
+import owncloud
+from pytarallo.AuditEntry import AuditChanges, AuditEntry
+from pytarallo.Errors import ItemNotFoundError
+
+
+class FakeOwnCloud:
+    """
+    Replaces OwnCloudClient
+    """
+
+    def __init__(self, files: Dict[str, bytes], latency_ms: float = 0):
+        self.files = dict(files)
+        self.modified: Dict[str, datetime] = {path: datetime.utcnow() for path in files}
+        self.latency_ms = latency_ms
+        self.requests = 0
+        # Conditional requests answered with "304 Not Modified"
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.__lock = Lock()
+
+    def __request(self):
+        with self.__lock:
+            self.requests += 1
+        if self.latency_ms > 0:
+            sleep(self.latency_ms / 1000)
+
+    def login(self, user, password):
+        self.__request()
+
+    def get_file_contents(self, path: str) -> bytes:
+        self.__request()
+        with self.__lock:
+            if path not in self.files:
+                raise owncloud.owncloud.HTTPResponseError(404)
+            self.bytes_sent += len(self.files[path])
+            return self.files[path]
+
+    def put_file_contents(self, path: str, data: bytes) -> bool:
+        self.__request()
+        with self.__lock:
+            self.files[path] = data
+            self.modified[path] = datetime.utcnow()
+        return True
+
+    def etag(self, path: str) -> str:
+        return '"' + hashlib.md5(self.files[path]).hexdigest() + '"'
+
+    def get_file_range(self, path: str, start: int, etag: Optional[str]):
+        """
+        Same as OwnCloudClient.get_file_range
+        """
+        self.__request()
+        with self.__lock:
+            if path not in self.files:
+                raise owncloud.owncloud.HTTPResponseError(404)
+            if etag is not None and etag == self.etag(path):
+                self.not_modified += 1
+                return None
+            content = self.files[path]
+            if start > len(content):
+                start = 0
+            self.bytes_sent += len(content) - start
+            return content[start:], self.etag(path), self.modified[path].replace(microsecond=0), start
+
+    def file_info(self, path: str) -> owncloud.FileInfo:
+        self.__request()
+        with self.__lock:
+            if path not in self.files:
+                raise owncloud.owncloud.HTTPResponseError(404)
+            modified = self.modified[path].strftime(owncloud.FileInfo._DATE_FORMAT.replace("%Z", "GMT"))
+            attributes = {"{DAV:}getlastmodified": modified, "{DAV:}getcontentlength": str(len(self.files[path]))}
+        return owncloud.FileInfo(path, "file", attributes)
+
+
+class FakeLdap:
+    """
+    What LdapConnection returns when entered: answers the searches made by LdapWrapper, on a list of people
+    """
+
+    def __init__(self, entries: Dict[str, dict], latency_ms: float, lock: Lock):
+        self.__entries = entries
+        self.__latency_ms = latency_ms
+        self.__lock = lock
+
+    def __wait(self):
+        if self.__latency_ms > 0:
+            sleep(self.__latency_ms / 1000)
+
+    def search_s(self, base: str, scope, filterstr: str, attrlist=None):
+        self.__wait()
+        with self.__lock:
+            by_id = re.search(r"\(telegramId=(\d+)\)", filterstr)
+            by_nickname = re.search(r"\(telegramNickname=([^)]+)\)", filterstr)
+            result = []
+            for dn, attributes in self.__entries.items():
+                if by_id and attributes.get("telegramid", [b""])[0].decode() != by_id.group(1):
+                    continue
+                if by_nickname and ("telegramid" in attributes or attributes.get("telegramnickname", [b""])[0].decode() != by_nickname.group(1)):
+                    continue
+                result.append((dn, dict(attributes)))
+            return result
+
+    def read_s(self, dn: str, filterstr=None, attrlist=None):
+        self.__wait()
+        with self.__lock:
+            if dn not in self.__entries:
+                return []
+            return [(dn, dict(self.__entries[dn]))]
+
+    def modify_s(self, dn: str, modlist: list):
+        self.__wait()
+        with self.__lock:
+            attributes = self.__entries[dn]
+            for operation, attribute, value in modlist:
+                attribute = attribute.lower()
+                if value is None:
+                    attributes.pop(attribute, None)
+                else:
+                    attributes[attribute] = [value]
+
+    def unbind_s(self):
+        pass
+
+
+class FakeLdapConnection:
+    """
+    Replaces LdapConnection
+    """
+
+    def __init__(self, people: int, admins: int, admin_group: str, tree: str, latency_ms: float = 0, first_tgid: int = 1):
+        """
+        :param people: How many people, their usernames are the same as in synthetic_logs
+        :param admins: How many of them are admins
+        :param admin_group: DN of the admin group
+        :param tree: People tree
+        :param latency_ms: Delay for each search or modify
+        :param first_tgid: Telegram ID of the first person, the others follow
+        """
+        self.latency_ms = latency_ms
+        self.connections = 0
+        self.__lock = Lock()
+        self.entries: Dict[str, dict] = {}
+        birthday = date.today() + timedelta(days=3)
+        for i in range(people):
+            uid = f"user{i}.surname{i}"
+            self.entries[f"uid={uid},{tree}"] = {
+                "uid": [uid.encode()],
+                "cn": [f"User{i} Surname{i}".encode()],
+                "givenname": [f"User{i}".encode()],
+                "sn": [f"Surname{i}".encode()],
+                "surname": [f"Surname{i}".encode()],
+                "memberof": [admin_group.encode()] if i < admins else [],
+                "telegramid": [str(first_tgid + i).encode()],
+                "telegramnickname": [f"user{i}".encode()],
+                "schacdateofbirth": [birthday.replace(year=1992).strftime("%Y%m%d").encode()],
+                "safetytestdate": [b"20200101"],
+                "signedsir": [b"true"],
+            }
+
+    def __enter__(self):
+        with self.__lock:
+            self.connections += 1
+        return FakeLdap(self.entries, self.latency_ms, self.__lock)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class FakeItem:
+    def __init__(self, code: str):
+        self.code = code
+        self.location = ["Polito", "Chernobyl", "Table"]
+        self.features = {"type": "case", "color": "black", "working": "yes"}
+        self.product = None
+
+
+class FakeTarallo:
+    """
+    Replaces pytarallo.Tarallo: every item code that starts with R exists
+    """
+
+    def __init__(self, latency_ms: float = 0):
+        self.url = "http://tarallo.invalid"
+        self.latency_ms = latency_ms
+        self.response = None
+
+    def __wait(self):
+        if self.latency_ms > 0:
+            sleep(self.latency_ms / 1000)
+
+    def get_item(self, code: str, depth_limit: Optional[int] = None) -> FakeItem:
+        self.__wait()
+        if not code.startswith("R"):
+            raise ItemNotFoundError(code)
+        return FakeItem(code)
+
+    def get_history(self, code: str, limit: Optional[int] = None) -> List[AuditEntry]:
+        self.__wait()
+        if not code.startswith("R"):
+            raise ItemNotFoundError(code)
+        now = datetime.now().timestamp()
+        changes = [AuditChanges.Create, AuditChanges.Update, AuditChanges.Move, AuditChanges.Rename]
+        return [AuditEntry(f"user{i}.surname{i}", changes[i % len(changes)], now - i * 3600, "Table") for i in range(limit or 6)]
@@ -0,0 +1,148 @@
+"""
+A stand-in for https://api.telegram.org that runs on localhost, to measure the bot without bothering Telegram.
+Updates are pushed by the benchmark, whatever the bot sends is recorded.
+"""
+
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Thread
+from time import monotonic
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl, urlparse
+
+
+class FakeBotApi:
+    def __init__(self, port: int = 0):
+        self.__condition = Condition()
+        self.__updates: List[dict] = []
+        self.__next_update_id = 1
+        self.__next_message_id = 1
+        # update_id -> when it was pushed
+        self.pushed_at: Dict[int, float] = {}
+        # update_id -> when the bot got it with getUpdates
+        self.fetched_at: Dict[int, float] = {}
+        # (when, method, params) of everything the bot sent
+        self.sent: List[tuple] = []
+        # How many updates each getUpdates returned, empty ones excluded
+        self.batches: List[int] = []
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.__handle(dict(parse_qsl(urlparse(self.path).query)))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8")
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body) if body else {}
+                else:
+                    params = dict(parse_qsl(body))
+                self.__handle(params)
+
+            def __handle(self, params: dict):
+                method = urlparse(self.path).path.rsplit("/", 1)[-1]
+                ok, result = fake.call(method, params)
+                response = json.dumps({"ok": ok, "result": result} if ok else {"ok": False, "description": result}).encode("utf-8")
+                self.send_response(200 if ok else 400)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        """
+        Pass this as "server" to BotHandler
+        """
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push_update(self, update: dict) -> int:
+        """
+        Make an update available to getUpdates
+
+        :param update: The update, update_id is added automatically
+        :return: update_id
+        """
+        with self.__condition:
+            update_id = self.__next_update_id
+            self.__next_update_id += 1
+            update["update_id"] = update_id
+            self.pushed_at[update_id] = monotonic()
+            self.__updates.append(update)
+            self.__condition.notify_all()
+        return update_id
+
+    def push_message(self, chat_id: int, text: str, username: Optional[str] = None, user_id: Optional[int] = None) -> int:
+        """
+        A user sends a text message in a private chat
+
+        :param user_id: Who sent it, same as chat_id if None (as it is in private chats)
+        """
+        with self.__condition:
+            message_id = self.__next_message_id
+            self.__next_message_id += 1
+        user_id = chat_id if user_id is None else user_id
+        sender = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+        if username is not None:
+            sender["username"] = username
+        message = {"message_id": message_id, "from": sender, "chat": {"id": chat_id, "type": "private"}, "date": 0, "text": text}
+        return self.push_update({"message": message})
+
+    def sent_count(self) -> int:
+        with self.__condition:
+            return len(self.sent)
+
+    def wait_sent(self, count: int, timeout: float) -> bool:
+        """
+        Wait until the bot has sent at least count messages
+        """
+        with self.__condition:
+            return self.__condition.wait_for(lambda: len(self.sent) >= count, timeout)
+
+    def call(self, method: str, params: dict):
+        if method == "getUpdates":
+            return True, self.__get_updates(params)
+        if method in ("setWebhook", "deleteWebhook"):
+            return True, True
+        if method in ("sendMessage", "sendPhoto", "editMessageText", "leaveChat"):
+            with self.__condition:
+                self.sent.append((monotonic(), method, params))
+                message_id = self.__next_message_id
+                self.__next_message_id += 1
+                self.__condition.notify_all()
+            if method == "leaveChat":
+                return True, True
+            return True, {"message_id": message_id, "chat": {"id": params.get("chat_id")}, "text": params.get("text")}
+        return False, f"Not Found: method {method} not found"
+
+    def __get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        with self.__condition:
+            # Confirmed updates are forgotten, as Telegram does
+            self.__updates = [u for u in self.__updates if u["update_id"] >= offset]
+            self.__condition.wait_for(lambda: len(self.__updates) > 0, timeout)
+            batch = list(self.__updates[:100])
+            for update in batch:
+                self.fetched_at.setdefault(update["update_id"], monotonic())
+            if len(batch) > 0:
+                self.batches.append(len(batch))
+            return batch
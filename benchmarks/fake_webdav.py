@@ -0,0 +1,115 @@
+"""
+A WebDAV server on localhost that answers like ownCloud to the few requests the bot makes (GET with ETags and ranges,
+PUT), with a delay on each request and some failures if wanted. OwnCloudClient connects to it with anon_login, so the
+real client code is measured, HTTP included.
+"""
+
+import hashlib
+import random
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Dict
+from urllib.parse import unquote, urlparse
+
+from owncloud_client import OwnCloudClient
+
+PREFIX = "/public.php/webdav"
+
+
+class FakeWebDav:
+    def __init__(self, files: Dict[str, bytes], latency_ms: float = 0, error_rate: float = 0, seed: int = 0, port: int = 0):
+        """
+        :param files: Path (e.g. /weeelab/log.txt) -> contents
+        :param latency_ms: Delay before answering each request
+        :param error_rate: Fraction of GET requests answered with 503
+        :param seed: For repeatable errors
+        :param port: 0 to pick a free one
+        """
+        self.files = dict(files)
+        self.modified = {path: time() for path in files}
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.__random = random.Random(seed)
+        self.__lock = Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                status, headers, body = fake.get(self.__path(), self.headers.get("If-None-Match"), self.headers.get("Range"))
+                self.__respond(status, headers, body)
+
+            def do_PUT(self):
+                length = int(self.headers.get("Content-Length", 0))
+                fake.put(self.__path(), self.rfile.read(length))
+                self.__respond(201, {}, b"")
+
+            def __path(self) -> str:
+                return unquote(urlparse(self.path).path)[len(PREFIX) :]
+
+            def __respond(self, status: int, headers: dict, body: bytes):
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self) -> OwnCloudClient:
+        oc = OwnCloudClient(self.url)
+        oc.anon_login("benchmark")
+        return oc
+
+    def get(self, path: str, if_none_match, byte_range) -> tuple:
+        if self.latency_ms > 0:
+            sleep(self.latency_ms / 1000)
+        with self.__lock:
+            self.requests += 1
+            if self.__random.random() < self.error_rate:
+                self.errors += 1
+                return 503, {}, b""
+            if path not in self.files:
+                return 404, {}, b""
+            content = self.files[path]
+            headers = {"ETag": '"' + hashlib.md5(content).hexdigest() + '"', "Last-Modified": formatdate(self.modified[path], usegmt=True)}
+        if if_none_match == headers["ETag"]:
+            return 304, headers, b""
+        if byte_range is not None and byte_range.startswith("bytes="):
+            start = int(byte_range[len("bytes=") :].split("-")[0])
+            if start >= len(content):
+                return 416, {}, b""
+            headers["Content-Range"] = f"bytes {start}-{len(content) - 1}/{len(content)}"
+            return 206, headers, content[start:]
+        return 200, headers, content
+
+    def put(self, path: str, content: bytes):
+        if self.latency_ms > 0:
+            sleep(self.latency_ms / 1000)
+        with self.__lock:
+            self.requests += 1
+            self.files[path] = content
+            self.modified[path] = time()
@@ -0,0 +1,218 @@
+"""
+End-to-end load test: the real main loop (serve_updates), dispatcher, outbox and CommandHandler, talking to a fake
+Bot API server and fake ownCloud, LDAP and T.A.R.A.L.L.O. backends.
+
+    python benchmarks/load_test.py --users 50 --commands 1000 --burst 100 --mix inlab=5,log=3,stat=2,id=1
+
+Each command is sent from its own chat (the sender is one of the synthetic users), so every reply can be matched to
+the command that caused it. Latency is from the moment the update is available to getUpdates to the first reply,
+commands that got no reply before the timeout are counted as dropped.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+from datetime import date
+from threading import Thread
+from time import monotonic, sleep
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ADMIN_GROUP = "cn=Admins,ou=Groups,dc=example,dc=test"
+PEOPLE_TREE = "ou=People,dc=example,dc=test"
+# variables.py reads these when imported
+for variable, value in {
+    "MAX_WORK_DONE": "2000",
+    "WEEE_CHAT_ID": "-1",
+    "WEEE_FOLD_ID": "-2",
+    "WEEE_CHAT2_ID": "-3",
+    "GRILLO_DB_PORT": "0",
+    "LOG_PATH": "/weeelab/log.txt",
+    "LOG_BASE": "/weeelab/",
+    "USER_BOT_PATH": "/weeelab/users_bot.txt",
+    "TOLAB_PATH": "/weeelab/tolab.json",
+    "QUOTES_PATH": "/weeelab/quotes.json",
+    "QUOTES_GAME_PATH": "/weeelab/game.json",
+    "DEMOTIVATIONAL_PATH": "/weeelab/demotivational.txt",
+    "LDAP_ADMIN_GROUPS": ADMIN_GROUP,
+    "LDAP_TREE_PEOPLE": PEOPLE_TREE,
+    "LDAP_TREE_GROUPS": "ou=Groups,dc=example,dc=test",
+    "LDAP_TREE_INVITES": "ou=Invites,dc=example,dc=test",
+}.items():
+    os.environ.setdefault(variable, value)
+
+from fake_backends import FakeLdapConnection, FakeOwnCloud, FakeTarallo
+from fake_bot_api import FakeBotApi
+from synthetic_logs import archive, month_lines, usernames
+
+from dispatcher import Dispatcher
+from LdapWrapper import People, Users
+from outbox import Outbox
+from Quotes import Quotes
+from ToLab import ToLab
+from variables import *
+from weeelab_bot import BotHandler, CommandHandler, serve_updates
+from Weeelablib import WeeelabLogs
+
+# Command -> what to send, "{user}" is replaced with a random username
+COMMANDS = {
+    "inlab": "/inlab",
+    "log": "/log",
+    "log7": "/log 7",
+    "stat": "/stat",
+    "statuser": "/stat {user}",
+    "top": "/top",
+    "topall": "/top all",
+    "id": "/id",
+    "start": "/start",
+    "help": "/help",
+    "history": "/history R100",
+    "item": "/item R100",
+    "location": "/location R100",
+    "quote": "/quote",
+    "motivami": "/motivami",
+    "nextbirthdays": "/nextbirthdays",
+    "unknown": "/asdasd",
+}
+DEFAULT_MIX = "inlab=5,log=3,stat=3,top=2,id=1,start=1,history=1,item=1,quote=1,statuser=1,topall=1"
+
+# Every command goes to its own chat, with IDs starting from here
+FIRST_CHAT = 1_000_000
+
+
+def fake_files(args) -> dict:
+    today = date.today()
+    last_year, last_month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+    files = {f"/weeelab/{name}": content.encode() for name, content in archive(2017, 4, last_year, last_month, args.users, args.lines_per_month).items()}
+    log = month_lines(today.year, today.month, usernames(args.users), args.lines_per_month, inlab=min(5, args.users))
+    files["/weeelab/log.txt"] = ("\n".join(log) + "\n").encode()
+    files["/weeelab/users_bot.txt"] = b""
+    files["/weeelab/tolab.json"] = b"[]"
+    quotes = [{"quote": f"Quote number {i}", "author": f"Author {i % 7}"} for i in range(200)]
+    files["/weeelab/quotes.json"] = json.dumps(quotes).encode()
+    files["/weeelab/game.json"] = b"{}"
+    files["/weeelab/demotivational.txt"] = "\n".join(f"Demotivational {i}" for i in range(50)).encode()
+    return files
+
+
+def parse_mix(mix: str) -> tuple:
+    names, weights = [], []
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        if name not in COMMANDS:
+            raise ValueError(f"Unknown command {name}, choose from {', '.join(COMMANDS)}")
+        names.append(name)
+        weights.append(float(weight))
+    return names, weights
+
+
+def run(args) -> dict:
+    api = FakeBotApi().start()
+    oc = FakeOwnCloud(fake_files(args), args.oc_ms)
+    conn = FakeLdapConnection(args.users, max(1, args.users // 10), ADMIN_GROUP, PEOPLE_TREE, args.ldap_ms)
+    tarallo = FakeTarallo(args.tarallo_ms)
+
+    bot = BotHandler("loadtest", api.url, pool_size=args.workers + 1)
+    if args.no_rate_limit:
+        outbox = Outbox(bot, global_rate=1e9, chat_rate=1e9, group_rate=1e9, burst=1e9)
+    else:
+        outbox = Outbox(bot)
+    dispatcher = Dispatcher(args.workers)
+    handler = CommandHandler(
+        outbox,
+        tarallo,
+        WeeelabLogs(oc, LOG_PATH, LOG_BASE, USER_BOT_PATH),
+        ToLab(oc, TOLAB_PATH),
+        Users(LDAP_ADMIN_GROUPS, LDAP_TREE_PEOPLE, LDAP_TREE_INVITES, LDAP_TREE_GROUPS),
+        People(LDAP_ADMIN_GROUPS, LDAP_TREE_PEOPLE),
+        conn,
+        {},
+        Quotes(oc, QUOTES_PATH, DEMOTIVATIONAL_PATH, QUOTES_GAME_PATH),
+        dispatcher,
+        None,
+    )
+    Thread(target=serve_updates, args=(bot, outbox, dispatcher, handler), daemon=True).start()
+
+    names, weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    users = usernames(args.users)
+    pushed = {}
+    start = monotonic()
+    for i in range(args.commands):
+        text = COMMANDS[rng.choices(names, weights)[0]].format(user=rng.choice(users))
+        chat_id = FIRST_CHAT + i
+        # Telegram IDs of the fake people start from 1
+        update_id = api.push_message(chat_id, text, user_id=rng.randrange(args.users) + 1)
+        pushed[chat_id] = (update_id, text)
+        if args.burst > 0 and (i + 1) % args.burst == 0 and args.pause > 0:
+            sleep(args.pause)
+    sent_all = monotonic()
+
+    # Wait for a reply to each command, or the timeout
+    deadline = sent_all + args.timeout
+    while monotonic() < deadline:
+        replied = {params.get("chat_id") for when, method, params in list(api.sent)}
+        if all(chat_id in replied for chat_id in pushed):
+            break
+        sleep(0.05)
+    elapsed = monotonic() - start
+
+    first_reply = {}
+    for when, method, params in list(api.sent):
+        chat_id = params.get("chat_id")
+        if chat_id in pushed and chat_id not in first_reply:
+            first_reply[chat_id] = when
+    latencies = sorted((first_reply[chat_id] - api.pushed_at[pushed[chat_id][0]]) * 1000 for chat_id in first_reply)
+    dropped = [pushed[chat_id][1] for chat_id in pushed if chat_id not in first_reply]
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [float("nan")] * 99
+
+    return {
+        "commands": args.commands,
+        "replied": len(latencies),
+        "dropped": len(dropped),
+        "dropped_commands": sorted(set(dropped)),
+        "seconds": elapsed,
+        "commands_per_second": len(latencies) / elapsed,
+        "p50_ms": percentiles[49],
+        "p95_ms": percentiles[94],
+        "p99_ms": percentiles[98],
+        "messages_sent": api.sent_count(),
+        "owncloud_requests": oc.requests,
+        "ldap_connections": conn.connections,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="People in LDAP and in the logs")
+    parser.add_argument("--commands", type=int, default=500, help="Commands sent in total")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Command=weight, comma separated. Commands: {', '.join(COMMANDS)}")
+    parser.add_argument("--burst", type=int, default=0, help="Send commands in bursts of this size, 0 to send them all at once")
+    parser.add_argument("--pause", type=float, default=1.0, help="Seconds between bursts")
+    parser.add_argument("--workers", type=int, default=8, help="BOT_WORKERS")
+    parser.add_argument("--lines-per-month", type=int, default=300, help="Lines in each synthetic log file")
+    parser.add_argument("--oc-ms", type=float, default=20, help="Delay of each ownCloud request")
+    parser.add_argument("--ldap-ms", type=float, default=5, help="Delay of each LDAP request")
+    parser.add_argument("--tarallo-ms", type=float, default=30, help="Delay of each T.A.R.A.L.L.O. request")
+    parser.add_argument("--no-rate-limit", action="store_true", help="Don't limit outgoing messages as Telegram would")
+    parser.add_argument("--timeout", type=float, default=120, help="Stop waiting for replies after this many seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write results to this file")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(
+        f"{result['replied']}/{result['commands']} commands replied in {result['seconds']:.1f} s, {result['commands_per_second']:.1f} commands/s\n"
+        f"latency p50 {result['p50_ms']:.0f} ms, p95 {result['p95_ms']:.0f} ms, p99 {result['p99_ms']:.0f} ms\n"
+        f"dropped {result['dropped']} {' '.join(result['dropped_commands'])}\n"
+        f"{result['messages_sent']} messages sent, {result['owncloud_requests']} ownCloud requests, {result['ldap_connections']} LDAP connections"
+    )
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
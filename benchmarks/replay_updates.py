@@ -0,0 +1,59 @@
+"""
+Post recorded updates to the webhook, as Telegram would. Start the bot with BOT_INGESTION=webhook first.
+
+    python benchmarks/replay_updates.py updates.json --url http://127.0.0.1:8443/ --secret "$WEBHOOK_SECRET"
+
+Without --secret (or WEBHOOK_SECRET) no token is sent, and the bot refuses every update: use it to check that.
+
+The file contains a JSON array of updates, or one update per line (e.g. copied from getUpdates results).
+"""
+
+import argparse
+import json
+import os
+import sys
+from time import monotonic
+
+import requests
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from webhook import WebhookServer
+
+
+def read_updates(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as file:
+        content = file.read().strip()
+    if content.startswith("["):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip() != ""]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="Recorded updates")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/", help="Where the webhook is listening")
+    parser.add_argument("--secret", default=os.environ.get("WEBHOOK_SECRET"), help="WEBHOOK_SECRET, taken from the environment by default")
+    parser.add_argument("--repeat", type=int, default=1, help="Send everything this many times, with new update IDs")
+    args = parser.parse_args()
+
+    updates = read_updates(args.file)
+    headers = {} if args.secret is None else {WebhookServer.SECRET_HEADER: args.secret}
+    session = requests.Session()
+    statuses = {}
+    update_id = max((update.get("update_id", 0) for update in updates), default=0)
+    start = monotonic()
+    for _ in range(args.repeat):
+        for update in updates:
+            if args.repeat > 1:
+                update_id += 1
+                update = dict(update, update_id=update_id)
+            status = session.post(args.url, json=update, headers=headers, timeout=10).status_code
+            statuses[status] = statuses.get(status, 0) + 1
+    elapsed = monotonic() - start
+
+    sent = sum(statuses.values())
+    print(f"Posted {sent} updates in {elapsed:.2f} s ({sent / elapsed:.1f}/s), responses: {statuses}")
+
+
+if __name__ == "__main__":
+    main()
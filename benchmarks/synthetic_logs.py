@@ -0,0 +1,83 @@
+"""
+Generate logs in the weeelab format, e.g.
+
+    [21/03/2023 15:02] [21/03/2023 18:47] [03:45] <name.surname> :: Fixed some computers
+    [22/03/2023 10:13] [INLAB] [INLAB] <other.person> ::
+"""
+
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List
+
+TEXTS = [
+    "Riparato PC",
+    "Sistemato il magazzino",
+    "Testato RAM e HDD",
+    "Catalogato roba su T.A.R.A.L.L.O.",
+    "Installato Linux su 3 computer",
+    "Pulizie di primavera",
+    "Sviluppo del bot, che scala benissimo",
+]
+
+DATE_FORMAT = "%d/%m/%Y %H:%M"
+
+
+def usernames(users: int) -> List[str]:
+    return [f"user{i}.surname{i}" for i in range(users)]
+
+
+def month_lines(year: int, month: int, users: List[str], lines: int, inlab: int = 0, rng: random.Random = None) -> List[str]:
+    """
+    Lines of a single month, ordered by login time as in the real logs
+
+    :param year: Year
+    :param month: Month, 1 to 12
+    :param users: Usernames to pick from
+    :param lines: How many lines
+    :param inlab: How many of the last lines are people still in lab
+    :param rng: Random generator, for repeatable logs
+    :return: Lines, without newlines
+    """
+    rng = rng or random.Random(year * 100 + month)
+    start = datetime(year, month, 1, 9, 0)
+    days = 28
+    logins = sorted(start + timedelta(days=rng.randrange(days), minutes=rng.randrange(60 * 12)) for _ in range(lines))
+
+    result = []
+    for i, time_in in enumerate(logins):
+        username = rng.choice(users)
+        if i >= lines - inlab:
+            result.append(f"[{time_in.strftime(DATE_FORMAT)}] [INLAB] [INLAB] <{username}> ::")
+            continue
+        minutes = rng.randrange(10, 60 * 8)
+        time_out = time_in + timedelta(minutes=minutes)
+        duration = f"{minutes // 60:02d}:{minutes % 60:02d}"
+        result.append(f"[{time_in.strftime(DATE_FORMAT)}] [{time_out.strftime(DATE_FORMAT)}] [{duration}] <{username}> :: {rng.choice(TEXTS)}")
+    return result
+
+
+def months(first_year: int, first_month: int, last_year: int, last_month: int) -> Iterator[tuple]:
+    """
+    (year, month) from the first to the last one, both included
+    """
+    year, month = first_year, first_month
+    while (year, month) <= (last_year, last_month):
+        yield year, month
+        month += 1
+        if month > 12:
+            month = 1
+            year += 1
+
+
+def archive(first_year: int, first_month: int, last_year: int, last_month: int, users: int, lines_per_month: int, seed: int = 0) -> Dict[str, str]:
+    """
+    Old log files, named as WeeelabLogs expects them
+
+    :return: File name (e.g. "log201704.txt") -> contents
+    """
+    rng = random.Random(seed)
+    names = usernames(users)
+    return {
+        f"log{year}{str(month).zfill(2)}.txt": "\n".join(month_lines(year, month, names, lines_per_month, rng=rng)) + "\n"
+        for year, month in months(first_year, first_month, last_year, last_month)
+    }
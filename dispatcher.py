@@ -0,0 +1,139 @@
+import asyncio
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, Hashable, Optional
+
+
+class Dispatcher:
+    """
+    Run jobs on a bounded pool of threads.
+    Jobs submitted with the same key (e.g. the chat ID) run one at a time, in the order they were submitted,
+    jobs with different keys run in parallel.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatcher")
+        self._lock = Lock()
+        # Jobs waiting for the one currently running with the same key
+        self.__lanes: Dict[Hashable, deque] = {}
+        self._queued = 0
+        self._in_flight = 0
+
+    def submit(self, key: Optional[Hashable], fn: Callable, *args):
+        """
+        Schedule a job
+
+        :param key: Jobs with the same key are run in order, None if it can run whenever it wants
+        :param fn: Function to call
+        :param args: Its arguments
+        """
+        if key is None:
+            self.submit_unordered(fn, *args)
+            return
+
+        with self._lock:
+            self._queued += 1
+            if key in self.__lanes:
+                # Something with this key is already running, it will pick this up when done
+                self.__lanes[key].append((fn, args))
+                return
+            self.__lanes[key] = deque()
+        self._executor.submit(self.__run_lane, key, fn, args)
+
+    def submit_unordered(self, fn: Callable, *args):
+        """
+        Schedule a job that does not have to wait for anything else, e.g. a long-running command.
+        Can be called from any thread.
+        """
+        with self._lock:
+            self._queued += 1
+        self._executor.submit(self._run, fn, args)
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Jobs submitted but not started yet
+        """
+        return self._queued
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Jobs running right now
+        """
+        return self._in_flight
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def __run_lane(self, key: Hashable, fn: Callable, args: tuple):
+        while True:
+            self._run(fn, args)
+            with self._lock:
+                lane = self.__lanes[key]
+                if len(lane) <= 0:
+                    del self.__lanes[key]
+                    return
+                fn, args = lane.popleft()
+
+    def _run(self, fn: Callable, args: tuple):
+        with self._lock:
+            self._queued -= 1
+            self._in_flight += 1
+        # noinspection PyBroadException
+        try:
+            fn(*args)
+        except:
+            print("ERROR in dispatched job!")
+            print(traceback.format_exc())
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+
+class AsyncDispatcher(Dispatcher):
+    """
+    Dispatcher for the asyncio runtime: jobs waiting for their turn are coroutines instead of entries in a queue,
+    only the jobs that are actually running take a thread (commands are blocking code, after all).
+    """
+
+    def __init__(self, workers: int, loop: asyncio.AbstractEventLoop):
+        super().__init__(workers)
+        self.__loop = loop
+        # Last job submitted with each key, the next one waits for it
+        self.__tails: Dict[Hashable, asyncio.Task] = {}
+
+    def submit(self, key: Optional[Hashable], fn: Callable, *args):
+        """
+        Schedule a job. Must be called from the event loop.
+
+        :param key: Jobs with the same key are run in order, None if it can run whenever it wants
+        :param fn: Function to call
+        :param args: Its arguments
+        """
+        with self._lock:
+            self._queued += 1
+        previous = None if key is None else self.__tails.get(key)
+        task = self.__loop.create_task(self.__run_after(previous, fn, args))
+        if key is not None:
+            self.__tails[key] = task
+            task.add_done_callback(lambda done: self.__forget(key, done))
+        return task
+
+    def shutdown(self):
+        for task in self.__tails.values():
+            task.cancel()
+        super().shutdown()
+
+    def __forget(self, key: Hashable, task: asyncio.Task):
+        if self.__tails.get(key) is task:
+            del self.__tails[key]
+
+    async def __run_after(self, previous: Optional[asyncio.Task], fn: Callable, args: tuple):
+        if previous is not None:
+            # Just wait for it to finish, errors have already been printed
+            await asyncio.wait([previous])
+        await self.__loop.run_in_executor(self._executor, self._run, fn, args)
@@ -0,0 +1,177 @@
+import select
+from threading import Event, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2 import sql
+
+from pg_pool import PgPool
+
+# Columns of the audit table, in the order WeeelabLine expects them
+AUDIT_COLUMNS = "userId, startTime, endTime, summary"
+# Minutes of a session, 0 if still in lab (endTime is NULL). Times are in seconds, the division rounds down as the
+# durations in the log files do.
+MINUTES = "COALESCE((endTime - startTime) / 60, 0)"
+
+
+class GrilloStats:
+    """
+    Statistics computed by the Grillo database, that sends back only the totals instead of every session
+    """
+
+    def __init__(self, pool: PgPool):
+        self.pool = pool
+        self.queries = 0
+
+    def __query(self, query: str, params: tuple = ()) -> list:
+        self.queries += 1
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, params)
+                    return cur.fetchall()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if isinstance(e, psycopg2.errors.QueryCanceled):
+                # statement_timeout, trying again won't help
+                raise
+            # The server may have restarted, the pool has dropped that connection: try once more with a new one
+            print(f"Grillo query failed, trying again: {e}")
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, params)
+                    return cur.fetchall()
+
+    def minutes_by_user(self, since: Optional[int] = None) -> Dict[str, int]:
+        """
+        Minutes spent in lab by each user
+
+        :param since: Count only sessions started from this timestamp, None for all of them
+        :return: Username -> minutes, people in lab right now are included even with 0 minutes
+        """
+        if since is None:
+            rows = self.__query(f"SELECT userId, SUM({MINUTES}) FROM audit GROUP BY userId")
+        else:
+            rows = self.__query(f"SELECT userId, SUM({MINUTES}) FROM audit WHERE startTime >= %s GROUP BY userId", (since,))
+        return {username: int(minutes) for username, minutes in rows}
+
+    def user_minutes(self, username: str, since: int) -> Tuple[int, int]:
+        """
+        :param username: Username
+        :param since: Start of this month, as a timestamp
+        :return: Minutes spent in lab since then, and in total
+        """
+        rows = self.__query(
+            f"SELECT COALESCE(SUM({MINUTES}) FILTER (WHERE startTime >= %s), 0), COALESCE(SUM({MINUTES}), 0) FROM audit WHERE userId = %s",
+            (since, username),
+        )
+        return int(rows[0][0]), int(rows[0][1])
+
+    def user_exists(self, username: str) -> bool:
+        return self.__query("SELECT EXISTS (SELECT 1 FROM audit WHERE userId = %s)", (username,))[0][0]
+
+    def inlab(self) -> List[Tuple[str, int]]:
+        """
+        :return: Username and login timestamp of people in lab right now, from who came first. Sessions started in
+            the previous months are included too.
+        """
+        return self.__query("SELECT userId, startTime FROM audit WHERE endTime IS NULL ORDER BY startTime")
+
+    def sessions(self, since: int, changed_since: Optional[int] = None, until: Optional[int] = None) -> Tuple[list, Optional[int]]:
+        """
+        Sessions started from a timestamp on, for /log
+
+        :param since: Timestamp
+        :param changed_since: Only sessions that started or ended from this timestamp on, None for all of them
+        :param until: Only sessions started before this timestamp, None for no limit
+        :return: Rows to build WeeelabLine from, and timestamp of the last login or logout (None if there are none)
+        """
+        where = "startTime >= %s"
+        params = (since,)
+        if changed_since is not None:
+            where += " AND (startTime >= %s OR endTime >= %s)"
+            params += (changed_since, changed_since)
+        if until is not None:
+            where += " AND startTime < %s"
+            params += (until,)
+        rows = self.__query(f"SELECT {AUDIT_COLUMNS} FROM audit WHERE {where} ORDER BY startTime", params)
+        last = None
+        for _, start, end, _ in rows:
+            last = max(last or 0, start, end or 0)
+        return rows, last
+
+
+class GrilloListener:
+    """
+    Calls a function as soon as the Grillo database sends a notification on a channel, which needs a trigger like:
+
+        CREATE FUNCTION audit_notify() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('audit', NEW.userId);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER audit_notify AFTER INSERT OR UPDATE ON audit FOR EACH ROW EXECUTE FUNCTION audit_notify();
+
+    The function is also called after every reconnection, since notifications sent in the meantime are lost.
+    """
+
+    # Seconds without notifications after which the connection is checked
+    KEEPALIVE = 60
+
+    def __init__(self, connect: Callable, channel: str, on_change: Callable[[], None]):
+        """
+        :param connect: Returns a new psycopg2 connection, this one is not shared with anything else
+        :param channel: Channel to LISTEN on
+        :param on_change: Called from the listener thread
+        """
+        self.connect = connect
+        self.channel = channel
+        self.on_change = on_change
+        self.listening = False
+        self.notifications = 0
+        self.reconnections = 0
+        self.__stop = Event()
+        Thread(target=self.__listen, name="grillo-listener", daemon=True).start()
+
+    def __changed(self):
+        try:
+            self.on_change()
+        except Exception as e:
+            print(f"Error after a Grillo notification: {e}")
+
+    def __listen(self):
+        wait = 1
+        while not self.__stop.is_set():
+            conn = None
+            try:
+                conn = self.connect()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                self.listening = True
+                self.reconnections += 1
+                wait = 1
+                self.__changed()
+                while not self.__stop.is_set():
+                    if select.select([conn], [], [], self.KEEPALIVE) == ([], [], []):
+                        # Nothing for a while, make sure the server is still there
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT 1")
+                    else:
+                        conn.poll()
+                    if len(conn.notifies) > 0:
+                        # Many logins and logouts at once are a single update
+                        self.notifications += len(conn.notifies)
+                        conn.notifies.clear()
+                        self.__changed()
+            except psycopg2.Error as e:
+                print(f"Not listening to Grillo notifications, retrying in {wait} s: {e}")
+            finally:
+                self.listening = False
+                if conn is not None:
+                    conn.close()
+            self.__stop.wait(wait)
+            wait = min(wait * 2, self.KEEPALIVE)
+
+    def stop(self):
+        self.__stop.set()
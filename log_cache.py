@@ -0,0 +1,76 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+
+@dataclass
+class CachedMonth:
+    content: bytes
+    etag: Optional[str]
+    # Username -> minutes spent in lab that month
+    minutes: Dict[str, int]
+
+
+class LogCache:
+    """
+    Old log files saved to disk with their ETag and how many minutes each user spent in lab, so that after a restart
+    they only need to be revalidated instead of downloaded and parsed again.
+    Each month is a copy of the file (log201704.txt) and a JSON file next to it (log201704.json) with the rest.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __paths(self, filename: str):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.directory, name + ".txt"), os.path.join(self.directory, name + ".json")
+
+    def load(self, filename: str) -> Optional[CachedMonth]:
+        """
+        :param filename: Log file path on ownCloud, only the name is used
+        :return: The cached month, None if it's not cached or the cache is broken
+        """
+        content_path, meta_path = self.__paths(filename)
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+            with open(content_path, "rb") as file:
+                content = file.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get("size") != len(content):
+            return None
+        return CachedMonth(content, meta.get("etag"), meta.get("minutes", {}))
+
+    def store(self, filename: str, month: CachedMonth):
+        content_path, meta_path = self.__paths(filename)
+        try:
+            # Content first and metadata last, a month without metadata isn't loaded
+            self.__write(content_path, month.content)
+            meta = {"etag": month.etag, "size": len(month.content), "minutes": month.minutes}
+            self.__write(meta_path, json.dumps(meta).encode("utf-8"))
+        except OSError as e:
+            print(f"Failed caching {filename} to {self.directory}: {e}")
+
+    @staticmethod
+    def __write(path: str, data: bytes):
+        temp = path + ".tmp"
+        with open(temp, "wb") as file:
+            file.write(data)
+        os.replace(temp, path)
+
+    def clear(self) -> int:
+        """
+        Delete every cached month
+
+        :return: How many months were deleted
+        """
+        months = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                months += 1
+            if name.endswith((".txt", ".json", ".tmp")):
+                os.remove(os.path.join(self.directory, name))
+        return months
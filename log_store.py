@@ -0,0 +1,179 @@
+from datetime import date, datetime, timedelta
+from threading import RLock
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+DATE_FORMAT = "%d/%m/%Y %H:%M"
+
+
+class ColumnarLog:
+    """
+    Log lines stored as arrays, one per field, instead of a WeeelabLine for each line: a few bytes per line instead of
+    a few hundred, and statistics are computed by numpy instead of a loop.
+    Lines can only be added. Texts are all in a single buffer, each line has the offset where its text starts.
+    """
+
+    def __init__(self):
+        self.__lock = RLock()
+        # Username <-> user id, ids are positions in this list
+        self.usernames: List[str] = []
+        self.__user_ids: Dict[str, int] = {}
+        # Lines added since the last query, they are concatenated when needed
+        self.__pending: List[tuple] = []
+        self.__text = bytearray()
+        self.user = np.zeros(0, dtype=np.int32)
+        # Minutes since 1970-01-01 00:00, local time as in the logs
+        self.start = np.zeros(0, dtype="datetime64[m]")
+        self.duration = np.zeros(0, dtype=np.int32)
+        self.inlab = np.zeros(0, dtype=np.bool_)
+        # Text of line i is __text[text_offset[i]:text_offset[i + 1]], so there's one more offset than lines
+        self.text_offset = np.zeros(1, dtype=np.int64)
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.user) + sum(len(chunk[0]) for chunk in self.__pending)
+
+    def extend(self, lines: Iterable):
+        """
+        Add lines
+
+        :param lines: WeeelabLine, or anything with the same attributes
+        """
+        with self.__lock:
+            self.__extend(lines)
+
+    def __extend(self, lines: Iterable):
+        users = []
+        starts = []
+        durations = []
+        inlab = []
+        offsets = []
+        for line in lines:
+            user_id = self.__user_ids.get(line.username)
+            if user_id is None:
+                user_id = self.__user_ids[line.username] = len(self.usernames)
+                self.usernames.append(line.username)
+            users.append(user_id)
+            # dd/mm/YYYY HH:MM to YYYY-mm-ddTHH:MM, that numpy parses by itself
+            starts.append(f"{line.time_in[6:10]}-{line.time_in[3:5]}-{line.time_in[0:2]}T{line.time_in[11:16]}")
+            durations.append(line.duration_minutes())
+            inlab.append(line.inlab)
+            self.__text += line.text.encode("utf-8")
+            offsets.append(len(self.__text))
+        if len(users) > 0:
+            self.__pending.append(
+                (
+                    np.array(users, dtype=np.int32),
+                    np.array(starts, dtype="datetime64[m]"),
+                    np.array(durations, dtype=np.int32),
+                    np.array(inlab, dtype=np.bool_),
+                    np.array(offsets, dtype=np.int64),
+                )
+            )
+
+    def __compact(self):
+        if len(self.__pending) == 0:
+            return
+        pending, self.__pending = self.__pending, []
+        self.user = np.concatenate([self.user] + [chunk[0] for chunk in pending])
+        self.start = np.concatenate([self.start] + [chunk[1] for chunk in pending])
+        self.duration = np.concatenate([self.duration] + [chunk[2] for chunk in pending])
+        self.inlab = np.concatenate([self.inlab] + [chunk[3] for chunk in pending])
+        self.text_offset = np.concatenate([self.text_offset] + [chunk[4] for chunk in pending])
+
+    @staticmethod
+    def __minute(value: Union[date, datetime]) -> np.datetime64:
+        return np.datetime64(value, "m") if isinstance(value, datetime) else np.datetime64(value, "D").astype("datetime64[m]")
+
+    def __mask(self, start: Optional[Union[date, datetime]], end: Optional[Union[date, datetime]]) -> Optional[np.ndarray]:
+        if start is None and end is None:
+            return None
+        mask = np.ones(len(self.user), dtype=np.bool_)
+        if start is not None:
+            mask &= self.start >= self.__minute(start)
+        if end is not None:
+            mask &= self.start < self.__minute(end)
+        return mask
+
+    def __sums(self, start, end) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: Minutes and number of lines for each user id
+        """
+        self.__compact()
+        mask = self.__mask(start, end)
+        users = self.user if mask is None else self.user[mask]
+        durations = self.duration if mask is None else self.duration[mask]
+        sums = np.bincount(users, weights=durations, minlength=len(self.usernames)).astype(np.int64)
+        return sums, np.bincount(users, minlength=len(self.usernames))
+
+    def minutes_by_user(self, start: Optional[Union[date, datetime]] = None, end: Optional[Union[date, datetime]] = None) -> Dict[str, int]:
+        """
+        Minutes spent in lab by each user, counting lines with login time from start (included) to end (excluded)
+
+        :param start: None for no limit
+        :param end: None for no limit
+        :return: Username -> minutes, for users that have at least a line in that period
+        """
+        with self.__lock:
+            sums, lines = self.__sums(start, end)
+            return {self.usernames[user_id]: int(sums[user_id]) for user_id in np.flatnonzero(lines)}
+
+    def user_minutes(self, username: str, start: Optional[Union[date, datetime]] = None, end: Optional[Union[date, datetime]] = None) -> int:
+        with self.__lock:
+            user_id = self.__user_ids.get(username)
+            if user_id is None:
+                return 0
+            self.__compact()
+            mask = self.user == user_id
+            period = self.__mask(start, end)
+            if period is not None:
+                mask &= period
+            return int(self.duration[mask].sum())
+
+    def top(self, n: int, start: Optional[Union[date, datetime]] = None, end: Optional[Union[date, datetime]] = None) -> List[Tuple[str, int]]:
+        """
+        :return: (username, minutes) of the n users with most minutes in that period, most minutes first
+        """
+        with self.__lock:
+            sums, lines = self.__sums(start, end)
+            n = min(n, len(sums))
+            if n <= 0:
+                return []
+            best = np.argpartition(-sums, n - 1)[:n]
+            best = best[np.argsort(-sums[best], kind="stable")]
+            return [(self.usernames[user_id], int(sums[user_id])) for user_id in best if lines[user_id] > 0]
+
+    def has_user(self, username: str) -> bool:
+        with self.__lock:
+            return username in self.__user_ids
+
+    def text(self, i: int) -> str:
+        with self.__lock:
+            self.__compact()
+            return bytes(self.__text[self.text_offset[i] : self.text_offset[i + 1]]).decode("utf-8")
+
+    def line(self, i: int) -> str:
+        """
+        :return: Line i, in the same format as the log files
+        """
+        with self.__lock:
+            self.__compact()
+            time_in = self.start[i].astype(datetime)
+            username = self.usernames[self.user[i]]
+            inlab = self.inlab[i]
+            minutes = int(self.duration[i])
+        if inlab:
+            return f"[{time_in.strftime(DATE_FORMAT)}] [INLAB] [INLAB] <{username}> ::"
+        time_out = time_in + timedelta(minutes=minutes)
+        duration = f"{minutes // 60:02d}:{minutes % 60:02d}"
+        return f"[{time_in.strftime(DATE_FORMAT)}] [{time_out.strftime(DATE_FORMAT)}] [{duration}] <{username}> :: {self.text(i)}"
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory used by the arrays and the text buffer, not counting the usernames
+        """
+        with self.__lock:
+            self.__compact()
+            return self.user.nbytes + self.start.nbytes + self.duration.nbytes + self.inlab.nbytes + self.text_offset.nbytes + len(self.__text)
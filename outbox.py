@@ -0,0 +1,271 @@
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from copy import copy
+from dataclasses import dataclass
+from enum import IntEnum
+from threading import Condition, Thread
+from time import monotonic
+from typing import Deque, Dict, List, Optional
+
+
+class Priority(IntEnum):
+    """
+    Lower goes first
+    """
+
+    INTERACTIVE = 0  # Replies to commands, someone is waiting for them
+    BROADCAST = 1  # Birthdays, reminders, stats...
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, with bursts of up to capacity requests
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def __refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """
+        :return: Seconds until a token is available, 0 if there's one right now
+        """
+        self.__refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self.__refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self.__refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class OutboxStats:
+    """
+    Messages that went through the outbox with a single priority
+    """
+
+    sent: int = 0
+    coalesced: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    def add(self, wait: float):
+        self.sent += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    @property
+    def average_wait(self) -> float:
+        return self.total_wait / self.sent if self.sent > 0 else 0.0
+
+
+class _Job:
+    def __init__(self, seq: int, priority: Priority, method: str, kwargs: dict):
+        self.seq = seq
+        self.priority = priority
+        self.method = method
+        self.kwargs = kwargs
+        self.enqueued = monotonic()
+        # Edits merged into this one get their result from here too
+        self.futures: List[Future] = [Future()]
+
+
+class Outbox:
+    """
+    Sits in front of a BotHandler and sends messages no faster than Telegram allows (about 1 message per second in
+    each chat, 20 per minute in groups, 30 per second overall), instead of getting 429s.
+
+    Messages to the same chat are sent in order, interactive replies go before broadcasts, and consecutive edits to
+    the same message are merged into one.
+    Everything else (get_updates, leave_chat, active_sessions, ...) goes straight to the bot.
+    """
+
+    def __init__(
+        self,
+        bot,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        group_rate: float = 20 / 60,
+        burst: float = 3.0,
+        senders: int = 4,
+    ):
+        """
+        :param bot: BotHandler, or anything that looks like it
+        :param global_rate: Messages per second, in total
+        :param chat_rate: Messages per second to each private chat
+        :param group_rate: Messages per second to each group
+        :param burst: Messages that can be sent to a chat at once before rate limits kick in
+        :param senders: Messages sent in parallel (to different chats)
+        """
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.__global_bucket = TokenBucket(global_rate, max(1.0, burst))
+        self.__chat_buckets: Dict[int, TokenBucket] = {}
+        self.__queues: Dict[int, Deque[_Job]] = {}
+        # Chats with a message being sent right now, the next one has to wait for it
+        self.__sending = set()
+        self.__condition = Condition()
+        self.__seq = 0
+        self.__stats: Dict[Priority, OutboxStats] = {priority: OutboxStats() for priority in Priority}
+        self.__executor = ThreadPoolExecutor(max_workers=senders, thread_name_prefix="outbox")
+        Thread(target=self.__schedule, name="outbox", daemon=True).start()
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def send_message(self, chat_id, text, *args, priority: Priority = Priority.INTERACTIVE, wait: bool = True, **kwargs):
+        """
+        Same as BotHandler.send_message
+
+        :param priority: Priority of the message
+        :param wait: Wait until it is sent and return the result, False to return immediately
+        """
+        return self.__enqueue(chat_id, priority, wait, "send_message", dict(chat_id=chat_id, text=text), args, kwargs)
+
+    def send_photo(self, chat_id, photo, *args, priority: Priority = Priority.INTERACTIVE, wait: bool = True, **kwargs):
+        """
+        Same as BotHandler.send_photo
+        """
+        return self.__enqueue(chat_id, priority, wait, "send_photo", dict(chat_id=chat_id, photo=photo), args, kwargs)
+
+    def edit_message(self, chat_id, message_id, *args, priority: Priority = Priority.INTERACTIVE, wait: bool = True, **kwargs):
+        """
+        Same as BotHandler.edit_message. If the previous message waiting for this chat is an edit to the same
+        message, that edit is replaced with this one.
+        """
+        return self.__enqueue(chat_id, priority, wait, "edit_message", dict(chat_id=chat_id, message_id=message_id), args, kwargs)
+
+    def get_outbox_stats(self) -> Dict[Priority, OutboxStats]:
+        with self.__condition:
+            return {priority: copy(stats) for priority, stats in self.__stats.items()}
+
+    @property
+    def queue_depth(self) -> int:
+        with self.__condition:
+            return sum(len(queue) for queue in self.__queues.values())
+
+    def __enqueue(self, chat_id: int, priority: Priority, wait: bool, method: str, kwargs: dict, args: tuple, more_kwargs: dict):
+        # Positional arguments are named here, so edits can be merged
+        names = {
+            "send_message": ("parse_mode", "disable_notification", "disable_web_page_preview", "reply_markup"),
+            "send_photo": ("caption", "parse_mode", "disable_notification", "reply_markup"),
+            "edit_message": ("text", "reply_markup", "parse_mode", "disable_web_page_preview"),
+        }[method]
+        kwargs.update(zip(names, args))
+        kwargs.update(more_kwargs)
+
+        with self.__condition:
+            queue = self.__queues.setdefault(chat_id, deque())
+            last = queue[-1] if len(queue) > 0 else None
+            if (
+                method == "edit_message"
+                and last is not None
+                and last.method == "edit_message"
+                and last.kwargs["message_id"] == kwargs["message_id"]
+                and kwargs.get("text") is not None
+            ):
+                # Nobody will ever see the previous text, only send the latest one
+                last.kwargs = kwargs
+                last.priority = min(last.priority, priority)
+                future = Future()
+                last.futures.append(future)
+                self.__stats[priority].coalesced += 1
+            else:
+                self.__seq += 1
+                job = _Job(self.__seq, priority, method, kwargs)
+                queue.append(job)
+                future = job.futures[0]
+                self.__condition.notify()
+
+        if wait:
+            return future.result()
+        return None
+
+    def __bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.__chat_buckets.get(chat_id)
+        if bucket is None:
+            # Groups and channels have negative IDs
+            bucket = TokenBucket(self.group_rate if chat_id < 0 else self.chat_rate, self.burst)
+            self.__chat_buckets[chat_id] = bucket
+        return bucket
+
+    def __next_job(self, now: float) -> (Optional[_Job], Optional[float]):
+        """
+        Pick the next message that can be sent right now
+
+        :return: The job and None, or None and how long to wait for one (None if there's nothing to wait for)
+        """
+        best = None
+        wait = None
+        for chat_id, queue in self.__queues.items():
+            if len(queue) <= 0 or chat_id in self.__sending:
+                continue
+            delay = self.__bucket(chat_id).delay(now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            job = queue[0]
+            if best is None or (job.priority, job.seq) < (best[1].priority, best[1].seq):
+                best = (chat_id, job)
+
+        if best is None:
+            return None, wait
+        delay = self.__global_bucket.delay(now)
+        if delay > 0:
+            return None, delay
+
+        chat_id, job = best
+        self.__queues[chat_id].popleft()
+        self.__bucket(chat_id).take(now)
+        self.__global_bucket.take(now)
+        self.__sending.add(chat_id)
+        return job, None
+
+    def __forget_idle(self, now: float):
+        for chat_id in [c for c, q in self.__queues.items() if len(q) <= 0 and c not in self.__sending]:
+            del self.__queues[chat_id]
+        for chat_id in [c for c, b in self.__chat_buckets.items() if c not in self.__queues and b.full(now)]:
+            del self.__chat_buckets[chat_id]
+
+    def __schedule(self):
+        while True:
+            with self.__condition:
+                now = monotonic()
+                job, wait = self.__next_job(now)
+                if job is None:
+                    if len(self.__chat_buckets) > 1000:
+                        self.__forget_idle(now)
+                    self.__condition.wait(wait)
+                    continue
+                self.__stats[job.priority].add(now - job.enqueued)
+            self.__executor.submit(self.__send, job)
+
+    def __send(self, job: _Job):
+        result = None
+        # noinspection PyBroadException
+        try:
+            result = getattr(self.bot, job.method)(**job.kwargs)
+        except:
+            print("ERROR while sending a message!")
+            print(traceback.format_exc())
+        finally:
+            with self.__condition:
+                self.__sending.discard(job.kwargs["chat_id"])
+                self.__condition.notify()
+            for future in job.futures:
+                future.set_result(result)
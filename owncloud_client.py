@@ -0,0 +1,45 @@
+import datetime
+from email.utils import parsedate_to_datetime
+from typing import Optional, Tuple
+from urllib import parse
+
+import owncloud
+
+
+class OwnCloudClient(owncloud.Client):
+    """
+    owncloud.Client, plus the few WebDAV features it does not expose
+    """
+
+    def __file_url(self, path: str) -> str:
+        return self._webdav_url + parse.quote(self._encode_string(self._normalize_path(path)))
+
+    def get_file_range(self, path: str, start: int, etag: Optional[str]) -> Optional[Tuple[bytes, Optional[str], datetime.datetime, int]]:
+        """
+        Download a file, or just its end, unless it still has the same ETag
+
+        :param path: Path to the remote file
+        :param start: Byte to start from, 0 for the whole file
+        :param etag: ETag from the last download, None to download it anyway
+        :return: None if not modified, else contents, new ETag, last modified time (UTC, naive) and the byte where the
+                 contents start: this is 0 if the server sent the whole file instead
+        :raises: HTTPResponseError in case an HTTP error status was returned
+        """
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if start > 0:
+            headers["Range"] = f"bytes={start}-"
+        res = self._session.get(self.__file_url(path), headers=headers)
+        if res.status_code == 304:
+            return None
+        if res.status_code == 416:
+            # The file is shorter than that, so it's not the same file anymore
+            return self.get_file_range(path, 0, None)
+        if res.status_code >= 400:
+            raise owncloud.owncloud.HTTPResponseError(res)
+        if "Last-Modified" in res.headers:
+            last_modified = parsedate_to_datetime(res.headers["Last-Modified"]).astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        else:
+            last_modified = self.file_info(path).get_last_modified()
+        return res.content, res.headers.get("ETag"), last_modified, start if res.status_code == 206 else 0
@@ -0,0 +1,227 @@
+from contextlib import contextmanager
+from copy import copy
+from dataclasses import dataclass
+from threading import Condition
+from time import monotonic
+from typing import Callable, List, Tuple
+
+import psycopg2
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+@dataclass
+class PoolStats:
+    """
+    What happened in a PgPool since it was created
+    """
+
+    checkouts: int = 0
+    # Checkouts that had to wait for another thread to give back a connection
+    waits: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+    timeouts: int = 0
+    connections_opened: int = 0
+    # Connections that couldn't be opened
+    failures: int = 0
+    # Connections thrown away because they were broken, e.g. the server restarted
+    discarded: int = 0
+    size: int = 0
+    idle: int = 0
+
+    def add_wait(self, wait: float):
+        self.waits += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    @property
+    def average_wait(self) -> float:
+        return self.total_wait / self.waits if self.waits > 0 else 0.0
+
+
+class PgPool:
+    """
+    A pool of psycopg2 connections, shared by all the threads. Connections are opened when needed up to max_size,
+    and those in excess of min_size are closed after a while if nobody uses them.
+    A connection that has been idle for a while is checked before being handed out, and replaced if it doesn't work.
+    """
+
+    def __init__(
+        self,
+        connect: Callable,
+        min_size: int = 1,
+        max_size: int = 4,
+        statement_timeout_ms: int = 10000,
+        checkout_timeout: float = 10,
+        check_after: float = 30,
+        max_idle: float = 300,
+    ):
+        """
+        :param connect: Returns a new psycopg2 connection
+        :param min_size: Connections kept open even if unused
+        :param max_size: Connections open at most, then threads wait for one to be given back
+        :param statement_timeout_ms: Queries taking longer than this are cancelled by the server, 0 for no limit
+        :param checkout_timeout: Seconds to wait for a connection before giving up with PoolTimeoutError
+        :param check_after: Seconds of idleness after which a connection is tested with "SELECT 1" before being used
+        :param max_idle: Seconds of idleness after which a connection is closed, if there are more than min_size
+        """
+        self.__connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_timeout_ms = statement_timeout_ms
+        self.checkout_timeout = checkout_timeout
+        self.check_after = check_after
+        self.max_idle = max_idle
+        self.__condition = Condition()
+        # (connection, when it was given back), most recently used last
+        self.__idle: List[Tuple[object, float]] = []
+        # Open connections, idle or in use, plus those being opened
+        self.__size = 0
+        self.__closed = False
+        self.__stats = PoolStats()
+
+    def __open(self):
+        try:
+            conn = self.__connect()
+            with conn.cursor() as cur:
+                cur.execute("SET statement_timeout = %s", (self.statement_timeout_ms,))
+            conn.commit()
+        except psycopg2.Error:
+            with self.__condition:
+                self.__size -= 1
+                self.__stats.failures += 1
+                self.__condition.notify()
+            raise
+        with self.__condition:
+            self.__stats.connections_opened += 1
+        return conn
+
+    def __discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self.__condition:
+            self.__size -= 1
+            self.__stats.discarded += 1
+            self.__condition.notify()
+
+    def __check_idle(self):
+        """
+        One connection broke, probably the others did too: check each one before using it again
+        """
+        with self.__condition:
+            self.__idle = [(conn, float("-inf")) for conn, _ in self.__idle]
+
+    @staticmethod
+    def __works(conn) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def __checkout(self):
+        start = monotonic()
+        waited = False
+        with self.__condition:
+            while True:
+                if len(self.__idle) > 0:
+                    conn, since = self.__idle.pop()
+                    break
+                if self.__size < self.max_size:
+                    self.__size += 1
+                    conn, since = None, None
+                    break
+                remaining = self.checkout_timeout - (monotonic() - start)
+                if remaining <= 0:
+                    self.__stats.timeouts += 1
+                    raise PoolTimeoutError(f"No database connection available in {self.checkout_timeout} seconds")
+                waited = True
+                self.__condition.wait(remaining)
+            self.__stats.checkouts += 1
+            if waited:
+                self.__stats.add_wait(monotonic() - start)
+
+        if conn is None:
+            return self.__open()
+        if conn.closed or (monotonic() - since > self.check_after and not self.__works(conn)):
+            self.__discard(conn)
+            with self.__condition:
+                self.__size += 1
+            return self.__open()
+        return conn
+
+    def __checkin(self, conn):
+        now = monotonic()
+        expired = []
+        with self.__condition:
+            if self.__closed:
+                expired.append(conn)
+            else:
+                self.__idle.append((conn, now))
+            # The least recently used ones are at the start
+            while self.__size - len(expired) > self.min_size and len(self.__idle) > 1 and now - self.__idle[0][1] > self.max_idle:
+                expired.append(self.__idle.pop(0)[0])
+            self.__size -= len(expired)
+            self.__condition.notify()
+        for old in expired:
+            old.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection, e.g.
+
+            with pool.connection() as conn:
+                with conn.cursor() as cur:
+                    ...
+
+        The transaction is committed if nothing goes wrong, rolled back otherwise. If the connection breaks, it's
+        thrown away and the next one will be a new one.
+
+        :raises PoolTimeoutError: if all connections are busy for checkout_timeout seconds
+        :raises psycopg2.Error: if the connection cannot be opened
+        """
+        conn = self.__checkout()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            # Not "with conn", rolling back a broken connection would hide what went wrong
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+            # A query cancelled by statement_timeout leaves the connection usable, a restarted server doesn't
+            if conn.closed:
+                self.__discard(conn)
+                self.__check_idle()
+            else:
+                self.__checkin(conn)
+            raise
+        self.__checkin(conn)
+
+    def get_stats(self) -> PoolStats:
+        with self.__condition:
+            stats = copy(self.__stats)
+            stats.size = self.__size
+            stats.idle = len(self.__idle)
+        return stats
+
+    def close(self):
+        """
+        Close the idle connections, those in use are closed when given back
+        """
+        with self.__condition:
+            idle, self.__idle = self.__idle, []
+            self.__size -= len(idle)
+            self.__closed = True
+        for conn, _ in idle:
+            conn.close()
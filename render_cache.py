@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from copy import copy
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, Dict, Hashable
+
+
+@dataclass
+class RenderStats:
+    """
+    Lookups in the RenderCache for a single command
+    """
+
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+class RenderCache:
+    """
+    Messages already built by a command, by the versions of everything they were built from. When something changes,
+    its version changes too, so old messages are never found again: they are simply pushed out by the new ones.
+    """
+
+    def __init__(self, size: int = 16):
+        """
+        :param size: Messages kept for each command, the least recently used are dropped
+        """
+        self.size = size
+        self.__lock = Lock()
+        self.__entries: Dict[str, OrderedDict] = {}
+        self.__stats: Dict[str, RenderStats] = {}
+
+    def get(self, name: str, key: Hashable, render: Callable):
+        """
+        Get a message, building it only if it isn't there already
+
+        :param name: Command
+        :param key: Versions of the data and anything else the message depends on
+        :param render: Builds the message, called without holding the lock
+        :return: What render returned, now or some time ago
+        """
+        with self.__lock:
+            entries = self.__entries.setdefault(name, OrderedDict())
+            stats = self.__stats.setdefault(name, RenderStats())
+            if key in entries:
+                entries.move_to_end(key)
+                stats.hits += 1
+                return entries[key]
+            stats.misses += 1
+
+        # Two threads may build the same message at once, nothing bad happens
+        value = render()
+        with self.__lock:
+            entries[key] = value
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+        return value
+
+    def clear(self) -> int:
+        """
+        :return: Messages deleted
+        """
+        with self.__lock:
+            deleted = sum(len(entries) for entries in self.__entries.values())
+            self.__entries = {}
+        return deleted
+
+    def get_stats(self) -> Dict[str, RenderStats]:
+        with self.__lock:
+            return {name: copy(stats) for name, stats in self.__stats.items()}
@@ -0,0 +1,178 @@
+from copy import copy
+from dataclasses import dataclass, field
+from enum import Enum
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+
+class Latency(Enum):
+    """
+    How long a command is expected to take
+    """
+
+    INSTANT = "instant"  # Only local data or caches
+    BACKEND = "backend"  # Waits for LDAP, ownCloud, T.A.R.A.L.L.O., ...
+    SLOW = "slow"  # Seconds or minutes: SSH, waiting for a machine to boot, ...
+
+
+@dataclass
+class RouteStats:
+    """
+    Times a single command or callback has been handled
+    """
+
+    calls: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    def add(self, seconds: float):
+        self.calls += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    @property
+    def average_seconds(self) -> float:
+        return self.total_seconds / self.calls if self.calls > 0 else 0.0
+
+
+@dataclass
+class Route:
+    """
+    A command (e.g. "/log") or a family of callbacks (e.g. everything that starts with "wol_")
+
+    fn is called as fn(handler, ctx, *args) for commands, fn(handler, ctx, data) for callbacks.
+    """
+
+    name: str
+    fn: Callable
+    min_args: int = 0
+    # Words after this are ignored, None for no limit
+    max_args: Optional[int] = 0
+    # Too many words is an error too, instead of ignoring the rest
+    strict: bool = False
+    # Reply to send, or fn(handler, ctx) to call, when the arguments are wrong
+    usage: Union[str, Callable, None] = None
+    # Only informative: the handler itself checks permissions and replies accordingly
+    admin_only: bool = False
+    # Heavy commands don't hold up the other messages from the same chat
+    heavy: bool = False
+    latency: Latency = Latency.BACKEND
+    stats: RouteStats = field(default_factory=RouteStats)
+
+
+class Router:
+    """
+    Finds the function that handles a command or a button press.
+    Commands are looked up in a dict, callbacks by their prefix.
+    """
+
+    def __init__(self, bot_username: str):
+        """
+        :param bot_username: "/command@bot_username" is the same as "/command"
+        """
+        self.__suffix = "@" + bot_username
+        self.commands: Dict[str, Route] = {}
+        self.callbacks: Dict[str, Route] = {}
+        # Distinct lengths of callback prefixes, longest first
+        self.__prefix_lengths: List[int] = []
+        self.__lock = Lock()
+
+    def command(self, name: str, **metadata):
+        """
+        Decorator to register a command, see Route for metadata
+
+        :param name: Command, with the slash
+        """
+
+        def decorator(fn: Callable):
+            self.add_command(name, fn, **metadata)
+            return fn
+
+        return decorator
+
+    def callback(self, prefix: str, **metadata):
+        """
+        Decorator to register callbacks, see Route for metadata
+
+        :param prefix: Callback data starts with this
+        """
+
+        def decorator(fn: Callable):
+            self.add_callback(prefix, fn, **metadata)
+            return fn
+
+        return decorator
+
+    def add_command(self, name: str, fn: Callable, **metadata):
+        if name in self.commands:
+            raise ValueError(f"Command {name} registered twice")
+        self.commands[name] = Route(name, fn, **metadata)
+
+    def add_callback(self, prefix: str, fn: Callable, **metadata):
+        if prefix in self.callbacks:
+            raise ValueError(f"Callback prefix {prefix} registered twice")
+        self.callbacks[prefix] = Route(prefix, fn, **metadata)
+        self.__prefix_lengths = sorted({len(p) for p in self.callbacks}, reverse=True)
+
+    def parse(self, text: str) -> Tuple[str, List[str]]:
+        """
+        Split a message into command and arguments
+
+        :return: Command without the bot username, and the other words
+        """
+        words = text.split()
+        if len(words) <= 0:
+            return "", []
+        name = words[0]
+        if name.endswith(self.__suffix):
+            name = name[: -len(self.__suffix)]
+        return name, words[1:]
+
+    def find_command(self, name: str) -> Optional[Route]:
+        return self.commands.get(name)
+
+    def find_callback(self, data: str) -> Optional[Route]:
+        """
+        :param data: Callback data
+        :return: Route with the longest prefix matching it, if any
+        """
+        for length in self.__prefix_lengths:
+            route = self.callbacks.get(data[:length])
+            if route is not None:
+                return route
+        return None
+
+    def check_args(self, route: Route, args: List[str]) -> Optional[List[str]]:
+        """
+        :return: Arguments to pass, None if they're wrong
+        """
+        if len(args) < route.min_args:
+            return None
+        if route.max_args is not None and len(args) > route.max_args:
+            if route.strict:
+                return None
+            return args[: route.max_args]
+        return args
+
+    def run(self, route: Route, handler, ctx, *args):
+        start = monotonic()
+        try:
+            route.fn(handler, ctx, *args)
+        finally:
+            elapsed = monotonic() - start
+            with self.__lock:
+                route.stats.add(elapsed)
+
+    def usage(self, route: Route, handler, ctx):
+        if route.usage is None:
+            ctx.reply(f"Wrong arguments for {route.name}, type /help for list of commands")
+        elif isinstance(route.usage, str):
+            ctx.reply(route.usage)
+        else:
+            route.usage(handler, ctx)
+
+    def get_stats(self) -> Dict[str, RouteStats]:
+        with self.__lock:
+            routes = list(self.commands.values()) + list(self.callbacks.values())
+            return {route.name: copy(route.stats) for route in routes if route.stats.calls > 0}
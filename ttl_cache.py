@@ -0,0 +1,224 @@
+from collections import OrderedDict
+from copy import copy
+from dataclasses import dataclass
+from threading import Condition, Thread
+from time import time
+from typing import Any, Callable, Dict, Hashable, Optional, Union
+
+
+@dataclass
+class CacheStats:
+    """
+    Lookups in a TtlCache
+    """
+
+    hits: int = 0
+    # Expired values returned while they were loaded again in the background
+    stale_hits: int = 0
+    misses: int = 0
+    loads: int = 0
+    load_failures: int = 0
+    evictions: int = 0
+    size: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.stale_hits + self.misses
+        return (self.hits + self.stale_hits) / total if total > 0 else 0.0
+
+
+@dataclass
+class _Entry:
+    value: Any
+    loaded_at: float
+    # Don't try loading it again in the background before this time, set after a failure
+    retry_at: float = 0.0
+
+
+class _Load:
+    """
+    A load in progress, for the threads waiting for it
+    """
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.done = False
+        self.value = None
+        self.error = None
+
+
+class TtlCache:
+    """
+    Values from a slow backend (LDAP, ownCloud, Grillo), kept for some time. Threads that ask for the same missing
+    value at once wait for a single load. With stale_while_revalidate, expired values are still returned while a
+    thread loads them again, so nobody waits after the first time.
+    """
+
+    # Seconds before loading in the background again, after it failed
+    RETRY_AFTER = 30
+
+    def __init__(
+        self,
+        name: str,
+        load: Callable,
+        ttl: Union[float, Callable[[], float]],
+        max_size: Optional[int] = None,
+        stale_while_revalidate: bool = False,
+        on_store: Optional[Callable[[Hashable, Any], None]] = None,
+    ):
+        """
+        :param name: Shown in /status
+        :param load: Called as load(key, previous value or None, *args) without holding the lock, returns the value
+        :param ttl: Seconds a value stays fresh, or a function that returns them
+        :param max_size: Values kept at most, the least recently used are dropped. None for no limit
+        :param stale_while_revalidate: Return expired values right away and load them again in the background
+        :param on_store: Called as on_store(key, value) with the lock held, right after a new value is stored
+        """
+        self.name = name
+        self.load = load
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stale_while_revalidate = stale_while_revalidate
+        self.on_store = on_store
+        self.__lock = Condition()
+        self.__entries: OrderedDict = OrderedDict()
+        self.__loading: Dict[Hashable, _Load] = {}
+        # Loads started before delete_cache don't store what they got
+        self.__generation = 0
+        self.__stats = CacheStats()
+
+    def get(self, key: Hashable = None, *args):
+        """
+        Get a value, loading it if it's missing or expired
+
+        :param key: Key, None if the cache holds a single value
+        :param args: Passed to load, if it's called by this thread or by the one started here
+        :return: The value
+        :raises: whatever load raised, if there was no value to return instead
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                self.__entries.move_to_end(key)
+                if not self.__expired(entry):
+                    self.__stats.hits += 1
+                    return entry.value
+                if self.stale_while_revalidate:
+                    self.__stats.stale_hits += 1
+                    if key not in self.__loading and time() >= entry.retry_at:
+                        loading = self.__start(key)
+                        Thread(target=self.__revalidate, args=(key, loading, entry.value, args), name=f"{self.name}-cache", daemon=True).start()
+                    return entry.value
+            self.__stats.misses += 1
+        return self.refresh(key, *args)
+
+    def refresh(self, key: Hashable = None, *args):
+        """
+        Load a value now, even if it's still fresh. If it's already being loaded, wait for that instead.
+
+        :return: The new value
+        """
+        with self.__lock:
+            loading = self.__loading.get(key)
+            if loading is not None:
+                while not loading.done:
+                    self.__lock.wait()
+                if loading.error is not None:
+                    raise loading.error
+                return loading.value
+            loading = self.__start(key)
+            entry = self.__entries.get(key)
+        return self.__run(key, loading, None if entry is None else entry.value, args)
+
+    def __start(self, key: Hashable) -> _Load:
+        loading = _Load(self.__generation)
+        self.__loading[key] = loading
+        return loading
+
+    def __run(self, key: Hashable, loading: _Load, old, args: tuple):
+        try:
+            value = self.load(key, old, *args)
+        except BaseException as e:
+            # LDAP errors are BaseException, the waiting threads have to get them too
+            with self.__lock:
+                self.__stats.load_failures += 1
+                if not self.stale_while_revalidate:
+                    # Don't return it again as if nothing happened
+                    self.__entries.pop(key, None)
+                self.__finish(key, loading, None, e)
+            raise
+        with self.__lock:
+            self.__stats.loads += 1
+            if loading.generation == self.__generation:
+                self.__store(key, value)
+            self.__finish(key, loading, value, None)
+        return value
+
+    def __revalidate(self, key: Hashable, loading: _Load, old, args: tuple):
+        try:
+            self.__run(key, loading, old, args)
+        except BaseException as e:
+            print(f"Failed loading {self.name} again, keeping the old one: {e}")
+            with self.__lock:
+                entry = self.__entries.get(key)
+                if entry is not None:
+                    entry.retry_at = time() + self.RETRY_AFTER
+
+    def __finish(self, key: Hashable, loading: _Load, value, error: Optional[BaseException]):
+        # Call with the lock held
+        loading.value = value
+        loading.error = error
+        loading.done = True
+        if self.__loading.get(key) is loading:
+            del self.__loading[key]
+        self.__lock.notify_all()
+
+    def __expired(self, entry: _Entry) -> bool:
+        ttl = self.ttl() if callable(self.ttl) else self.ttl
+        return time() - entry.loaded_at >= ttl
+
+    def is_fresh(self, key: Hashable = None) -> bool:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            return entry is not None and not self.__expired(entry)
+
+    def peek(self, key: Hashable = None):
+        """
+        :return: The value, even if expired, or None if there's none. Nothing is loaded.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            return None if entry is None else entry.value
+
+    def put(self, key: Hashable, value):
+        """
+        Store a value loaded some other way, as fresh
+        """
+        with self.__lock:
+            self.__store(key, value)
+
+    def __store(self, key: Hashable, value):
+        # Call with the lock held
+        self.__entries[key] = _Entry(value, time())
+        self.__entries.move_to_end(key)
+        while self.max_size is not None and len(self.__entries) > self.max_size:
+            self.__entries.popitem(last=False)
+            self.__stats.evictions += 1
+        if self.on_store is not None:
+            self.on_store(key, value)
+
+    def delete_cache(self) -> int:
+        """
+        :return: Values deleted
+        """
+        with self.__lock:
+            busted = len(self.__entries)
+            self.__entries = OrderedDict()
+            self.__generation += 1
+        return busted
+
+    def get_stats(self) -> CacheStats:
+        with self.__lock:
+            stats = copy(self.__stats)
+            stats.size = len(self.__entries)
+        return stats
@@ -22,9 +22,21 @@ QUOTES_GAME_PATH = os.environ.get("QUOTES_GAME_PATH")
 DEMOTIVATIONAL_PATH = os.environ.get("DEMOTIVATIONAL_PATH")
 # base path
 LOG_BASE = os.environ.get("LOG_BASE")
+LOG_CACHE_DIR = os.environ.get("LOG_CACHE_DIR")  # /var/cache/weeelab-bot, old logs are saved there to be loaded faster after a restart
+OLD_LOGS_WORKERS = int(os.environ.get("OLD_LOGS_WORKERS", 8))  # old log files downloaded at the same time
+LOG_STORE = os.environ.get("LOG_STORE", "objects")  # objects, columnar (old logs stored as numpy arrays, uses less memory)
+LOG_REFRESH_SECONDS = int(os.environ.get("LOG_REFRESH_SECONDS", 30))  # log.txt is downloaded in the background this often, 0 to download it only when needed
 # path of the file to store bot users in OwnCloud (/folder/file.txt)
 USER_BOT_PATH = os.environ.get("USER_BOT_PATH")
 TOKEN_BOT = os.environ.get("TOKEN_BOT")  # Telegram token for the bot API
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", 8))  # threads handling commands, one chat is handled by a single thread at a time
+BOT_RUNTIME = os.environ.get("BOT_RUNTIME", "threads")  # threads, asyncio (Telegram requests are made on an event loop)
+BOT_INGESTION = os.environ.get("BOT_INGESTION", "polling")  # polling, webhook (Telegram sends updates to WEBHOOK_URL)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # https://bot.example.com/telegram, a reverse proxy forwards it to WEBHOOK_HOST:WEBHOOK_PORT
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # random string, 1-256 characters: A-Z, a-z, 0-9, _ and -
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/")  # path part of WEBHOOK_URL, as seen by the bot after the proxy
 TARALLO = os.environ.get("TARALLO")  # tarallo URL
 TARALLO_TOKEN = os.environ.get("TARALLO_TOKEN")  # tarallo token
 
@@ -68,3 +80,7 @@ GRILLO_DB_PORT = int(os.environ.get("GRILLO_DB_PORT"))
 GRILLO_DB_NAME = os.environ.get("GRILLO_DB_NAME")
 GRILLO_DB_USER = os.environ.get("GRILLO_DB_USER")
 GRILLO_DB_PASS = os.environ.get("GRILLO_DB_PASS")
+GRILLO_DB_POOL_MIN = int(os.environ.get("GRILLO_DB_POOL_MIN", 1))  # connections kept open even when idle
+GRILLO_DB_POOL_MAX = int(os.environ.get("GRILLO_DB_POOL_MAX", 4))  # connections shared by all commands
+GRILLO_DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("GRILLO_DB_STATEMENT_TIMEOUT_MS", 10000))  # queries taking longer are cancelled
+GRILLO_DB_NOTIFY_CHANNEL = os.environ.get("GRILLO_DB_NOTIFY_CHANNEL")  # audit, if a trigger on the audit table sends notifications there
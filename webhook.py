@@ -0,0 +1,115 @@
+import hmac
+import json
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from typing import Callable, Optional
+
+
+class WebhookServer:
+    """
+    Receives updates from Telegram as HTTP POSTs, instead of polling for them.
+    Put it behind a reverse proxy that does TLS, Telegram only talks to HTTPS webhooks.
+    """
+
+    # Telegram sends the secret_token given to setWebhook in this header
+    SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+    def __init__(self, on_update: Callable[[dict], None], secret: str, host: str = "127.0.0.1", port: int = 8443, path: str = "/"):
+        """
+        :param on_update: Called with each update, from the server thread: it should just schedule it and return
+        :param secret: Requests without this secret token are refused. It's required: without it anyone who can reach
+                       the webhook could send updates as any user, admins included
+        :param host: Address to listen on
+        :param port: Port to listen on, 0 for any free port
+        :param path: Only accept updates on this path
+        """
+        if not secret:
+            raise ValueError("A webhook without a secret token would accept updates from anyone")
+        self.on_update = on_update
+        self.secret = secret
+        self.path = path
+        self.received = 0
+        self.duplicates = 0
+        self.refused = 0
+        self.__lock = Lock()
+        # Telegram sends an update again if it did not get a response in time, remember the last few
+        self.__recent_ids = set()
+        self.__recent_order = deque()
+
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                self.__respond(webhook.handle(self.path, self.headers.get(WebhookServer.SECRET_HEADER), body))
+
+            def do_GET(self):
+                self.__respond(405)
+
+            def __respond(self, status: int):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def serve_forever(self):
+        print(f"Webhook listening on port {self.port}")
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, path: str, secret: Optional[str], body: bytes) -> int:
+        """
+        Handle a request
+
+        :return: HTTP status code for the response
+        """
+        if path.split("?", 1)[0] != self.path:
+            return 404
+        if secret is None or not hmac.compare_digest(secret.encode("utf-8"), self.secret.encode("utf-8")):
+            with self.__lock:
+                self.refused += 1
+            print("Webhook request with wrong secret token refused")
+            return 403
+        try:
+            update = json.loads(body)
+            update_id = update["update_id"]
+        except (ValueError, KeyError, TypeError):
+            print("Webhook request is not an update")
+            return 400
+
+        with self.__lock:
+            if update_id in self.__recent_ids:
+                self.duplicates += 1
+                return 200
+            self.__recent_ids.add(update_id)
+            self.__recent_order.append(update_id)
+            if len(self.__recent_order) > 1000:
+                self.__recent_ids.discard(self.__recent_order.popleft())
+            self.received += 1
+
+        # noinspection PyBroadException
+        try:
+            self.on_update(update)
+        except Exception as e:
+            print(f"Failed to schedule update {update_id}: {str(e)}")
+            # Telegram will send it again
+            with self.__lock:
+                self.__recent_ids.discard(update_id)
+            return 500
+        return 200
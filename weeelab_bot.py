@@ -16,6 +16,7 @@ Author: WEEE Open Team
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import asyncio
 import datetime
 
 # Modules
@@ -24,47 +25,100 @@ import os
 import random
 import time
 import traceback  # Print stack traces in logs
+from copy import copy
+from dataclasses import dataclass
 from datetime import timedelta
 from enum import Enum
 from json import JSONDecodeError
 from subprocess import PIPE, run
-from threading import Thread
-from time import sleep
-from typing import List, Optional
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
 
 # from requests_html import HTMLSession
 # noinspection PyUnresolvedReferences
-import owncloud
 import requests  # send HTTP requests to Telegram server
+from requests.adapters import HTTPAdapter
 import simpleaudio
 from pytarallo.AuditEntry import AuditChanges, AuditEntry
 from pytarallo.Errors import AuthenticationError, ItemNotFoundError
 from pytarallo.Tarallo import Tarallo
 
+from dispatcher import AsyncDispatcher, Dispatcher
 from LdapWrapper import AccountLockedError, AccountNotFoundError, DuplicateEntryError, LdapConnection, LdapConnectionError, People, Person, User, Users
+from outbox import Outbox, Priority
+from owncloud_client import OwnCloudClient
 from Quotes import Quotes
 from remote_commands import shutdown_command, ssh_i_am_door_command, ssh_weeelab_command
+from render_cache import RenderCache
+from router import Latency, Router
 from ssh_util import SSHUtil
 from stream_yt_audio import LofiVlcPlayer
 from ToLab import ToLab, Tolab_Calendar
 from variables import *  # internal library with the environment variables
+from webhook import WebhookServer
 from Weeelablib import WeeelabLogs
 from Wol import Wol
 
 
+@dataclass
+class EndpointStats:
+    """
+    Requests made to a single Telegram endpoint, including retries
+    """
+
+    calls: int = 0
+    failures: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    def add(self, seconds: float, ok: bool):
+        self.calls += 1
+        if not ok:
+            self.failures += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    @property
+    def average_seconds(self) -> float:
+        return self.total_seconds / self.calls if self.calls > 0 else 0.0
+
+
 class BotHandler:
     """
     class with method used by the bot, for more details see https://core.telegram.org/bots/api
     """
 
-    def __init__(self, token):
+    # Everything else (edited messages, channel posts, ...) is ignored anyway
+    allowed_updates = ["message", "callback_query", "my_chat_member"]
+
+    def __init__(self, token, server="https://api.telegram.org", timeout: float = 10, retries: int = 4, pool_size: int = 10):
         """
         init function to set bot token and reference url
+
+        :param token: Bot token
+        :param server: Bot API server
+        :param timeout: Seconds to wait for Telegram on each request, except for long polling
+        :param retries: How many times a request is retried after a server or network error, or after being rate limited
+        :param pool_size: Connections to keep open, there should be one for each thread that sends messages
         """
         print("Bot handler started")
         self.token = token
-        self.api_url = "https://api.telegram.org/bot{}/".format(token)
+        self.api_url = "{}/bot{}/".format(server, token)
         self.offset = None
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+
+        # Keep connections open, instead of a TCP and TLS handshake for each message
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+        self.stats: Dict[str, EndpointStats] = {}
+        self.stats_lock = Lock()
 
         # These are returned when a user sends an unknown command.
         self.unknown_command_messages_last = -1
@@ -101,27 +155,21 @@ class BotHandler:
             "Do you know this one?",
             "Do you know who said this one?",
         ]
-        self.active_sessions = []
+        # User ID -> (ID of the /tolab calendar message, day chosen) while waiting for the hour. A dict, since
+        # commands from different chats change it at the same time.
+        self.active_sessions: Dict[int, Tuple[int, str]] = {}
 
     def get_updates(self, timeout=120):
         """
         method to receive incoming updates using long polling
         [Telegram API -> getUpdates ]
         """
-        params = {"offset": self.offset, "timeout": timeout}
-        requests_timeout = timeout + 5
-        # noinspection PyBroadException
-        try:
-            result = requests.get(self.api_url + "getUpdates", params, timeout=requests_timeout).json()["result"]
-            if len(result) > 0:
-                self.offset = result[-1]["update_id"] + 1
-            return result
-        except requests.exceptions.Timeout:
-            print(f"Polling timed out after f{str(requests_timeout)} seconds")
-            return None
-        except Exception as e:
-            print("Failed to get updates: " + str(e))
-            return None
+        # Filter server side, so edited messages and channel posts aren't even downloaded
+        params = {"offset": self.offset, "timeout": timeout, "allowed_updates": json.dumps(self.allowed_updates)}
+        result = self._call("get", "getUpdates", params, timeout + 5)
+        if result is not None and len(result) > 0:
+            self.offset = result[-1]["update_id"] + 1
+        return result
 
     def send_message(
         self,
@@ -145,7 +193,7 @@ class BotHandler:
         }
         if reply_markup is not None:
             params["reply_markup"] = {"inline_keyboard": reply_markup}
-        self.__do_post("sendMessage", params)
+        return self._do_post("sendMessage", params)
 
     def send_photo(
         self,
@@ -170,7 +218,7 @@ class BotHandler:
         }
         if reply_markup is not None:
             params["reply_markup"] = {"inline_keyboard": reply_markup}
-        self.__do_post("sendPhoto", params)
+        return self._do_post("sendPhoto", params)
 
     def edit_message(
         self,
@@ -191,28 +239,118 @@ class BotHandler:
             params["disable_web_page_preview"] = disable_web_page_preview
         if reply_markup is not None:
             params["reply_markup"] = {"inline_keyboard": reply_markup}
-        self.__do_post("editMessageText", params)
+        return self._do_post("editMessageText", params)
 
-    def __do_post(self, endpoint, params):
-        result = requests.post(self.api_url + endpoint, json=params)
-        if result.status_code >= 400:
-            print(f"Telegram server says there's an error: {result.status_code}")
-            print(result.content)
-            print("Our message:")
-            print(json.dumps(params))
+    def _do_post(self, endpoint, params):
+        return self._call("post", endpoint, params, self.timeout)
 
-    def get_last_update(self):
+    def _call(self, http_method: str, endpoint: str, params: dict, timeout: float):
         """
-        method to get last message if there is.
-        in case of error return an error code used in the main function
+        Make a request to Telegram, retrying it if necessary
+
+        :param http_method: "get" or "post"
+        :param endpoint: Bot API method
+        :param params: Its parameters
+        :param timeout: Seconds to wait for a response
+        :return: The result, or None if it failed
         """
-        get_result = self.get_updates(120)  # recall the function to get updates
-        if not get_result:
-            return -1
-        elif len(get_result) > 0:  # check if there are new messages
-            return get_result[-1]  # return the last message in json format
-        else:
-            return -1
+        for attempt in range(self.retries + 1):
+            start = monotonic()
+            try:
+                if http_method == "get":
+                    response = self.session.get(self.api_url + endpoint, params=params, timeout=timeout)
+                else:
+                    response = self.session.post(self.api_url + endpoint, json=params, timeout=timeout)
+            except requests.exceptions.RequestException as e:
+                self._record(endpoint, monotonic() - start, False)
+                # If it timed out while waiting for a response, the message may have been sent anyway: sending it
+                # again would duplicate it. Everything else is safe to retry.
+                retry = http_method == "get" or isinstance(e, requests.exceptions.ConnectionError)
+                if not retry or attempt >= self.retries:
+                    print(f"Request to {endpoint} failed: {str(e)}")
+                    return None
+                wait = self._backoff(attempt)
+                print(f"Request to {endpoint} failed: {str(e)}, retrying in {wait:.1f} seconds")
+                sleep(wait)
+                continue
+
+            if response.status_code < 400:
+                # A proxy or CDN in the middle may answer 200 with an error page
+                try:
+                    result = response.json()["result"]
+                except (ValueError, KeyError, TypeError) as e:
+                    self._record(endpoint, monotonic() - start, False)
+                    print(f"Invalid response from Telegram to {endpoint}: {str(e)}")
+                    print(response.content)
+                    return None
+                self._record(endpoint, monotonic() - start, True)
+                return result
+            self._record(endpoint, monotonic() - start, False)
+
+            # noinspection PyBroadException
+            try:
+                body = response.json()
+            except Exception:
+                body = {}
+            if not isinstance(body, dict):
+                body = {}
+            wait = self._retry_delay(response.status_code, body, attempt)
+            if wait is None or attempt >= self.retries:
+                print(f"Telegram server says there's an error: {response.status_code}")
+                print(response.content)
+                print("Our message:")
+                print(json.dumps(params))
+                return None
+            print(f"Telegram server says there's an error: {response.status_code}, retrying {endpoint} in {wait:.1f} seconds")
+            sleep(wait)
+        return None
+
+    def _retry_delay(self, status_code: int, body: dict, attempt: int) -> Optional[float]:
+        """
+        How long to wait before retrying a request that Telegram refused
+
+        :return: Seconds, None if it should not be retried
+        """
+        if status_code == 429:
+            # Rate limited: Telegram tells us exactly how long to wait
+            return float(body.get("parameters", {}).get("retry_after", 1))
+        if status_code >= 500:
+            return self._backoff(attempt)
+        return None
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        """
+        Exponential backoff with jitter, so that many requests that failed together aren't retried together
+        """
+        return min(30.0, 0.5 * 2**attempt) * random.uniform(0.5, 1.0)
+
+    def _record(self, endpoint: str, seconds: float, ok: bool):
+        with self.stats_lock:
+            if endpoint not in self.stats:
+                self.stats[endpoint] = EndpointStats()
+            self.stats[endpoint].add(seconds, ok)
+
+    def get_stats(self) -> Dict[str, "EndpointStats"]:
+        with self.stats_lock:
+            return {endpoint: copy(stats) for endpoint, stats in self.stats.items()}
+
+    def get_new_updates(self):
+        """
+        Poll forever and yield every update, in the same order Telegram sent them.
+        A single getUpdates may return many updates when messages arrive in a burst, none of them is skipped.
+        """
+        while True:
+            updates = self.get_updates(120)
+            if updates is None:
+                # Failed, don't hammer whatever is answering instead of Telegram
+                sleep(1)
+                continue
+            if not updates:
+                # Timed out or no new messages
+                continue
+            for update in updates:
+                yield update
 
     def leave_chat(self, chat_id):
         """
@@ -222,7 +360,28 @@ class BotHandler:
         params = {
             "chat_id": chat_id,
         }
-        return requests.post(self.api_url + "leaveChat", params)
+        return self._do_post("leaveChat", params)
+
+    def set_webhook(self, url: str, secret_token: Optional[str] = None, max_connections: int = 40):
+        """
+        method to receive updates on a webhook instead of polling [ Telegram API -> setWebhook ]
+        On success, True is returned.
+        """
+        params = {
+            "url": url,
+            "max_connections": max_connections,
+            "allowed_updates": self.allowed_updates,
+        }
+        if secret_token is not None:
+            params["secret_token"] = secret_token
+        return self._do_post("setWebhook", params)
+
+    def delete_webhook(self):
+        """
+        method to go back to polling [ Telegram API -> deleteWebhook ]
+        On success, True is returned.
+        """
+        return self._do_post("deleteWebhook", {})
 
     @property
     def unknown_command_message(self):
@@ -237,6 +396,134 @@ class BotHandler:
         return self.game_questions[self.game_questions_last]
 
 
+class AsyncBotHandler(BotHandler):
+    """
+    Same as BotHandler, but every method that talks to Telegram is a coroutine.
+    Use it as "async with AsyncBotHandler(token) as bot:", that opens and closes the connection pool.
+    """
+
+    def __init__(self, token, server="https://api.telegram.org", timeout: float = 10, retries: int = 4, pool_size: int = 10):
+        super().__init__(token, server, timeout, retries, pool_size)
+        # aiohttp replaces the requests session
+        self.session.close()
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+
+    async def get_updates(self, timeout=120):
+        """
+        method to receive incoming updates using long polling
+        [Telegram API -> getUpdates ]
+        """
+        params = {"timeout": timeout, "allowed_updates": json.dumps(self.allowed_updates)}
+        if self.offset is not None:
+            params["offset"] = self.offset
+        result = await self._call("get", "getUpdates", params, timeout + 5)
+        if result is not None and len(result) > 0:
+            self.offset = result[-1]["update_id"] + 1
+        return result
+
+    async def get_new_updates(self):
+        """
+        Poll forever and yield every update, in the same order Telegram sent them.
+        """
+        while True:
+            updates = await self.get_updates(120)
+            if updates is None:
+                await asyncio.sleep(1)
+                continue
+            if not updates:
+                continue
+            for update in updates:
+                yield update
+
+    async def _do_post(self, endpoint, params):
+        return await self._call("post", endpoint, params, self.timeout)
+
+    async def _call(self, http_method: str, endpoint: str, params: dict, timeout: float):
+        """
+        Same as BotHandler._call, with aiohttp
+        """
+        for attempt in range(self.retries + 1):
+            start = monotonic()
+            try:
+                if http_method == "get":
+                    request = self.session.get(self.api_url + endpoint, params=params, timeout=aiohttp.ClientTimeout(total=timeout))
+                else:
+                    request = self.session.post(self.api_url + endpoint, json=params, timeout=aiohttp.ClientTimeout(total=timeout))
+                async with request as response:
+                    status = response.status
+                    content = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self._record(endpoint, monotonic() - start, False)
+                # Same as above: a POST that timed out may have been delivered anyway
+                retry = http_method == "get" or isinstance(e, aiohttp.ClientConnectionError) and not isinstance(e, aiohttp.ServerTimeoutError)
+                if not retry or attempt >= self.retries:
+                    print(f"Request to {endpoint} failed: {str(e) or type(e).__name__}")
+                    return None
+                wait = self._backoff(attempt)
+                print(f"Request to {endpoint} failed: {str(e) or type(e).__name__}, retrying in {wait:.1f} seconds")
+                await asyncio.sleep(wait)
+                continue
+
+            try:
+                body = json.loads(content)
+            except ValueError:
+                body = {}
+            if status < 400:
+                # Same as above, the response may not come from Telegram at all
+                if not isinstance(body, dict) or "result" not in body:
+                    self._record(endpoint, monotonic() - start, False)
+                    print(f"Invalid response from Telegram to {endpoint}")
+                    print(content)
+                    return None
+                self._record(endpoint, monotonic() - start, True)
+                return body["result"]
+            self._record(endpoint, monotonic() - start, False)
+            if not isinstance(body, dict):
+                body = {}
+
+            wait = self._retry_delay(status, body, attempt)
+            if wait is None or attempt >= self.retries:
+                print(f"Telegram server says there's an error: {status}")
+                print(content)
+                print("Our message:")
+                print(json.dumps(params))
+                return None
+            print(f"Telegram server says there's an error: {status}, retrying {endpoint} in {wait:.1f} seconds")
+            await asyncio.sleep(wait)
+        return None
+
+
+class BlockingBotHandler:
+    """
+    Lets code running in other threads (i.e. every command) use an AsyncBotHandler as if it were a BotHandler:
+    each call is run on the event loop and waited for.
+    """
+
+    def __init__(self, bot: AsyncBotHandler, loop: asyncio.AbstractEventLoop):
+        self.__bot = bot
+        self.__loop = loop
+
+    def __getattr__(self, name):
+        attribute = getattr(self.__bot, name)
+        if not callable(attribute):
+            return attribute
+
+        def blocking(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if asyncio.iscoroutine(result):
+                return asyncio.run_coroutine_threadsafe(result, self.__loop).result()
+            return result
+
+        return blocking
+
+
 def escape_all(string):
     return string.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
@@ -430,7 +717,7 @@ def fah_ranker(bot: BotHandler, hour: int, minute: int):
                 f'See all the stats <a href="https://stats.foldingathome.org/team/{team_number}">here</a>'
             )
 
-            bot.send_message(chat_id=WEEE_FOLD_ID, text=text, disable_notification=True)
+            bot.send_message(chat_id=WEEE_FOLD_ID, text=text, disable_notification=True, priority=Priority.BROADCAST)
 
         except Exception as e:  # TODO: specify any expected Exception class
             print(e)
@@ -458,11 +745,57 @@ def run_shell_cmd(cmd: str) -> str:
     return run(cmd, stdout=PIPE).stdout.decode("utf-8")
 
 
+class UpdateContext:
+    """
+    Everything about a single update: who sent it, where, and how to reply.
+    Each update gets its own, so the same CommandHandler can handle many of them at once.
+    """
+
+    def __init__(self, bot: Outbox, chat_id: int, sender: dict, message_id: Optional[int] = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        # The "from" field of the update, see https://core.telegram.org/bots/api#user
+        self.sender = sender
+        self.user_id = sender["id"]
+        self.nickname = sender["username"] if "username" in sender else None
+        self.message_id = message_id
+        # Filled in by CommandHandler.read_user
+        self.user: Optional[User] = None
+
+    @staticmethod
+    def from_message(bot: Outbox, update: dict):
+        message = update["message"]
+        return UpdateContext(bot, message["chat"]["id"], message["from"], message["message_id"])
+
+    @staticmethod
+    def from_callback(bot: Outbox, update: dict):
+        query = update["callback_query"]
+        return UpdateContext(bot, query["message"]["chat"]["id"], query["from"], query["message"]["message_id"])
+
+    def reply(self, message):
+        for i in range(0, len(message), 4096):
+            self.bot.send_message(self.chat_id, message[i : i + 4096], wait=False)
+
+    def reply_keyboard(self, message, markup):
+        self.bot.send_message(self.chat_id, message, reply_markup=markup, wait=False)
+
+    def edit(self, message_id, message, markup=None):
+        self.bot.edit_message(self.chat_id, message_id, message, reply_markup=markup, wait=False)
+
+
+# Every command and callback, registered with the CommandHandler methods (or right after the class, if they need
+# some adapting). Called with the CommandHandler as first argument.
+commands = Router("weeelab_bot")
+
+
 class CommandHandler:
     """
     Aggregates all the possible commands within one class.
     """
 
+    # Days shown by /log n at most: every day since 2017 would be hundreds of messages
+    MAX_LOG_DAYS = 31
+
     def __init__(
         self,
         bot: BotHandler,
@@ -474,6 +807,8 @@ class CommandHandler:
         conn: LdapConnection,
         wol: dict,
         quotes: Quotes,
+        dispatcher: Dispatcher,
+        wave_obj,
     ):
         self.bot = bot
         self.tarallo = tarallo
@@ -484,93 +819,73 @@ class CommandHandler:
         self.people = people
         self.conn = conn
         self.wol_dict = wol
-
-        self.user: Optional[User] = None
-        self.__last_from = None
-        self.__last_chat_id = None
-        self.__last_user_id = None
-        self.__last_user_nickname = None
+        self.dispatcher = dispatcher
+        self.wave_obj = wave_obj
+        # /inlab, /top and /log, until logs, /tolab or people change
+        self.render_cache = RenderCache()
 
         self.lofi_player = LofiVlcPlayer()
         self.lofi_player_last_volume = -1
 
-    def read_user_from_callback(self, last_update):
-        self.__last_from = last_update["callback_query"]["from"]
-        self.__last_chat_id = last_update["callback_query"]["message"]["chat"]["id"]
-        self.__last_user_id = last_update["callback_query"]["from"]["id"]
-        self.__last_user_nickname = last_update["callback_query"]["from"]["username"] if "username" in last_update["callback_query"]["from"] else None
-
-        return self.__read_user(None)
-
-    def read_user_from_message(self, last_update):
-        self.__last_from = last_update["message"]["from"]
-        self.__last_chat_id = last_update["message"]["chat"]["id"]
-        self.__last_user_id = last_update["message"]["from"]["id"]
-        self.__last_user_nickname = last_update["message"]["from"]["username"] if "username" in last_update["message"]["from"] else None
-
-        return self.__read_user(last_update["message"]["text"])
+    def read_user(self, ctx: UpdateContext, text: Optional[str] = None):
+        """
+        Find who sent the update in LDAP and store it in the context
 
-    def __read_user(self, text: Optional[str]):
-        self.user = None
+        :param ctx: Context of the update
+        :param text: Text of the message, None for callbacks
+        :return: True if they can use the bot
+        """
+        ctx.user = None
         try:
-            self.user = self.users.get(self.__last_user_id, self.__last_user_nickname, self.conn)
+            ctx.user = self.users.get(ctx.user_id, ctx.nickname, self.conn)
             return True
         except (LdapConnectionError, DuplicateEntryError) as e:
-            self.exception(e.__class__.__name__)
+            self.exception(ctx, e.__class__.__name__)
         except AccountLockedError:
-            self.__send_message(
+            ctx.reply(
                 "Your account is locked. You cannot use the bot until an administrator unlocks it.\n"
                 "If you're a new team member, that will happen after the test on safety."
             )
         except AccountNotFoundError:
             if text is not None:
                 # Maybe it is the invite link for an account that doesn't exist yet?
-                responded = self.respond_to_invite_link(text)
+                responded = self.respond_to_invite_link(ctx, text)
                 if responded:
                     return
-            self.store_id()
+            self.store_id(ctx)
             msg = f"""Sorry, you are not allowed to use this bot.
 
 If you're part of <a href=\"http://weeeopen.polito.it/\">WEEE Open</a> add your user ID in the account management panel
 or ask an administrator to unlock your account.
-Your user ID is: <b>{self.__last_user_id}</b>"""
-            self.__send_message(msg)
+Your user ID is: <b>{ctx.user_id}</b>"""
+            ctx.reply(msg)
         return False
 
-    def __send_message(self, message):
-        for i in range(0, len(message), 4096):
-            self.bot.send_message(self.__last_chat_id, message[i : i + 4096])
-
-    def __send_inline_keyboard(self, message, markup):
-        self.bot.send_message(self.__last_chat_id, message, reply_markup=markup)
-
-    def __edit_message(self, message_id, message, markup):
-        self.bot.edit_message(self.__last_chat_id, message_id, message, reply_markup=markup)
-
-    def respond_to_invite_link(self, message) -> bool:
+    def respond_to_invite_link(self, ctx: UpdateContext, message) -> bool:
         message: str
         if not message.startswith(INVITE_LINK):
             return False
         link = message.split(" ", 1)[0]
         code = link[len(INVITE_LINK) :]
         try:
-            self.users.update_invite(code, self.__last_user_id, self.__last_user_nickname, self.conn)
+            self.users.update_invite(code, ctx.user_id, ctx.nickname, self.conn)
         except AccountNotFoundError:
-            self.__send_message("I couldn't find your invite. Are you sure of that link?")
+            ctx.reply("I couldn't find your invite. Are you sure of that link?")
             return True
-        self.__send_message(
+        ctx.reply(
             "Hey, I've filled some fields in the registration form for you, no need to say thanks.\n"
             f"Just go back to {link} and complete the registration.\n"
             "See you!"
         )
         return True
 
-    def start(self):
+    @commands.command("/start", latency=Latency.INSTANT)
+    def start(self, ctx: UpdateContext):
         """
         Called with /start
         """
 
-        self.__send_message(
+        ctx.reply(
             "\
 <b>WEEE Open Telegram bot</b>.\nThe goal of this bot is to obtain information \
 about who is currently in the lab, who has done what, compute some stats and, \
@@ -578,7 +893,7 @@ in general, simplify the life of our members and to avoid waste of paper \
 as well.\nFor a list of the available commands type /help.",
         )
 
-    def format_user_in_list(self, username: str, other=""):
+    def format_user_in_list(self, ctx: UpdateContext, username: str, other=""):
         person = self.people.get(username, self.conn)
         user_id = None if person is None or person.tgid is None else person.tgid  # This is unreadable. Deal with it.
         display_name = CommandHandler.try_get_display_name(username, person)
@@ -586,7 +901,7 @@ as well.\nFor a list of the available commands type /help.",
         haskey = chr(128273) if person.haskey else ""
 
         sir = ""
-        if self.user.isadmin and person.dateofsafetytest is not None and not person.signedsir:
+        if ctx.user.isadmin and person.dateofsafetytest is not None and not person.signedsir:
             sir = f" (Remember to sign the SIR! {chr(128221)})"
 
         if user_id is None:
@@ -601,12 +916,46 @@ as well.\nFor a list of the available commands type /help.",
         else:
             return person.cn
 
-    def inlab(self):
+    @commands.command("/inlab")
+    def inlab(self, ctx: UpdateContext):
         """
         Called with /inlab
         """
 
-        inlab = self.logs.get_log().get_entries_inlab()
+        logs = self.logs.get_log()
+        self.people.refresh_if_necessary(self.conn)
+        right_now = datetime.datetime.now(self.tolab_db.local_tz)
+        # Time spent in lab and /tolab entries change every minute, even if nothing else does
+        key = (logs.version, self.tolab_db.version, self.people.version, ctx.user.isadmin, right_now.strftime("%Y-%m-%d %H:%M"))
+        msg, people_inlab, people_going = self.render_cache.get("/inlab", key, lambda: self._render_inlab(ctx, logs, right_now))
+
+        # The rest depends on who is asking
+        user_themself_inlab = ctx.user.uid in people_inlab
+        if len(people_going) > 0:
+            if ctx.user.uid not in people_going and not user_themself_inlab:
+                msg += "\nAre you going, too? Tell everyone with /tolab."
+        else:
+            if right_now.hour > 19:
+                msg += "\n\nAre you going to the lab tomorrow? Tell everyone with /tolab."
+            elif not user_themself_inlab:
+                msg += "\n\nAre you going to the lab later? Tell everyone with /tolab."
+
+        if len(people_inlab) > 0 and not user_themself_inlab:
+            msg += "\n\nUse /ring for the bell, if you are at door 3."
+        ctx.reply(msg + self._stale_warning())
+
+    def _stale_warning(self) -> str:
+        if not self.logs.stale:
+            return ""
+        return f"\n\n⚠️ Couldn't update the log, this is how it was at {self.logs.log_last_update}"
+
+    def _render_inlab(self, ctx: UpdateContext, logs: WeeelabLogs, right_now: datetime.datetime):
+        """
+        Build the part of /inlab that is the same for everyone (admins see a bit more)
+
+        :return: Message, usernames of people in lab and of people going there
+        """
+        inlab = logs.get_entries_inlab()
         people_inlab = set()
 
         if len(inlab) == 0:
@@ -617,14 +966,13 @@ as well.\nFor a list of the available commands type /help.",
             msg = f"There are {str(len(inlab))} students in lab right now:"
 
         for username in inlab:
-            msg += self.format_user_in_list(username)
+            minutes = logs.inlab_minutes(username)
+            msg += self.format_user_in_list(ctx, username, "" if minutes is None else f" for {minutes // 60:02d}:{minutes % 60:02d}")
             people_inlab.add(username)
 
-        user_themself_inlab = self.user.uid in people_inlab
         self.tolab_db.check_tolab(people_inlab)
         people_going = self.tolab_db.filter_tolab(people_inlab)
         number_of_people_going = len(people_going)
-        right_now = datetime.datetime.now(self.tolab_db.local_tz)
 
         if number_of_people_going > 0:
             today = right_now.date()
@@ -633,84 +981,73 @@ as well.\nFor a list of the available commands type /help.",
             else:
                 msg += f"\n\nThere are {str(number_of_people_going)} students that are going to lab:"
 
-            user_themself_tolab = False
             for user in people_going:
                 username = user["username"]
                 going_day = user["tolab"].date()
                 hh = str(user["tolab"].hour).zfill(2)
                 mm = str(user["tolab"].minute).zfill(2)
                 if today == going_day:
-                    msg += self.format_user_in_list(username, f" today at {hh}:{mm}")
+                    msg += self.format_user_in_list(ctx, username, f" today at {hh}:{mm}")
                 elif today + datetime.timedelta(days=1) == going_day:
-                    msg += self.format_user_in_list(username, f" tomorrow at {hh}:{mm}")
+                    msg += self.format_user_in_list(ctx, username, f" tomorrow at {hh}:{mm}")
                 else:
-                    msg += self.format_user_in_list(username, f" on {str(going_day)} at {hh}:{mm}")
-                if username == self.user.uid:
-                    user_themself_tolab = True
-            if not user_themself_tolab and not user_themself_inlab:
-                msg += "\nAre you going, too? Tell everyone with /tolab."
-        else:
-            if right_now.hour > 19:
-                msg += "\n\nAre you going to the lab tomorrow? Tell everyone with /tolab."
-            elif not user_themself_inlab:
-                msg += "\n\nAre you going to the lab later? Tell everyone with /tolab."
+                    msg += self.format_user_in_list(ctx, username, f" on {str(going_day)} at {hh}:{mm}")
 
-        if len(inlab) > 0 and not user_themself_inlab:
-            msg += "\n\nUse /ring for the bell, if you are at door 3."
-        self.__send_message(msg)
+        return msg, frozenset(people_inlab), frozenset(user["username"] for user in people_going)
 
-    def tolab(self, the_time: str, day: str = None, is_gui: bool = False):
+    @commands.command("/tolab", min_args=1, max_args=2, usage=lambda handler, ctx: handler.tolabGui(ctx))
+    def tolab(self, ctx: UpdateContext, the_time: str, day: str = None, is_gui: bool = False):
         try:
             the_time = self._tolab_parse_time(the_time)
         except ValueError:
-            self.__send_message("Use correct time format, e.g. 10:30, or <i>no</i> to cancel")
+            ctx.reply("Use correct time format, e.g. 10:30, or <i>no</i> to cancel")
             return
 
         if the_time is not None:
             try:
                 day = self._tolab_parse_day(day)
             except ValueError:
-                self.__send_message("Use correct day format: +1 for tomorrow, +2 for the day after tomorrow and so on")
+                ctx.reply("Use correct day format: +1 for tomorrow, +2 for the day after tomorrow and so on")
                 return
 
         # noinspection PyBroadException
         try:
             if the_time is None:
                 # Delete previous entry via Telegram ID
-                self.tolab_db.delete_entry(self.user.tgid)
-                self.__send_message(f"Ok, you aren't going to the lab, I've taken note.")
+                self.tolab_db.delete_entry(ctx.user.tgid)
+                ctx.reply(f"Ok, you aren't going to the lab, I've taken note.")
             else:
                 sir_message = ""
-                if not self.user.signedsir and self.user.dateofsafetytest is not None:
+                if not ctx.user.signedsir and ctx.user.dateofsafetytest is not None:
                     sir_message = "\nRemember to sign the SIR when you get there!"
 
-                days = self.tolab_db.set_entry(self.user.uid, self.user.tgid, the_time, day)
+                days = self.tolab_db.set_entry(ctx.user.uid, ctx.user.tgid, the_time, day)
                 if not is_gui:
                     if days <= 0:
-                        self.__send_message(
+                        ctx.reply(
                             f"I took note that you'll go to the lab at {the_time}. "
                             f"Use /tolab_no to cancel. Check if "
                             f"anybody else is coming with /inlab.{sir_message}"
                         )
                     elif days == 1:
-                        self.__send_message(
+                        ctx.reply(
                             f"So you'll go the lab at {the_time} tomorrow. Use /tolab_no to cancel. " f"Check if anyone else is coming with /inlab{sir_message}"
                         )
                     else:
                         last_message = sir_message if sir_message != "" else "\nMark it down on your calendar!"
-                        self.__send_message(
+                        ctx.reply(
                             f"So you'll go the lab at {the_time} in {days} days. Use /tolab_no to "
                             f"cancel. Check if anyone else is coming with /inlab"
                             f"{last_message}"
                         )
         except Exception as e:
-            self.__send_message(f"An error occurred: {str(e)}")
+            ctx.reply(f"An error occurred: {str(e)}")
             print(traceback.format_exc())
 
-    def tolabGui(self):
+    def tolabGui(self, ctx: UpdateContext):
         calendar = Tolab_Calendar().make()
         idx = 0
-        self.__send_inline_keyboard(message=f"Select a date", markup=calendar)
+        ctx.reply_keyboard(message=f"Select a date", markup=calendar)
 
     def get_tolab_active_sessions(self):
         return self.bot.active_sessions
@@ -760,8 +1097,8 @@ as well.\nFor a list of the available commands type /help.",
                     return day
         raise ValueError
 
-    def _get_tolab_gui_days(self, idx: int, date: str):
-        self.bot.active_sessions[idx][2]
+    @staticmethod
+    def _get_tolab_gui_days(date: str):
         day = date.split()
         day[1] = datetime.datetime.strptime(day[1], "%B").month
         day = f"{day[0]} {day[1]} {day[2]}"
@@ -772,13 +1109,14 @@ as well.\nFor a list of the available commands type /help.",
         diff = day - today
         return diff.days
 
-    def ring(self, wave_obj):
+    @commands.command("/ring")
+    def ring(self, ctx: UpdateContext):
         """
         Called with /ring
         """
         inlab = self.logs.get_log().get_entries_inlab()
         if len(inlab) <= 0:
-            self.__send_message("Nobody is in lab right now, I cannot ring the bell.")
+            ctx.reply("Nobody is in lab right now, I cannot ring the bell.")
             return
 
         if self.lofi_player.player_exist():
@@ -786,73 +1124,81 @@ as well.\nFor a list of the available commands type /help.",
             if lofi_player.is_playing():
                 lofi_player.stop()
                 sleep(1)
-                wave_obj.play()
+                self.wave_obj.play()
                 sleep(1)
                 lofi_player.play()
             else:
-                wave_obj.play()
+                self.wave_obj.play()
         else:
-            wave_obj.play()
+            self.wave_obj.play()
 
-        self.__send_message("You rang the bell 🔔 Wait at door 3 until someone comes. 🔔")
+        ctx.reply("You rang the bell 🔔 Wait at door 3 until someone comes. 🔔")
 
     def user_is_in_lab(self, uid):
-        inlab = self.logs.get_log().get_entries_inlab()
-        for username in inlab:
-            if username == uid:
-                return True
-        return False
+        return self.logs.get_log().is_inlab(uid)
 
-    def log(self, cmd_days_to_filter=None):
+    @commands.command("/log", max_args=1)
+    def log(self, ctx: UpdateContext, cmd_days_to_filter=None):
         """
         Called with /log
         """
 
-        self.logs.get_log()
-
+        day = None
+        capped = ""
         if cmd_days_to_filter is not None and cmd_days_to_filter.isdigit():
             # Command is "/log [number]"
-            days_to_print = int(cmd_days_to_filter)
+            days_to_print = min(int(cmd_days_to_filter), self.MAX_LOG_DAYS)
+            if int(cmd_days_to_filter) > self.MAX_LOG_DAYS:
+                capped = f"\n\nShowing only the last {self.MAX_LOG_DAYS} days, that's the most /log can do"
         elif cmd_days_to_filter == "all":
             # This won't work. Will never work. There's a length limit on messages.
             # Whatever, this variant had been missing for months and nobody even noticed...
-            days_to_print = 31
+            days_to_print = self.MAX_LOG_DAYS
+        elif cmd_days_to_filter is not None:
+            # Command is "/log YYYY-MM-DD"
+            try:
+                day = datetime.datetime.strptime(cmd_days_to_filter, "%Y-%m-%d").date()
+            except ValueError:
+                ctx.reply("Use /log, /log <i>n</i> or /log <i>YYYY-MM-DD</i>")
+                return
+            days_to_print = 1
         else:
             days_to_print = 1
 
-        days = {}
-        # reversed() doesn't create a copy
-        for line in reversed(self.logs.log):
-            this_day = line.day()
-            if this_day not in days:
-                if len(days) >= days_to_print:
-                    break
-                days[this_day] = []
-
-            print_name = CommandHandler.try_get_display_name(line.username, self.people.get(line.username, self.conn))
-
-            if line.inlab:
-                days[this_day].append(f"<i>{print_name}</i> is in lab\n")
-            else:
-                days[this_day].append(f"<i>{print_name}</i>: {escape_all(line.text)}\n")
+        self.logs.get_log()
+        self.people.refresh_if_necessary(self.conn)
+
+        def render():
+            msg = ""
+            for this_day, lines in self.logs.get_days(days_to_print, day):
+                rows = []
+                # Most recent first
+                for line in reversed(lines):
+                    print_name = CommandHandler.try_get_display_name(line.username, self.people.get(line.username, self.conn))
+
+                    if line.inlab:
+                        rows.append(f"<i>{print_name}</i> is in lab\n")
+                    else:
+                        rows.append(f"<i>{print_name}</i>: {escape_all(line.text)}\n")
+                msg += "<b>{day}</b>\n{rows}\n".format(day=this_day.strftime("%d/%m/%Y"), rows="".join(rows))
+            if day is not None and msg == "":
+                msg = f"Nobody was in lab on {day.strftime('%d/%m/%Y')}\n\n"
 
-        msg = ""
-        for this_day in days:
-            msg += "<b>{day}</b>\n{rows}\n".format(day=this_day, rows="".join(days[this_day]))
+            return msg + "Latest log update: <b>{}</b>".format(self.logs.log_last_update)
 
-        msg = msg + "Latest log update: <b>{}</b>".format(self.logs.log_last_update)
-        self.__send_message(msg)
+        ctx.reply(self.render_cache.get("/log", (self.logs.version, self.people.version, days_to_print, day), render) + capped + self._stale_warning())
 
-    def stat(self, cmd_target_user=None):
+    @commands.command("/stat", max_args=1)
+    def stat(self, ctx: UpdateContext, cmd_target_user=None):
         if cmd_target_user is None:
             # User asking its own /stat
-            target_username = self.user.uid
+            target_username = ctx.user.uid
         else:
             # Asking for somebody else
             target_username = str(cmd_target_user)
-            if target_username.lower() != self.user.uid.lower():
+            if target_username.lower() != ctx.user.uid.lower():
                 # *Really* somebody else
-                if self.user.isadmin:
+                if ctx.user.isadmin:
                     # Are you an admin? Then go on!
                     person = self.people.get(target_username, self.conn)
                     if person is None:
@@ -861,12 +1207,12 @@ as well.\nFor a list of the available commands type /help.",
                         self.logs.get_log()
                         if not self.logs.user_exists_in_logs(target_username):
                             target_username = None
-                            self.__send_message("No statistics for the given user. Have you typed it correctly?")
+                            ctx.reply("No statistics for the given user. Have you typed it correctly?")
                     else:
                         target_username = person.uid
                 else:
                     target_username = None
-                    self.__send_message("Sorry! You are not allowed to see stat of other users!\nOnly admins can!")
+                    ctx.reply("Sorry! You are not allowed to see stat of other users!\nOnly admins can!")
 
         # Do we know what to search?
         if target_username is not None:
@@ -885,12 +1231,13 @@ as well.\nFor a list of the available commands type /help.",
                 f"\n<b>{total_mins_hh} h {total_mins_mm} m</b> in total."
                 f"\n\nLast log update: {self.logs.log_last_update}"
             )
-            self.__send_message(msg)
+            ctx.reply(msg)
 
-    def item_command_error(self, command):
-        self.__send_message(f"Add the item the code, e.g. /{command} R100")
+    def item_command_error(self, ctx: UpdateContext, command):
+        ctx.reply(f"Add the item the code, e.g. /{command} R100")
 
-    def history(self, item, cmd_limit=None):
+    @commands.command("/history", min_args=1, max_args=2, usage=lambda handler, ctx: handler.item_command_error(ctx, "history"))
+    def history(self, ctx: UpdateContext, item, cmd_limit=None):
         if cmd_limit is None:
             limit = 6
         else:
@@ -927,20 +1274,21 @@ as well.\nFor a list of the available commands type /help.",
                 display_user = CommandHandler.try_get_display_name(h_user, self.people.get(h_user, self.conn))
                 msg += f"{h_time} by <i>{display_user}</i>\n\n"
                 if entries >= 6:
-                    self.__send_message(msg)
+                    ctx.reply(msg)
                     msg = ""
                     entries = 0
             if entries != 0:
-                self.__send_message(msg)
+                ctx.reply(msg)
         except ItemNotFoundError:
-            self.__send_message(f"Item {item} not found.")
+            ctx.reply(f"Item {item} not found.")
         except AuthenticationError:
-            self.__send_message("Sorry, cannot authenticate with T.A.R.A.L.L.O.")
+            ctx.reply("Sorry, cannot authenticate with T.A.R.A.L.L.O.")
         except RuntimeError:
             fail_msg = f"Sorry, an error has occurred (HTTP status: {str(self.tarallo.response.status_code)})."
-            self.__send_message(fail_msg)
+            ctx.reply(fail_msg)
 
-    def item_info(self, item):
+    @commands.command("/item", min_args=1, max_args=1, usage=lambda handler, ctx: handler.item_command_error(ctx, "item"))
+    def item_info(self, ctx: UpdateContext, item):
         try:
             item = self.tarallo.get_item(item)
             location = " → ".join(item.location)
@@ -953,124 +1301,137 @@ as well.\nFor a list of the available commands type /help.",
                     msg += f"{feature}: {item.product.features[feature]}\n"
             msg += f'\n<a href="{self.tarallo.url}/item/{item.code}">View on Tarallo</a>'
 
-            self.__send_message(msg)
+            ctx.reply(msg)
         except ItemNotFoundError:
-            self.__send_message(f"Item {item} not found.")
+            ctx.reply(f"Item {item} not found.")
         except (RuntimeError, AuthenticationError):
             fail_msg = f"Sorry, an error has occurred (HTTP status: {str(self.tarallo.response.status_code)})."
-            self.__send_message(fail_msg)
+            ctx.reply(fail_msg)
 
-    def item_location(self, item):
+    @commands.command("/location", min_args=1, max_args=1, usage=lambda handler, ctx: handler.item_command_error(ctx, "location"))
+    def item_location(self, ctx: UpdateContext, item):
         try:
             item = self.tarallo.get_item(item, 0)
             location = " → ".join(item.location)
             msg = f"Item <b>{item.code}</b>\nLocation: {location}\n"
             msg += f'\n<a href="{self.tarallo.url}/item/{item.code}">View on Tarallo</a>'
 
-            self.__send_message(msg)
+            ctx.reply(msg)
         except ItemNotFoundError:
-            self.__send_message(f"Item {item} not found.")
+            ctx.reply(f"Item {item} not found.")
         except (RuntimeError, AuthenticationError):
             fail_msg = f"Sorry, an error has occurred (HTTP status: {str(self.tarallo.response.status_code)})."
-            self.__send_message(fail_msg)
+            ctx.reply(fail_msg)
 
-    def top(self, cmd_filter=None):
+    @commands.command("/top", max_args=1)
+    def top(self, ctx: UpdateContext, cmd_filter=None):
         """
         Called with /top <filter>.
         Currently, the only accepted filter is "all", and besides that,
         it returns the monthly filter
         """
-        if self.user.isadmin:
+        if ctx.user.isadmin:
             # Downloads them only if needed
             self.logs.get_old_logs()
             self.logs.get_log()
+            self.people.refresh_if_necessary(self.conn)
 
-            # TODO: add something like "/top 04 2018" that returns top list for April 2018
-            if cmd_filter == "all":
-                msg = "Top User List!\n"
-                rank = self.logs.count_time_all()
-            else:
-                msg = "Top Monthly User List!\n"
-                rank = self.logs.count_time_month()
-            # sort the dict by value in descending order (and convert dict to list of tuples)
-            rank = sorted(rank.items(), key=lambda x: x[1], reverse=True)
-
-            n = 0
-            for rival, the_time in rank:
-                entry = self.people.get(rival, self.conn)
-                if entry is not None:
-                    n += 1
-                    time_hh, time_mm = self.logs.mm_to_hh_mm(the_time)
-                    display_user = CommandHandler.try_get_display_name(rival, self.people.get(rival, self.conn))
-                    if entry.isadmin:
-                        msg += f"{n}) [{time_hh}:{time_mm}] <b>{display_user}</b>\n"
-                    else:
-                        msg += f"{n}) [{time_hh}:{time_mm}] {display_user}\n"
+            def render():
+                # TODO: add something like "/top 04 2018" that returns top list for April 2018
+                if cmd_filter == "all":
+                    msg = "Top User List!\n"
+                    rank = self.logs.count_time_all()
+                else:
+                    msg = "Top Monthly User List!\n"
+                    rank = self.logs.count_time_month()
+                # sort the dict by value in descending order (and convert dict to list of tuples)
+                rank = sorted(rank.items(), key=lambda x: x[1], reverse=True)
+
+                n = 0
+                for rival, the_time in rank:
+                    entry = self.people.get(rival, self.conn)
+                    if entry is not None:
+                        n += 1
+                        time_hh, time_mm = self.logs.mm_to_hh_mm(the_time)
+                        display_user = CommandHandler.try_get_display_name(rival, self.people.get(rival, self.conn))
+                        if entry.isadmin:
+                            msg += f"{n}) [{time_hh}:{time_mm}] <b>{display_user}</b>\n"
+                        else:
+                            msg += f"{n}) [{time_hh}:{time_mm}] {display_user}\n"
+
+                return msg + f"\nLast log update: {self.logs.log_last_update}"
 
-            msg += f"\nLast log update: {self.logs.log_last_update}"
-            self.__send_message(msg)
+            ctx.reply(self.render_cache.get("/top", (self.logs.version, self.people.version, cmd_filter == "all"), render) + self._stale_warning())
         else:
-            self.__send_message("Sorry, only admins can use this function!")
+            ctx.reply("Sorry, only admins can use this function!")
 
-    def delete_cache(self):
-        if not self.user.isadmin:
-            self.__send_message("Sorry, only admins can use this function!")
+    @commands.command("/deletecache", admin_only=True, max_args=1, usage="Use /deletecache, or /deletecache memory to keep old logs saved on disk")
+    def delete_cache(self, ctx: UpdateContext, what: str = ""):
+        if not ctx.user.isadmin:
+            ctx.reply("Sorry, only admins can use this function!")
+            return
+        if what not in ("", "memory"):
+            ctx.reply("Use /deletecache, or /deletecache memory to keep old logs saved on disk")
             return
         users = self.users.delete_cache()
         people = self.people.delete_cache()
-        logs = self.logs.delete_cache()
+        logs = self.logs.delete_cache(keep_disk=what == "memory")
         quotes = self.quotes.delete_cache()
-        self.__send_message(
+        messages = self.render_cache.clear()
+        ctx.reply(
             "All caches busted! 💥\n"
             f"Users: deleted {users} entries\n"
             f"People: deleted {people} entries\n"
             f"Logs: deleted {logs} lines\n"
-            f"Quotes: deleted {quotes} lines"
+            f"Quotes: deleted {quotes} lines\n"
+            f"Rendered messages: deleted {messages} messages"
         )
 
-    def exception(self, exception: str):
+    def exception(self, ctx: UpdateContext, exception: str):
         msg = f"I tried to do that, but an exception occurred: {exception}"
-        self.__send_message(msg)
+        ctx.reply(msg)
 
-    def store_id(self):
-        first_name = self.__last_from["first_name"]
+    def store_id(self, ctx: UpdateContext):
+        first_name = ctx.sender["first_name"]
 
-        if "username" in self.__last_from:
-            username = self.__last_from["username"]
+        if "username" in ctx.sender:
+            username = ctx.sender["username"]
         else:
             username = ""
 
-        if "last_name" in self.__last_from:
-            last_name = self.__last_from["last_name"]
+        if "last_name" in ctx.sender:
+            last_name = ctx.sender["last_name"]
         else:
             last_name = ""
 
-        self.logs.store_new_user(self.__last_user_id, first_name, last_name, username)
+        self.logs.store_new_user(ctx.user_id, first_name, last_name, username)
 
-    def wol(self):
-        if not self.user.isadmin:
-            self.__send_message("Sorry, this is a feature reserved to admins.")
+    @commands.command("/wol", admin_only=True, latency=Latency.INSTANT)
+    def wol(self, ctx: UpdateContext):
+        if not ctx.user.isadmin:
+            ctx.reply("Sorry, this is a feature reserved to admins.")
             return
         buttons = []
         for machine in self.wol_dict:
             buttons.append([inline_keyboard_button(machine, "wol_" + machine)])
-        self.__send_inline_keyboard("Who do I wake up?", buttons)
+        ctx.reply_keyboard("Who do I wake up?", buttons)
 
-    def game(self, param=None):
+    @commands.command("/game", max_args=1)
+    def game(self, ctx: UpdateContext, param=None):
         if param is not None:
             if param == "stat" or param == "stats" or param == "statistics":
-                right, wrong = self.quotes.get_game_stats(self.user.uid)
+                right, wrong = self.quotes.get_game_stats(ctx.user.uid)
                 total = right + wrong
                 if total == 0:
-                    self.__send_message(f"You never played the game.")
+                    ctx.reply(f"You never played the game.")
                     return
                 right_percent = right * 100 / total
                 wrong_percent = wrong * 100 / total
-                self.__send_message(f"You answered {total} questions.\n" f"Right: {right} ({right_percent:2.1f}%)\nWrong: {wrong} ({wrong_percent:2.1f}%)")
+                ctx.reply(f"You answered {total} questions.\n" f"Right: {right} ({right_percent:2.1f}%)\nWrong: {wrong} ({wrong_percent:2.1f}%)")
             else:
-                self.unknown()
+                self.unknown(ctx)
         else:
-            quote, context, answers = self.quotes.get_quote_for_game(self.user.uid)
+            quote, context, answers = self.quotes.get_quote_for_game(ctx.user.uid)
             buttons = [
                 [
                     inline_keyboard_button(
@@ -1099,15 +1460,16 @@ as well.\nFor a list of the available commands type /help.",
             else:
                 context = ""
 
-            self.__send_inline_keyboard(
+            ctx.reply_keyboard(
                 f"{escape_all(quote)}{context}\n\n<i>{self.bot.game_question}</i>",
                 buttons,
             )
 
-    def lofi(self):
+    @commands.command("/lofi")
+    def lofi(self, ctx: UpdateContext):
         # check if stream is playing to show correct button
-        if not self.user_is_in_lab(self.user.uid) and not self.user.isadmin:
-            self.__send_message("You are not in lab, no relaxing lo-fi beats for you!")
+        if not self.user_is_in_lab(ctx.user.uid) and not ctx.user.isadmin:
+            ctx.reply("You are not in lab, no relaxing lo-fi beats for you!")
             return
         lofi_player = self.lofi_player.get_player()
         playing = lofi_player.is_playing()
@@ -1115,7 +1477,7 @@ as well.\nFor a list of the available commands type /help.",
         message = self.lofi_message(playing)
         reply_markup = self.lofi_keyboard(playing)
 
-        self.__send_inline_keyboard(message, reply_markup)
+        ctx.reply_keyboard(message, reply_markup)
 
     @staticmethod
     def lofi_message(playing):
@@ -1141,13 +1503,14 @@ as well.\nFor a list of the available commands type /help.",
         ]
         return reply_markup
 
-    def lofi_callback(self, query: str, messge_id: int):
+    @commands.callback("lofi_")
+    def lofi_callback(self, ctx: UpdateContext, query: str):
         lofi_player = self.lofi_player.get_player()
         playing = lofi_player.is_playing()
         try:
             query = AcceptableQueriesLoFi(query)
         except ValueError:
-            self.__send_message("I did not understand that button press")
+            ctx.reply("I did not understand that button press")
             return
 
         if query == AcceptableQueriesLoFi.play:
@@ -1157,14 +1520,14 @@ as well.\nFor a list of the available commands type /help.",
                     volume = self.lofi_player_last_volume
                 if volume == 0:
                     lofi_player.audio_set_volume(10)  # automatically turn up the volume by one notch
-                self.__edit_message(
-                    messge_id,
+                ctx.edit(
+                    ctx.message_id,
                     "Playing... - current volume: " + str(volume),
                     self.lofi_keyboard(True),
                 )
             else:  # == -1
-                self.__edit_message(
-                    messge_id,
+                ctx.edit(
+                    ctx.message_id,
                     "Stream could not be started because of an error.",
                     self.lofi_keyboard(playing),
                 )
@@ -1173,7 +1536,7 @@ as well.\nFor a list of the available commands type /help.",
             # there are no checks implemented for stop() in vlc.py
             self.lofi_player_last_volume = lofi_player.audio_get_volume()
             lofi_player.stop()  # .pause() only works on non-live streaming videos
-            self.__edit_message(messge_id, "Stopping...", self.lofi_keyboard(False))
+            ctx.edit(ctx.message_id, "Stopping...", self.lofi_keyboard(False))
 
         elif query == AcceptableQueriesLoFi.volume_down:
             # os.system("amixer -c 0 set PCM 3dB-")  # system volume
@@ -1181,18 +1544,18 @@ as well.\nFor a list of the available commands type /help.",
             if volume == -1:
                 volume = self.lofi_player_last_volume
             if lofi_player.audio_set_volume(volume - 10) == 0:
-                self.__edit_message(
-                    messge_id,
+                ctx.edit(
+                    ctx.message_id,
                     "Volume down 10% - current volume: " + str(volume - 10),
                     self.lofi_keyboard(playing),
                 )
                 if volume - 10 == 0:
                     self.lofi_player_last_volume = 0
                     lofi_player.stop()  # otherwise volume == -1
-                    self.__edit_message(messge_id, "Stopping...", self.lofi_keyboard(False))
+                    ctx.edit(ctx.message_id, "Stopping...", self.lofi_keyboard(False))
             else:  # == -1
-                self.__edit_message(
-                    messge_id,
+                ctx.edit(
+                    ctx.message_id,
                     "The volume is already muted.",
                     self.lofi_keyboard(playing),
                 )
@@ -1206,134 +1569,137 @@ as well.\nFor a list of the available commands type /help.",
                 if volume == 0:  # was muted, now resuming
                     if lofi_player.play() == 0:
                         lofi_player.audio_set_volume(10)
-                        self.__edit_message(
-                            messge_id,
+                        ctx.edit(
+                            ctx.message_id,
                             "Playing... - current volume: " + str(10),
                             self.lofi_keyboard(True),
                         )
                         return
                 if lofi_player.audio_set_volume(volume + 10) == 0:
-                    self.__edit_message(
-                        messge_id,
+                    ctx.edit(
+                        ctx.message_id,
                         "Volume up 10% - current volume: " + str(volume + 10),
                         self.lofi_keyboard(playing),
                     )
                 else:
-                    self.__edit_message(
-                        messge_id,
+                    ctx.edit(
+                        ctx.message_id,
                         "There was an error pumpin' up. Try hitting 'Play'.",
                         self.lofi_keyboard(playing),
                     )
             else:  # == -1
-                self.__edit_message(
-                    messge_id,
+                ctx.edit(
+                    ctx.message_id,
                     "The volume is already cranked up to 11.",
                     self.lofi_keyboard(playing),
                 )
 
         elif query == AcceptableQueriesLoFi.close:
-            self.__edit_message(messge_id, "Closed. 🐄\nUse /lofi to re-open.", None)
+            ctx.edit(ctx.message_id, "Closed. 🐄\nUse /lofi to re-open.", None)
 
-    def wol_callback(self, query: str, message_id: int):
+    @commands.callback("wol_", admin_only=True, latency=Latency.INSTANT)
+    def wol_callback(self, ctx: UpdateContext, query: str):
         machine = query.split("_", 1)[1]
         mac = self.wol_dict.get(machine, None)
         if mac is None:
-            self.__send_message("That machine does not exist")
+            ctx.reply("That machine does not exist")
             return
         Wol.send(mac)
-        self.__edit_message(message_id, f"Waking up {machine} ({mac}) from its slumber...", None)
+        ctx.edit(ctx.message_id, f"Waking up {machine} ({mac}) from its slumber...", None)
 
     # noinspection PyUnusedLocal
-    def game_callback(self, query: str, message_id: int):
+    @commands.callback("game_")
+    def game_callback(self, ctx: UpdateContext, query: str):
         answer = query.split("_", 1)[1]
-        result = self.quotes.answer_game(self.user.uid, answer)
+        result = self.quotes.answer_game(ctx.user.uid, answer)
         if result is None:
-            self.__send_message("I somehow forgot the question, sorry")
+            ctx.reply("I somehow forgot the question, sorry")
             return
         elif result is True:
-            self.__send_message("🏆 You're winner! 🏆\nAnother one? /game")
+            ctx.reply("🏆 You're winner! 🏆\nAnother one? /game")
             return
         else:
-            self.__send_message(f"Nope, that quote was from {result}\nAnother one? /game")
+            ctx.reply(f"Nope, that quote was from {result}\nAnother one? /game")
 
-    def tolab_callback(self, query: str, message_id: int, user_id: int):
+    def tolab_callback(self, ctx: UpdateContext, query: str, message_id: int):
         # ---------------- READMEEEEEEEEEEEEEE --------------------
         # PLEASE, do not touch anything if you're not absolutely sure about what are you doing. Thanks
         query = query.replace(".", ":")
         data = query.split(":")
 
         if data[0] == "hour":
-            for idx, session in enumerate(self.bot.active_sessions):
-                if session[0] == user_id:
-                    day = self._get_tolab_gui_days(idx, self.bot.active_sessions[idx][2])
-                    sir_message = ""
-                    if data[-2] != "hour":
-                        hour_str = data[-2]
-                        minute_str = data[-1]
-                        # hour_str could be only one character, but minute_str should always be 2 characters long
-                        # e.g. 9.27 or 8:30
-                        if not hour_str or not minute_str or len(hour_str) > 2 or len(minute_str) != 2:
-                            self.bot.edit_message(
-                                chat_id=self.__last_chat_id,
-                                message_id=message_id,
-                                text="❌ Use correct time format, e.g. 10:30. Please, retry /tolab",
-                            )
-                            del self.bot.active_sessions[idx]
-                            return
-                    else:
-                        hour_str = data[-1]
-                        if not hour_str or len(hour_str) > 2:
-                            self.bot.edit_message(
-                                chat_id=self.__last_chat_id,
-                                message_id=message_id,
-                                text="❌ Use correct time format, e.g. 10:30. Please, retry /tolab",
-                            )
-                            del self.bot.active_sessions[idx]
-                            return
-                    if (not self.user.signedsir) and (self.user.dateofsafetytest is not None):
-                        sir_message = "\nRemember to sign the SIR when you get there! 📝"
-                        # if people do tolab for a day that is after tomorrow then send also the "mark it down" message
-                        if day > 1:
-                            sir_message += "\nMark it down on your calendar!"
-                    if day < 0:
+            session = self.bot.active_sessions.get(ctx.user_id)
+            if session is not None:
+                tolab_date = session[1]
+                day = self._get_tolab_gui_days(tolab_date)
+                sir_message = ""
+                if data[-2] != "hour":
+                    hour_str = data[-2]
+                    minute_str = data[-1]
+                    # hour_str could be only one character, but minute_str should always be 2 characters long
+                    # e.g. 9.27 or 8:30
+                    if not hour_str or not minute_str or len(hour_str) > 2 or len(minute_str) != 2:
                         self.bot.edit_message(
-                            chat_id=self.__last_chat_id,
+                            chat_id=ctx.chat_id,
                             message_id=message_id,
-                            text="❌ You've selected a past date. Please select a valid date.",
+                            text="❌ Use correct time format, e.g. 10:30. Please, retry /tolab",
                         )
-                        del self.bot.active_sessions[idx]
+                        self.bot.active_sessions.pop(ctx.user_id, None)
                         return
-                    if day == 0:
-                        day = None
-                    else:
-                        day = f"+{day}"
-                    if len(data) > 2:
-                        self.tolab(the_time=f"{data[1]}:{data[2]}", day=day, is_gui=True)
-                        self.bot.edit_message(
-                            chat_id=self.__last_chat_id,
-                            message_id=message_id,
-                            text=f"✅ So you're going to lab at {data[1]}:{data[2]} of "
-                            f"{self.bot.active_sessions[idx][2]}. See you inlab!\nUse /tolab_no "
-                            f"to cancel. Check if anybody else is coming with /inlab.\n"
-                            f"{sir_message}",
-                        )
-                    else:
-                        self.tolab(the_time=f"{data[1]}", day=day, is_gui=True)
+                else:
+                    hour_str = data[-1]
+                    if not hour_str or len(hour_str) > 2:
                         self.bot.edit_message(
-                            chat_id=self.__last_chat_id,
+                            chat_id=ctx.chat_id,
                             message_id=message_id,
-                            text=f"✅ So you're going to lab at {data[1]}:00 of "
-                            f"{self.bot.active_sessions[idx][2]}. See you inlab!\nUse /tolab_no "
-                            f"to cancel. Check if anybody else is coming with /inlab.\n"
-                            f"{sir_message}",
+                            text="❌ Use correct time format, e.g. 10:30. Please, retry /tolab",
                         )
-
-                    del self.bot.active_sessions[idx]
+                        self.bot.active_sessions.pop(ctx.user_id, None)
+                        return
+                if (not ctx.user.signedsir) and (ctx.user.dateofsafetytest is not None):
+                    sir_message = "\nRemember to sign the SIR when you get there! 📝"
+                    # if people do tolab for a day that is after tomorrow then send also the "mark it down" message
+                    if day > 1:
+                        sir_message += "\nMark it down on your calendar!"
+                if day < 0:
+                    self.bot.edit_message(
+                        chat_id=ctx.chat_id,
+                        message_id=message_id,
+                        text="❌ You've selected a past date. Please select a valid date.",
+                    )
+                    self.bot.active_sessions.pop(ctx.user_id, None)
                     return
+                if day == 0:
+                    day = None
+                else:
+                    day = f"+{day}"
+                if len(data) > 2:
+                    self.tolab(ctx, the_time=f"{data[1]}:{data[2]}", day=day, is_gui=True)
+                    self.bot.edit_message(
+                        chat_id=ctx.chat_id,
+                        message_id=message_id,
+                        text=f"✅ So you're going to lab at {data[1]}:{data[2]} of "
+                        f"{tolab_date}. See you inlab!\nUse /tolab_no "
+                        f"to cancel. Check if anybody else is coming with /inlab.\n"
+                        f"{sir_message}",
+                    )
+                else:
+                    self.tolab(ctx, the_time=f"{data[1]}", day=day, is_gui=True)
+                    self.bot.edit_message(
+                        chat_id=ctx.chat_id,
+                        message_id=message_id,
+                        text=f"✅ So you're going to lab at {data[1]}:00 of "
+                        f"{tolab_date}. See you inlab!\nUse /tolab_no "
+                        f"to cancel. Check if anybody else is coming with /inlab.\n"
+                        f"{sir_message}",
+                    )
+
+                self.bot.active_sessions.pop(ctx.user_id, None)
+                return
         elif data[1] == "forward_month":
             calendar = Tolab_Calendar(data[2]).make()
             self.bot.edit_message(
-                chat_id=self.__last_chat_id,
+                chat_id=ctx.chat_id,
                 message_id=message_id,
                 text=f"Select a date",
                 reply_markup=calendar,
@@ -1341,38 +1707,30 @@ as well.\nFor a list of the available commands type /help.",
         elif data[1] == "backward_month":
             calendar = Tolab_Calendar(data[2]).make()
             self.bot.edit_message(
-                chat_id=self.__last_chat_id,
+                chat_id=ctx.chat_id,
                 message_id=message_id,
                 text=f"Select a date",
                 reply_markup=calendar,
             )
         elif data[1] == "cancel_tolab":
-            for idx, session in enumerate(self.bot.active_sessions):
-                if session == self.__last_chat_id:
-                    del self.bot.active_sessions[idx]
+            self.bot.active_sessions.pop(ctx.user_id, None)
             self.bot.edit_message(
-                chat_id=self.__last_chat_id,
+                chat_id=ctx.chat_id,
                 message_id=message_id,
                 text=f"❌ Tolab canceled.",
             )
         elif data[1] != " " and data[1] != "None":
             self.bot.edit_message(
-                chat_id=self.__last_chat_id,
+                chat_id=ctx.chat_id,
                 message_id=message_id,
                 text=f"🕐 Now, send a message with the hour you're going to lab",
             )
-            for idx, session in enumerate(self.bot.active_sessions):
-                if user_id == session[0]:
-                    return
-                if (idx + 1) == len(self.bot.active_sessions):
-                    self.bot.active_sessions.append([user_id, message_id, f"{data[1]} {data[2]}"])
-                    return
-            # This is horrendous but it werks
-            self.bot.active_sessions.append([user_id, message_id, f"{data[1]} {data[2]}"])
+            # Keep the first day chosen, if the user presses more than one
+            self.bot.active_sessions.setdefault(ctx.user_id, (message_id, f"{data[1]} {data[2]}"))
 
-    def logout(self, words):
-        if not self.user.isadmin:
-            self.__send_message("Sorry, this is a feature reserved to admins. You can ask an admin to do your logout.")
+    def logout(self, ctx: UpdateContext, words):
+        if not ctx.user.isadmin:
+            ctx.reply("Sorry, this is a feature reserved to admins. You can ask an admin to do your logout.")
             return
 
         username = words[0]
@@ -1383,12 +1741,12 @@ as well.\nFor a list of the available commands type /help.",
         logout_message.rstrip().replace("  ", " ")
 
         if '"' in logout_message:
-            self.__send_message("What have I told you? The logout message cannot contain double quotes.\n" "Please try again.")
-            self.logout_help()
+            ctx.reply("What have I told you? The logout message cannot contain double quotes.\n" "Please try again.")
+            self.logout_help(ctx)
             return
 
         if logout_message.__len__() > MAX_WORK_DONE:
-            self.__send_message("Try not to write the story of your life. Re-send a shorter logout message with /logout")
+            ctx.reply("Try not to write the story of your life. Re-send a shorter logout message with /logout")
             return
 
         # send commands
@@ -1404,34 +1762,32 @@ as well.\nFor a list of the available commands type /help.",
 
             # SSH worked, check return code
             if ssh_connection.execute_command():
-                self.__check_weeelab_ssh(ssh_connection, username, "Logout")
+                self.__check_weeelab_ssh(ctx, ssh_connection, username, "Logout")
 
             # SSH didn't work
             else:
                 # wol always exits with 0, cannot check if it worked
                 Wol.send(WOL_WEEELAB)
-                self.__send_message(
-                    "Sent wol command. Waiting a couple minutes until it's completed.\n" "I'll reach out to you when I've completed the logout process."
-                )
+                ctx.reply("Sent wol command. Waiting a couple minutes until it's completed.\n" "I'll reach out to you when I've completed the logout process.")
                 # boot time is around 115 seconds
                 # check instead of guessing when the machine has finished booting
                 while True:
                     sleep(10)
                     if ssh_connection.execute_command():
-                        self.__check_weeelab_ssh(ssh_connection, username, "Logout")
+                        self.__check_weeelab_ssh(ctx, ssh_connection, username, "Logout")
                         break
 
             # give the user the option to shutdown the logout machine
-            self.shutdown_prompt(Machines.scma)
+            self.shutdown_prompt(ctx, Machines.scma)
         else:
             if os.system(command) == 0:
-                self.__send_message(f"{username} logged out!")
+                ctx.reply(f"{username} logged out!")
 
         return
 
-    def login(self, words):
-        if not self.user.isadmin:
-            self.__send_message("Sorry, this is a feature reserved to admins. You can ask an admin to do your login.")
+    def login(self, ctx: UpdateContext, words):
+        if not ctx.user.isadmin:
+            ctx.reply("Sorry, this is a feature reserved to admins. You can ask an admin to do your login.")
             return
 
         username = words[0]
@@ -1450,47 +1806,45 @@ as well.\nFor a list of the available commands type /help.",
 
             # SSH worked, check return code
             if ssh_connection.execute_command():
-                self.__check_weeelab_ssh(ssh_connection, username, "Login")
+                self.__check_weeelab_ssh(ctx, ssh_connection, username, "Login")
 
             # SSH didn't work
             else:
                 # wol always exits with 0, cannot check if it worked
                 Wol.send(WOL_WEEELAB)
-                self.__send_message(
-                    "Sent wol command. Waiting a couple minutes until it's completed.\n" "I'll reach out to you when I've completed the login process."
-                )
+                ctx.reply("Sent wol command. Waiting a couple minutes until it's completed.\n" "I'll reach out to you when I've completed the login process.")
                 # boot time is around 115 seconds
                 # check instead of guessing when the machine has finished booting
                 while True:
                     sleep(10)
                     if ssh_connection.execute_command():
-                        self.__check_weeelab_ssh(ssh_connection, username, "Login")
+                        self.__check_weeelab_ssh(ctx, ssh_connection, username, "Login")
                         break
 
             # give the user the option to shutdown the logout machine
-            self.shutdown_prompt(Machines.scma)
+            self.shutdown_prompt(ctx, Machines.scma)
         else:
             if os.system(command) == 0:
-                self.__send_message(f"{username} logged in!")
+                ctx.reply(f"{username} logged in!")
 
         return
 
-    def __check_weeelab_ssh(self, ssh_connection, username: str, action: str):
+    def __check_weeelab_ssh(self, ctx: UpdateContext, ssh_connection, username: str, action: str):
         # weeelab logout worked
         if ssh_connection.return_code == 0:
-            self.__send_message(action + " for " + username + " completed!")
+            ctx.reply(action + " for " + username + " completed!")
         # weeelab logout didn't work
         elif ssh_connection.return_code == 3:
-            self.__send_message(action + " didn't work. Try checking the parameters you've sent me.")
+            ctx.reply(action + " didn't work. Try checking the parameters you've sent me.")
         else:
-            self.__send_message("Unexpected weeelab return code. Please check what happened.")
+            ctx.reply("Unexpected weeelab return code. Please check what happened.")
         return
 
-    def quote(self, author: Optional[str]):
+    def quote(self, ctx: UpdateContext, author: Optional[str]):
         quote, author, context, _ = self.quotes.get_random_quote(author)
 
         if quote is None:
-            self.__send_message("No quotes found 🙁")
+            ctx.reply("No quotes found 🙁")
             return
 
         if context:
@@ -1498,20 +1852,22 @@ as well.\nFor a list of the available commands type /help.",
         else:
             context = ""
 
-        self.__send_message(f"{escape_all(quote)} - <i>{escape_all(author)}</i>{escape_all(context)}")
+        ctx.reply(f"{escape_all(quote)} - <i>{escape_all(author)}</i>{escape_all(context)}")
 
-    def motivami(self):
+    @commands.command("/motivami")
+    def motivami(self, ctx: UpdateContext):
         quote = self.quotes.get_demotivational_quote()
 
         if quote is None:
-            self.__send_message("No demotivational quotes found 🙁")
+            ctx.reply("No demotivational quotes found 🙁")
             return
 
-        self.__send_message(escape_all(quote))
+        ctx.reply(escape_all(quote))
 
-    def i_am_door(self):
-        if not self.user.isadmin:
-            self.__send_message("Sorry, this is a feature reserved to admins. You can ask an admin to do your logout.")
+    @commands.command("/door", admin_only=True, heavy=True, latency=Latency.SLOW)
+    def i_am_door(self, ctx: UpdateContext):
+        if not ctx.user.isadmin:
+            ctx.reply("Sorry, this is a feature reserved to admins. You can ask an admin to do your logout.")
             return
 
         ssh_connection = SSHUtil(
@@ -1526,27 +1882,25 @@ as well.\nFor a list of the available commands type /help.",
         if not ssh_connection.execute_command():
             # wol always exits with 0, cannot check if it worked
             Wol.send(WOL_I_AM_DOOR)
-            self.__send_message(
-                "Sent wol command. Waiting a couple minutes until it's completed.\n" "I'll reach out to you when I've completed the logout process."
-            )
+            ctx.reply("Sent wol command. Waiting a couple minutes until it's completed.\n" "I'll reach out to you when I've completed the logout process.")
             while True:
                 sleep(10)
                 if ssh_connection.execute_command():
                     break
 
-        self.__send_message("IO. SONO. PORTA.")
+        ctx.reply("IO. SONO. PORTA.")
 
         # give the user the option to shutdown the logout machine
         # actually don't since it could break some disks during formatting
-        # self.shutdown_prompt(Machines.piall)
+        # self.shutdown_prompt(ctx, Machines.piall)
 
         return
 
-    def shutdown_prompt(self, machine):
+    def shutdown_prompt(self, ctx: UpdateContext, machine):
         try:
             machine = Machines(machine)
         except ValueError:
-            self.__send_message("That machine does not exist!")
+            ctx.reply("That machine does not exist!")
             return
 
         if machine == Machines.scma:
@@ -1556,7 +1910,7 @@ as well.\nFor a list of the available commands type /help.",
             yes = AcceptableQueriesShutdown.i_am_door_yes.value
             no = AcceptableQueriesShutdown.i_am_door_no.value
         else:
-            self.__send_message("That machine does not exist!")
+            ctx.reply("That machine does not exist!")
             return
 
         message = "Do you want to shutdown the machine now?"
@@ -1564,15 +1918,15 @@ as well.\nFor a list of the available commands type /help.",
             [inline_keyboard_button("Kill it with fire!", callback_data=yes)],
             [inline_keyboard_button("No, it's crucial that it stays alive!", callback_data=no)],
         ]
-        self.__send_inline_keyboard(message, reply_markup)
+        ctx.reply_keyboard(message, reply_markup)
 
-    def shutdown_callback(self, query, message_id: int, ssh_user: str, ssh_host_ip: str, ssh_key_path: str):
+    def shutdown_callback(self, ctx: UpdateContext, query, ssh_user: str, ssh_host_ip: str, ssh_key_path: str):
         shutdown_retry_times = 5
 
         try:
             query = AcceptableQueriesShutdown(query)
         except ValueError:
-            self.__send_message("I did not understand that button press")
+            ctx.reply("I did not understand that button press")
             return
 
         if query == AcceptableQueriesShutdown.weeelab_yes or query == AcceptableQueriesShutdown.i_am_door_yes:
@@ -1586,21 +1940,22 @@ as well.\nFor a list of the available commands type /help.",
 
             for _ in range(shutdown_retry_times):
                 if ssh_connection.execute_command():
-                    self.__edit_message(message_id, "Shutdown successful!", None)
+                    ctx.edit(ctx.message_id, "Shutdown successful!", None)
                     break
                 else:
-                    self.__edit_message(
-                        message_id,
+                    ctx.edit(
+                        ctx.message_id,
                         "There was an issue with the shutdown. Retrying...",
                         None,
                     )
 
         elif query == AcceptableQueriesShutdown.weeelab_no or query == AcceptableQueriesShutdown.i_am_door_no:
-            self.__edit_message(message_id, "Alright, we'll leave it alive. <i>For now.</i>", None)
+            ctx.edit(ctx.message_id, "Alright, we'll leave it alive. <i>For now.</i>", None)
 
-    def status(self):
-        if not self.user.isadmin:
-            self.__send_message("Sorry, this is a feature reserved to admins.")
+    @commands.command("/status", admin_only=True)
+    def status(self, ctx: UpdateContext):
+        if not ctx.user.isadmin:
+            ctx.reply("Sorry, this is a feature reserved to admins.")
             return
         uptime_out = f"<code>{run_shell_cmd('uptime')}</code>"
         # enable if you want to check network speed, it takes 30ish seconds to run though
@@ -1608,8 +1963,64 @@ as well.\nFor a list of the available commands type /help.",
         free_h_out = f"<code>{run_shell_cmd('free -h')}</code>"
         df_h_root_out = f"<code>{run_shell_cmd('df -h /')}</code>"
         python_out = f"<code>{run_shell_cmd('pgrep -a python')}</code>"
+        dispatcher_out = f"Handlers: <b>{self.dispatcher.in_flight}</b> running, <b>{self.dispatcher.queue_depth}</b> queued, {self.dispatcher.workers} workers"
+
+        telegram_out = "Telegram API:"
+        for endpoint, stats in sorted(ctx.bot.get_stats().items()):
+            telegram_out += (
+                f"\n<code>{endpoint}</code>: {stats.calls} calls, {stats.failures} failed, "
+                f"{stats.average_seconds * 1000:.0f} ms avg, {stats.max_seconds * 1000:.0f} ms max"
+            )
+
+        outbox_out = f"Outbox: <b>{ctx.bot.queue_depth}</b> queued"
+        for priority, stats in ctx.bot.get_outbox_stats().items():
+            outbox_out += (
+                f"\n{priority.name.lower()}: {stats.sent} sent, {stats.coalesced} edits merged, "
+                f"waited {stats.average_wait * 1000:.0f} ms avg, {stats.max_wait * 1000:.0f} ms max"
+            )
+
+        logs_out = (
+            f"Logs: {self.logs.log_refreshes} refreshes of log.txt, {self.logs.log_not_modified} not modified, {self.logs.log_incremental} incremental, "
+            f"{self.logs.old_logs_downloaded} old logs downloaded, {self.logs.old_logs_from_disk} from disk, "
+            f"{self.logs.rejected_lines} malformed lines skipped, {self.logs.log_failures} failed downloads"
+        )
+        if self.logs.stale:
+            logs_out += f"\n<b>Stale</b> since the last download failed: {escape_all(self.logs.error)}"
+        if self.logs.pg_pool is not None:
+            pool = self.logs.pg_pool.get_stats()
+            logs_out += (
+                f"\nGrillo DB: {pool.size} connections, {pool.idle} idle, {pool.checkouts} checkouts, "
+                f"{pool.waits} waited {pool.average_wait * 1000:.0f} ms avg {pool.max_wait * 1000:.0f} ms max, "
+                f"{pool.timeouts} timeouts, {pool.failures} failed connections, {pool.discarded} broken ones replaced"
+            )
+        if self.logs.grillo_listener is not None:
+            listener = self.logs.grillo_listener
+            logs_out += (
+                f"\nGrillo notifications: {'listening' if listener.listening else '<b>not listening</b>'}, "
+                f"{listener.notifications} received, {listener.reconnections} connections"
+            )
+
+        render_out = "Rendered messages:"
+        for name, stats in sorted(self.render_cache.get_stats().items()):
+            render_out += f"\n{name}: {stats.hits} reused, {stats.misses} built, {stats.hit_rate * 100:.0f}% hit rate"
+
+        caches_out = "Caches:"
+        for cache in (self.logs.log_cache, self.users.cache, self.people.cache, self.quotes.quotes_cache, self.quotes.demotivational_cache):
+            stats = cache.get_stats()
+            caches_out += (
+                f"\n{cache.name}: {stats.size} entries, {stats.hits} hits, {stats.stale_hits} stale, {stats.misses} misses, "
+                f"{stats.loads} loads, {stats.load_failures} failed, {stats.evictions} evicted"
+            )
 
-        self.__send_message("\n\n".join([uptime_out, free_h_out, df_h_root_out, python_out]))
+        commands_out = "Commands:"
+        for name, stats in sorted(commands.get_stats().items(), key=lambda item: -item[1].calls):
+            commands_out += f"\n{name}: {stats.calls} calls, {stats.average_seconds * 1000:.0f} ms avg, {stats.max_seconds * 1000:.0f} ms max"
+
+        ctx.reply(
+            "\n\n".join(
+                [uptime_out, free_h_out, df_h_root_out, python_out, dispatcher_out, telegram_out, outbox_out, logs_out, caches_out, render_out, commands_out]
+            )
+        )
 
     @staticmethod
     def __get_telegram_link_to_person(p: Person) -> str:
@@ -1654,9 +2065,10 @@ as well.\nFor a list of the available commands type /help.",
         """
         return self.__sorted_birthday_people()[:n]
 
-    def next_birthdays(self):
-        if not self.user.isadmin:
-            self.__send_message("Sorry, this is a feature reserved to admins.")
+    @commands.command("/nextbirthdays", admin_only=True)
+    def next_birthdays(self, ctx: UpdateContext):
+        if not ctx.user.isadmin:
+            ctx.reply("Sorry, this is a feature reserved to admins.")
             return
 
         bd_people = "\n".join(
@@ -1668,7 +2080,7 @@ as well.\nFor a list of the available commands type /help.",
                 for p in self.__next_birthday_people()
             ]
         )
-        self.__send_message(f"The people who have a coming birthday 🎂 are:\n\n{bd_people}")
+        ctx.reply(f"The people who have a coming birthday 🎂 are:\n\n{bd_people}")
 
     def birthday_wisher(self):
         """
@@ -1714,7 +2126,7 @@ as well.\nFor a list of the available commands type /help.",
                         f"{birthday_wishes}"
                         f"\n\n{birthday_decoration}"
                     )
-                    self.bot.send_message(chat_id=WEEE_CHAT_ID, text=birthday_msg)
+                    self.bot.send_message(chat_id=WEEE_CHAT_ID, text=birthday_msg, priority=Priority.BROADCAST)
                     sleep(60)  # TODO: do we need this?
 
             except Exception as e:
@@ -1743,9 +2155,10 @@ as well.\nFor a list of the available commands type /help.",
             )
         ]
 
-    def next_tests(self):
-        if not self.user.isadmin:
-            self.__send_message("Sorry, this is a feature reserved to admins.")
+    @commands.command("/nexttests", admin_only=True)
+    def next_tests(self, ctx: UpdateContext):
+        if not ctx.user.isadmin:
+            ctx.reply("Sorry, this is a feature reserved to admins.")
             return
 
         test_people = "\n".join(
@@ -1756,7 +2169,7 @@ as well.\nFor a list of the available commands type /help.",
                 for p in self.__next_test_people()
             ]
         )
-        self.__send_message(f"The people who have a coming safety test 🛠 are:\n\n{test_people}" if test_people else "No safety tests planned at the moment.")
+        ctx.reply(f"The people who have a coming safety test 🛠 are:\n\n{test_people}" if test_people else "No safety tests planned at the moment.")
 
     def safety_test_reminder(self):
         """
@@ -1778,51 +2191,54 @@ as well.\nFor a list of the available commands type /help.",
 
                 if test_people:
                     reminder_msg = f"⚠️⚠️⚠️\nOggi c'è il <b>test di sicurezza</b> di:\n{', '.join(test_people)}"
-                    self.bot.send_message(chat_id=WEEE_CHAT2_ID, text=reminder_msg)
+                    self.bot.send_message(chat_id=WEEE_CHAT2_ID, text=reminder_msg, priority=Priority.BROADCAST)
                     sleep(60)
 
             except Exception as e:
                 print(e)
 
-    def id(self):
-        self.__send_message(f"Your Telegram ID is: {self.user.uid}")
+    @commands.command("/id", latency=Latency.INSTANT)
+    def id(self, ctx: UpdateContext):
+        ctx.reply(f"Your Telegram ID is: {ctx.user.uid}")
 
-    def unknown(self):
+    def unknown(self, ctx: UpdateContext):
         """
         Called when an unknown command is received
         """
-        self.__send_message(self.bot.unknown_command_message + "\n\nType /help for list of commands")
+        ctx.reply(self.bot.unknown_command_message + "\n\nType /help for list of commands")
 
-    def tolab_help(self):
+    def tolab_help(self, ctx: UpdateContext):
         help_message = "Use /tolab and the time to tell the bot when you'll go to the lab.\n\n\
 For example type <code>/tolab 10:30</code> if you're going at 10:30.\n\
 You can also set the day: <code>/tolab 10:30 +1</code> for tomorrow, <code>+2</code> for the day after tomorrow and so\
 on. If you don't set a day, I will consider the time for today or tomorrow, the one which makes more sense.\n\
 You can use <code>/tolab no</code> to cancel your plans and /inlab to see who's going when."
-        self.__send_message(help_message)
+        ctx.reply(help_message)
 
-    def logout_help(self):
+    def logout_help(self, ctx: UpdateContext):
         help_message = """
 Use /logout followed by a username and a description of what they've done to logout that user via weeelab.\n\n\
 An example would be: /logout asd.asdoni Riparato PC 69.\n\
 No special symbols are needed to separate the different fields, just use spaces.\n\
 Note: the username <b>must</b> be a single word with no spaces in between.\n\
 Note: the logout message cannot contain double quotes characters such as " """
-        self.__send_message(help_message)
+        ctx.reply(help_message)
 
-    def login_help(self):
+    def login_help(self, ctx: UpdateContext):
         help_message = """
 Use /login followed by a username to login that user via weeelab.\n\n\
 An example would be: /logout asd.asdoni\n\
 Note: the username <b>must</b> be a single word with no spaces in between.\n"""
-        self.__send_message(help_message)
+        ctx.reply(help_message)
 
-    def help(self):
+    @commands.command("/help")
+    def help(self, ctx: UpdateContext):
         help_message = """Available commands and options:
 /inlab - Show the people in lab
 /tolab - Show other people when you are going to the lab
 /log - Show log of the day
-/log <i>n</i> - Show last <i>n</i> days worth of logs
+/log <i>n</i> - Show last <i>n</i> days worth of logs, up to 31
+/log <i>YYYY-MM-DD</i> - Show log of that day
 /stat - Show hours you've spent in lab
 /ring - Ring the bell at the door
 /item <i>code</i> - Show info about an item
@@ -1831,13 +2247,14 @@ Note: the username <b>must</b> be a single word with no spaces in between.\n"""
 /id - Show your Telegram ID
 /lofi - Spawns a keyboard with media controls for the lofi YouTube stream"""
 
-        if self.user.isadmin:
+        if ctx.user.isadmin:
             help_message += """
 \n<b>only for admin users</b>
 /stat <i>username</i> - Show hours spent in lab by this user
 /top - Show a list of top users by hours spent this month
 /top all - Show a list of top users by hours spent
 /deletecache - Delete caches (reload logs and users)
+/deletecache memory - Delete caches, but keep old logs saved on disk
 /logout <i>username</i> <i>description of what they've done</i> - Logout a user with weeelab
 /login <i>username</i> - Login a user with weeelab
 /wol - Spawns a keyboard with machines an admin can Wake On LAN
@@ -1845,18 +2262,156 @@ Note: the username <b>must</b> be a single word with no spaces in between.\n"""
 /status - Show host machine uptime, load, memory and disk usage
 /nextbirthdays - Show next people who will have a birthday
 /nexttests - Show next people who will have a safety test"""
-        self.__send_message(help_message)
+        ctx.reply(help_message)
+
+
+# Commands and callbacks that need some adapting to call a CommandHandler method
+commands.add_command("/tolab_no", lambda handler, ctx: handler.tolab(ctx, "no"))
+commands.add_command(
+    "/quote", lambda handler, ctx, *words: handler.quote(ctx, " ".join(words) if len(words) > 0 else None), max_args=None, latency=Latency.INSTANT
+)
+# These take minutes if the machine has to boot, don't hold up the chat in the meantime
+commands.add_command(
+    "/logout",
+    lambda handler, ctx, *words: handler.logout(ctx, list(words)),
+    min_args=1,
+    max_args=None,
+    usage=lambda handler, ctx: handler.logout_help(ctx),
+    admin_only=True,
+    heavy=True,
+    latency=Latency.SLOW,
+)
+commands.add_command(
+    "/login",
+    lambda handler, ctx, username: handler.login(ctx, [username]),
+    min_args=1,
+    max_args=1,
+    strict=True,
+    usage=lambda handler, ctx: handler.login_help(ctx),
+    admin_only=True,
+    heavy=True,
+    latency=Latency.SLOW,
+)
+commands.add_callback(
+    "weeelab_",
+    lambda handler, ctx, query: handler.shutdown_callback(ctx, query, SSH_SCMA_USER, SSH_SCMA_HOST_IP, SSH_SCMA_KEY_PATH),
+    admin_only=True,
+    latency=Latency.SLOW,
+)
+commands.add_callback(
+    "i_am_door_",
+    lambda handler, ctx, query: handler.shutdown_callback(ctx, query, SSH_PIALL_USER, SSH_PIALL_HOST_IP, SSH_PIALL_KEY_PATH),
+    admin_only=True,
+    latency=Latency.SLOW,
+)
+commands.add_callback("tolab:", lambda handler, ctx, query: handler.tolab_callback(ctx, query, ctx.message_id))
+
+
+def update_chat_id(update: dict) -> Optional[int]:
+    """
+    Find which chat an update comes from, if any
+    """
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    if "callback_query" in update and "message" in update["callback_query"]:
+        return update["callback_query"]["message"]["chat"]["id"]
+    if "my_chat_member" in update:
+        return update["my_chat_member"]["chat"]["id"]
+    return None
 
 
-def main():
-    """main function of the bot"""
-    print("Entered main")
-    oc = owncloud.Client(OC_URL)
+def dispatch_update(bot: BotHandler, handler: CommandHandler, last_update: dict):
+    """
+    Handle a single update received from Telegram
+    """
+    # per Telegram docs, either message or callback_query are None
+    # noinspection PyBroadException
+    try:
+        if "my_chat_member" in last_update:
+            # Leave scam channels where people add our bot randomly, as soon as they add it
+            chat = last_update["my_chat_member"]["chat"]
+            status = last_update["my_chat_member"]["new_chat_member"]["status"]
+            if chat["type"] == "channel" and status in ("member", "administrator"):
+                print(f"Left channel {chat['id']}: {bot.leave_chat(chat['id'])}")
+
+        # Ignore images, stickers and stuff like that
+        elif "message" in last_update and "text" not in last_update["message"]:
+            return
+
+        # see https://core.telegram.org/bots/api#message
+        elif "message" in last_update and "text" in last_update["message"]:
+            # Handle private messages
+            name, args = commands.parse(last_update["message"]["text"])
+            message_type = last_update["message"]["chat"]["type"]
+            # print(last_update['message'])  # Extremely advanced debug techniques
+
+            # Don't respond to messages in group chats
+            if message_type != "private":
+                return
+
+            ctx = UpdateContext.from_message(bot, last_update)
+            authorized = handler.read_user(ctx, last_update["message"]["text"])
+            if not authorized:
+                return
+
+            route = commands.find_command(name)
+            if route is None:
+                # Waiting for the hour after /tolab?
+                session = handler.get_tolab_active_sessions().get(ctx.user_id)
+                if session is not None:
+                    handler.tolab_callback(ctx, f"hour:{name}", session[0])
+                else:
+                    handler.unknown(ctx)
+                return
+
+            args = commands.check_args(route, args)
+            if args is None:
+                commands.usage(route, handler, ctx)
+            elif route.heavy:
+                handler.dispatcher.submit_unordered(commands.run, route, handler, ctx, *args)
+            else:
+                commands.run(route, handler, ctx, *args)
+
+        elif "callback_query" in last_update:
+            ctx = UpdateContext.from_callback(bot, last_update)
+            authorized = handler.read_user(ctx)
+            if not authorized:
+                return
+
+            # Handle button callbacks
+            query = last_update["callback_query"]["data"]
+            route = commands.find_callback(query)
+            if route is None:
+                handler.unknown(ctx)
+            elif route.heavy:
+                handler.dispatcher.submit_unordered(commands.run, route, handler, ctx, query)
+            else:
+                commands.run(route, handler, ctx, query)
+        else:
+            print('Unsupported "last_update" type')
+            print(last_update)
+
+    except:  # catch any exception if raised
+        print("ERROR!")
+        print(last_update)
+        print(traceback.format_exc())
+
+
+def start_bot(bot, dispatcher):
+    """
+    Connect to everything and start the background jobs
+
+    :param bot: Outbox in front of the BotHandler
+    :param dispatcher: Dispatcher for long-running commands
+    :return: CommandHandler
+    """
+    oc = OwnCloudClient(OC_URL)
     oc.login(OC_USER, OC_PWD)
 
-    bot = BotHandler(TOKEN_BOT)
     tarallo = Tarallo(TARALLO, TARALLO_TOKEN)
-    logs = WeeelabLogs(oc, LOG_PATH, LOG_BASE, USER_BOT_PATH)
+    logs = WeeelabLogs(oc, LOG_PATH, LOG_BASE, USER_BOT_PATH, LOG_CACHE_DIR, OLD_LOGS_WORKERS, LOG_STORE == "columnar")
+    if LOG_REFRESH_SECONDS > 0:
+        logs.start_refresher(LOG_REFRESH_SECONDS)
     tolab = ToLab(oc, TOLAB_PATH)
     if os.path.isfile("weeedong.wav"):
         wave_obj = simpleaudio.WaveObject.from_wave_file("weeedong.wav")
@@ -1883,7 +2438,7 @@ def main():
     fah_ranker_t = Thread(target=fah_ranker, args=(bot, 9, 0))
     fah_ranker_t.start()
 
-    handler = CommandHandler(bot, tarallo, logs, tolab, users, people, conn, wol, quotes)
+    handler = CommandHandler(bot, tarallo, logs, tolab, users, people, conn, wol, quotes, dispatcher, wave_obj)
 
     birthday_wisher_t = Thread(target=handler.birthday_wisher)
     birthday_wisher_t.start()
@@ -1891,218 +2446,79 @@ def main():
     safety_test_reminder_t = Thread(target=handler.safety_test_reminder)
     safety_test_reminder_t.start()
 
-    while True:
-        # call the function to check if there are new messages
-        last_update = bot.get_last_update()
-
-        if last_update == -1:
-            # When no messages are received...
-            # print("last_update = -1")
-            continue
-
-        # per Telegram docs, either message or callback_query are None
-        # noinspection PyBroadException
-        try:
-            if "channel_post" in last_update:
-                # Leave scam channels where people add our bot randomly
-                chat_id = last_update["channel_post"]["chat"]["id"]
-                print(bot.leave_chat(chat_id).text)
-
-            # Ignore edited messages
-            elif "edited_message" in last_update:
-                continue
-
-            # Ignore images, stickers and stuff like that
-            elif "message" in last_update and "text" not in last_update["message"]:
-                continue
-
-            # see https://core.telegram.org/bots/api#message
-            elif "message" in last_update and "text" in last_update["message"]:
-                # Handle private messages
-                command = last_update["message"]["text"].split()
-                message_type = last_update["message"]["chat"]["type"]
-                # print(last_update['message'])  # Extremely advanced debug techniques
-
-                # Don't respond to messages in group chats
-                if message_type != "private":
-                    continue
-
-                authorized = handler.read_user_from_message(last_update)
-                if not authorized:
-                    continue
-
-                if command[0] == "/start" or command[0] == "/start@weeelab_bot":
-                    handler.start()
-
-                elif command[0] == "/inlab" or command[0] == "/inlab@weeelab_bot":
-                    handler.inlab()
-
-                elif command[0] == "/history" or command[0] == "/history@weeelab_bot":
-                    if len(command) < 2:
-                        handler.item_command_error("history")
-                    elif len(command) < 3:
-                        handler.history(command[1])
-                    else:
-                        handler.history(command[1], command[2])
-
-                elif command[0] == "/item" or command[0] == "/item@weeelab_bot":
-                    if len(command) < 2:
-                        handler.item_command_error("item")
-                    else:
-                        handler.item_info(command[1])
-
-                elif command[0] == "/location" or command[0] == "/location@weeelab_bot":
-                    if len(command) < 2:
-                        handler.item_command_error("location")
-                    else:
-                        handler.item_location(command[1])
-
-                elif command[0] == "/log" or command[0] == "/log@weeelab_bot":
-                    if len(command) > 1:
-                        handler.log(command[1])
-                    else:
-                        handler.log()
-
-                elif command[0] == "/tolab" or command[0] == "/tolab@weeelab_bot":
-                    if len(command) == 2:
-                        handler.tolab(command[1])
-                    elif len(command) >= 3:
-                        handler.tolab(command[1], command[2])
-                    else:
-                        handler.tolabGui()
-
-                elif command[0] == "/tolab_no" or command[0] == "/tolab_no@weeelab_bot":
-                    handler.tolab("no")
-
-                elif command[0] == "/ring":
-                    handler.ring(wave_obj)
-
-                elif command[0] == "/stat" or command[0] == "/stat@weeelab_bot":
-                    if len(command) > 1:
-                        handler.stat(command[1])
-                    else:
-                        handler.stat()
-
-                elif command[0] == "/top" or command[0] == "/top@weeelab_bot":
-                    if len(command) > 1:
-                        handler.top(command[1])
-                    else:
-                        handler.top()
-
-                elif command[0] == "/deletecache" or command[0] == "/deletecache@weeelab_bot":
-                    handler.delete_cache()
-
-                elif command[0] == "/help" or command[0] == "/help@weeelab_bot":
-                    handler.help()
+    return handler
 
-                elif command[0] == "/lofi" or command[0] == "/lofi@weeelab_bot":
-                    handler.lofi()
 
-                elif command[0] == "/wol" or command[0] == "/wol@weeelab_bot":
-                    handler.wol()
-
-                elif command[0] == "/game" or command[0] == "/game@weeelab_bot":
-                    if len(command) > 1:
-                        handler.game(command[1])
-                    else:
-                        handler.game()
-
-                elif command[0] == "/logout" or command[0] == "/logout@weeelab_bot":
-                    if len(command) > 1:
-                        # handler.logout(command[1:])
-                        logout = Thread(target=handler.logout, args=(command[1:],))
-                        logout.start()
-                    else:
-                        handler.logout_help()
-
-                elif command[0] == "/login" or command[0] == "/login@weeelab_bot":
-                    if len(command) == 2:
-                        login = Thread(target=handler.login, args=(command[1:],))
-                        login.start()
-                    else:
-                        handler.login_help()
+def main():
+    """main function of the bot"""
+    print("Entered main")
+    if BOT_INGESTION == "webhook" and (not WEBHOOK_URL or not WEBHOOK_SECRET):
+        # Without the secret token anyone who can reach the webhook could send updates as any user, admins included
+        raise ValueError("BOT_INGESTION=webhook needs WEBHOOK_URL and WEBHOOK_SECRET, not starting")
+    if BOT_RUNTIME == "asyncio":
+        asyncio.run(async_main())
+        return
 
-                elif command[0] == "/door" or command[0] == "/door@weeelab_bot":
-                    i_am_door = Thread(target=handler.i_am_door)
-                    i_am_door.start()
+    # One connection for each worker, plus one for polling
+    bot = BotHandler(TOKEN_BOT, pool_size=BOT_WORKERS + 1)
+    outbox = Outbox(bot)
+    dispatcher = Dispatcher(BOT_WORKERS)
+    handler = start_bot(outbox, dispatcher)
+    serve_updates(bot, outbox, dispatcher, handler)
 
-                elif command[0] == "/status" or command[0] == "/status@weeelab_bot":
-                    handler.status()
 
-                elif command[0] == "/quote" or command[0] == "/quote@weeelab_bot":
-                    author = None
-                    if len(command) > 1:
-                        author = " ".join(command[1:])
-                    handler.quote(author)
+def serve_updates(bot: BotHandler, outbox: Outbox, dispatcher: Dispatcher, handler: CommandHandler):
+    """
+    Receive updates forever and handle them
 
-                elif command[0] == "/motivami" or command[0] == "/motivami@weeelab_bot":
-                    handler.motivami()
+    :param bot: BotHandler that receives updates
+    :param outbox: Outbox that sends replies
+    :param dispatcher: Dispatcher to run commands on
+    :param handler: CommandHandler, as returned by start_bot
+    """
 
-                elif command[0] == "/nextbirthdays" or command[0] == "/nextbirthdays@weeelab_bot":
-                    handler.next_birthdays()
+    def schedule(last_update: dict):
+        # Updates from the same chat are handled in order, different chats in parallel
+        dispatcher.submit(update_chat_id(last_update), dispatch_update, outbox, handler, last_update)
 
-                elif command[0] == "/nexttests" or command[0] == "/nexttests@weeelab_bot":
-                    handler.next_tests()
+    if BOT_INGESTION == "webhook":
+        server = WebhookServer(schedule, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        if bot.set_webhook(WEBHOOK_URL, WEBHOOK_SECRET, max_connections=BOT_WORKERS) is None:
+            print("Failed to set webhook, Telegram won't send updates")
+        server.serve_forever()
+        return
 
-                elif command[0] == "/id" or command[0] == "/id@weeelab_bot":
-                    handler.id()
+    # Telegram refuses getUpdates while a webhook is set
+    bot.delete_webhook()
+    for last_update in bot.get_new_updates():
+        schedule(last_update)
 
-                else:
-                    flag = True
-                    user_id = last_update["message"]["from"]["id"]
-                    tolab_active_sessions = handler.get_tolab_active_sessions()
-                    for idx, session in enumerate(tolab_active_sessions):
-                        if user_id in session:
-                            handler.tolab_callback(f"hour:{command[0]}", session[1], user_id)
-                            flag = False
-                            break
-                    if flag:
-                        handler.unknown()
-
-            elif "callback_query" in last_update:
-                authorized = handler.read_user_from_callback(last_update)
-                if not authorized:
-                    continue
 
-                # Handle button callbacks
-                query = last_update["callback_query"]["data"]
-                message_id = last_update["callback_query"]["message"]["message_id"]
-                user_id = last_update["callback_query"]["from"]["id"]
-
-                if query.startswith("wol_"):
-                    handler.wol_callback(query, message_id)
-                elif query.startswith("lofi_"):
-                    handler.lofi_callback(query, message_id)
-                elif query.startswith("weeelab_"):
-                    handler.shutdown_callback(
-                        query,
-                        message_id,
-                        SSH_SCMA_USER,
-                        SSH_SCMA_HOST_IP,
-                        SSH_SCMA_KEY_PATH,
-                    )
-                elif query.startswith("i_am_door_"):
-                    handler.shutdown_callback(
-                        query,
-                        message_id,
-                        SSH_PIALL_USER,
-                        SSH_PIALL_HOST_IP,
-                        SSH_PIALL_KEY_PATH,
-                    )
-                elif query.startswith("game_"):
-                    handler.game_callback(query, message_id)
-                elif query.startswith("tolab:"):
-                    handler.tolab_callback(query, message_id, user_id)
-                else:
-                    handler.unknown()
-            else:
-                print('Unsupported "last_update" type')
-                print(last_update)
+async def async_main():
+    """
+    main function of the bot, asyncio version: talking to Telegram happens on the event loop,
+    commands (which wait for LDAP, ownCloud, SSH, ...) on the executor threads of the dispatcher
+    """
+    async with AsyncBotHandler(TOKEN_BOT, pool_size=BOT_WORKERS + 1) as bot:
+        loop = asyncio.get_running_loop()
+        dispatcher = AsyncDispatcher(BOT_WORKERS, loop)
+        outbox = Outbox(BlockingBotHandler(bot, loop))
+        handler = await loop.run_in_executor(None, start_bot, outbox, dispatcher)
+
+        def schedule(last_update: dict):
+            dispatcher.submit(update_chat_id(last_update), dispatch_update, outbox, handler, last_update)
+
+        if BOT_INGESTION == "webhook":
+            # The server runs in its own threads, the dispatcher wants to be called from the event loop
+            server = WebhookServer(lambda update: loop.call_soon_threadsafe(schedule, update), WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+            if await bot.set_webhook(WEBHOOK_URL, WEBHOOK_SECRET, max_connections=BOT_WORKERS) is None:
+                print("Failed to set webhook, Telegram won't send updates")
+            await loop.run_in_executor(None, server.serve_forever)
+            return
 
-        except:  # catch any exception if raised
-            print("ERROR!")
-            print(last_update)
-            print(traceback.format_exc())
+        await bot.delete_webhook()
+        async for last_update in bot.get_new_updates():
+            schedule(last_update)
 
 
 # call the main() until a keyboard interrupt is called